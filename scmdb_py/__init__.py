@@ -1,4 +1,5 @@
 import os
+import types
 from flask import Flask, current_app
 from flask_mail import Mail
 from flask_appconfig import AppConfig
@@ -6,13 +7,16 @@ from flask_bootstrap import Bootstrap
 from flask.ext.cache import Cache
 from flask_nav import Nav
 from flask_assets import Environment
-from flask_compress import Compress
-from flask_htmlmin import HTMLMIN
 from flask.json import JSONEncoder
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from flask_rq import RQ
-from .assets import app_css, app_js, vendor_css, vendor_js, browser_js, browser_css, tabular_rs1_js, tabular_rs2_js, tabular_ensemble_js, tabular_css, request_new_ensemble_js
+from .catalog import SchemaCatalog
+from .compress import compress, htmlmin
+from .lazy import preload, preload_in_background
+from .singleflight import SingleFlight
+from .assets import asset_manifest, flask_assets_bundles
+from .bundles import source_dirs
 import urllib.parse
 from flask_wtf import CsrfProtect
 
@@ -27,13 +31,13 @@ class MiniJSONEncoder(JSONEncoder):
     item_separator = ','
     key_separator = ':'
 
-cache = Cache(config={'CACHE_TYPE': 'simple', 'CACHE_THRESHOLD': 1000})
+cache = Cache()
+singleflight = SingleFlight(cache)
 nav = Nav()
 mail = Mail()
 db = SQLAlchemy()
 csrf = CsrfProtect()
-compress = Compress()
-htmlmin = HTMLMIN()
+catalog = SchemaCatalog()
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 # Set up Flask-Login
@@ -41,6 +45,19 @@ login_manager = LoginManager()
 login_manager.session_protection = 'strong'
 login_manager.login_view = 'frontend.login'
 
+def clear_data_cache(bind):
+    """Invalidate the memoized functions of content.py and frontend.py after the data of a bind changed.
+
+    Only their version hashes are replaced (cache.delete_memoized without arguments), so the rest of the cache stays:
+    compressed bodies and minified pages are keyed by their content and job ids by the data version.
+    """
+    from . import content, frontend
+    for module in (content, frontend):
+        for function in list(vars(module).values()):
+            # Plain functions only: hasattr on request proxies raises outside of requests.
+            if isinstance(function, types.FunctionType) and hasattr(function, 'make_cache_key'):
+                cache.delete_memoized(function)
+
 def create_app(configfile=None):
     app = Flask(__name__)
     AppConfig(app)
@@ -57,26 +74,21 @@ def create_app(configfile=None):
     app.config['RQ_DEFAULT_DB'] = 0
 
     # EAM : Set limit on the number of items in cache (RAM)
+    # Defaults only: a deployment sets CACHE_TYPE (ie. redis) in its config to share the cache between processes.
+    app.config.setdefault('CACHE_TYPE', 'simple')
+    app.config.setdefault('CACHE_THRESHOLD', 1000)
     cache.init_app(app)
 
     # Set up asset pipeline
     assets_env = Environment(app)
-    dirs = ['assets/styles', 'assets/scripts']
-    for path in dirs:
+    for path in source_dirs:
         assets_env.append_path(os.path.join(basedir, path))
     assets_env.url_expire = True
 
-    assets_env.register('app_css', app_css)
-    assets_env.register('app_js', app_js)
-    assets_env.register('vendor_css', vendor_css)
-    assets_env.register('vendor_js', vendor_js)
-    assets_env.register('browser_js', browser_js)
-    assets_env.register('browser_css', browser_css)
-    assets_env.register('tabular_ensemble_js', tabular_ensemble_js)
-    assets_env.register('tabular_rs1_js', tabular_rs1_js)
-    assets_env.register('tabular_rs2_js', tabular_rs2_js)
-    assets_env.register('request_new_ensemble_js', request_new_ensemble_js)
-    assets_env.register('tabular_css', tabular_css)
+    for name, bundle in flask_assets_bundles():
+        assets_env.register(name, bundle)
+    # Bundles prebuilt by scripts/build_assets.py, used instead of the ones above when built.
+    asset_manifest.init_app(app, assets_env)
 
     with app.app_context():
         from .frontend import frontend
@@ -87,17 +99,32 @@ def create_app(configfile=None):
         app.register_blueprint(content)
         #app.register_blueprint(content, url_prefix="/portal")
 
+        from .export import export
+        app.register_blueprint(export)
+
+        from . import jobs
+        jobs.init_app(app)
+
     app.json_encoder = MiniJSONEncoder
 
     nav.init_app(app)
     mail.init_app(app)
     csrf.init_app(app)
     db.init_app(app)
+    catalog.init_app(app, db)
+    catalog.on_version_change(clear_data_cache)
     login_manager.init_app(app)
     compress.init_app(app)
     htmlmin.init_app(app)
     RQ(app)
 
+    # numpy, pandas and plotly are imported on first use unless preloaded, see lazy.py.
+    preload_modules = app.config.get('PRELOAD_MODULES', False)
+    if preload_modules == 'background':
+        preload_in_background()
+    elif preload_modules:
+        preload()
+
     return app
 
 
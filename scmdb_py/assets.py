@@ -1,57 +1,88 @@
+"""Static asset bundles.
+
+Bundles are defined in bundles.py. scripts/build_assets.py builds them ahead of time into static/dist: concatenated,
+minified, named after the hash of their content and precompressed with gzip (and brotli if installed), with a
+manifest mapping bundle names to files. When the manifest exists, templates link the prebuilt files with
+asset_url(name) and they are served with far-future immutable caching, so requests do no webassets work. Without a
+manifest (ie. in development), asset_url falls back to the Flask-Assets bundles built on demand.
+"""
+import datetime
+import json
+import os
+import sys
+
+from flask import abort, request, send_file, url_for
 from flask_assets import Bundle
 
-app_css = Bundle('app_base.css', filters='cssmin', output='styles/app.css')
-
-app_js = Bundle('app.js', filters='jsmin', output='scripts/app.js')
-
-vendor_css = Bundle('vendor/semantic.min.css', output='styles/vendor.css')
-
-vendor_js = Bundle(
-    'vendor/jquery.min.js',
-    'vendor/semantic.min.js',
-    'vendor/tablesort.min.js',
-    'vendor/zxcvbn.js',
-    filters='jsmin',
-    output='scripts/vendor.js')
-
-browser_js = Bundle(
-        'vendor/plotly.min.js',
-        'vendor/datatables.min.js',
-        'vendor/bootstrap-toggle.min.js',
-        'vendor/select2.min.js',
-        'vendor/bootstrap-slider.min.js',
-        'customview.js',
-        output='scripts/browser.js')
-browser_css = Bundle(
-        'vendor/datatables.min.css',
-        'vendor/bootstrap-toggle.min.css',
-        'vendor/select2.min.css',
-        'vendor/bootstrap-slider.min.css',
-        'browser.css',
-        filters='cssmin',
-        output='styles/browser.css')
-
-tabular_rs1_js = Bundle(
-        'vendor/datatables.min.js',
-        'tabular_dataset_rs1.js',
-        output='scripts/tabular_rs1.js')
-
-tabular_rs2_js = Bundle(
-        'vendor/datatables.min.js',
-        'tabular_dataset_rs2.js',
-        output='scripts/tabular_rs2.js')
-
-tabular_ensemble_js = Bundle(
-        'vendor/datatables.min.js',
-        'tabular_ensemble.js',
-        output='scripts/tabular_ensemble.js')
-
-tabular_css = Bundle(
-        'vendor/datatables.min.css',
-        filters='cssmin',
-        output='styles/tabular.css')
-
-request_new_ensemble_js = Bundle(
-        'vendor/datatables.min.js',
-        'request_new_ensemble.js',
-        output='scripts/request_new_ensemble.js')
+from .bundles import bundles
+
+# Prebuilt bundles never change under a given name.
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+
+def flask_assets_bundles():
+    """Return the Flask-Assets Bundle of each bundle of bundles.py."""
+    return [(name, Bundle(*files, filters=filters, output=output)) for name, (files, filters, output) in bundles.items()]
+
+
+class AssetManifest(object):
+    """Prebuilt bundles listed in the manifest written by scripts/build_assets.py.
+
+    The manifest maps bundle names to {"file": "browser.<hash>.js", "encodings": ["br", "gzip"]}. Its location is
+    ASSETS_MANIFEST, by default static/dist/manifest.json.
+    """
+
+    def __init__(self):
+        self.bundles = {}
+        self.files = {}
+        self.directory = None
+        self.assets_env = None
+
+    def init_app(self, app, assets_env):
+        app.config.setdefault('ASSETS_MANIFEST', os.path.join(app.static_folder, 'dist', 'manifest.json'))
+        self.assets_env = assets_env
+        path = app.config['ASSETS_MANIFEST']
+        self.directory = os.path.dirname(os.path.abspath(path))
+        if os.path.exists(path):
+            try:
+                with open(path) as manifest:
+                    self.bundles = json.load(manifest)
+            except (IOError, ValueError) as e:
+                now = datetime.datetime.now()
+                print("[{}] ERROR in app(AssetManifest.init_app): Could not read {}: {}".format(str(now), path, e))
+                sys.stdout.flush()
+        self.files = {bundle['file']: bundle.get('encodings', []) for bundle in self.bundles.values()}
+
+        # Under /static so that relative url()s in the stylesheets resolve as for the Flask-Assets bundles.
+        app.add_url_rule('/static/dist/<path:filename>', 'dist', self.send_bundle)
+        app.add_template_global(self.asset_url, 'asset_url')
+
+    def asset_url(self, name):
+        """URL of a bundle: the prebuilt file if it is in the manifest, otherwise the Flask-Assets bundle."""
+        bundle = self.bundles.get(name)
+        if bundle is not None:
+            return url_for('dist', filename=bundle['file'])
+        return self.assets_env[name].urls()[0]
+
+    def send_bundle(self, filename):
+        """Serve a prebuilt bundle, precompressed if the client accepts one of its encodings."""
+        if filename not in self.files:
+            abort(404)
+        path = os.path.join(self.directory, filename)
+        mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+        encoding = None
+        for candidate in ('br', 'gzip'):
+            if candidate in self.files[filename] and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+
+        suffix = {'br': '.br', 'gzip': '.gz', None: ''}[encoding]
+        response = send_file(path + suffix, mimetype=mimetype, conditional=True)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = immutable_cache_control
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+asset_manifest = AssetManifest()
@@ -655,6 +655,10 @@ function updateMCHScatterPlot(onlyUpdatetSNEandClustering=false) {
                 //Plotly.newPlot('plot-mch-scatter', data);
                 $('#plot-mch-scatter').html(data);
                 $("#methylation-tsneUpdateBtn").attr('disabled', false);
+            },
+            error: function(xhr) {
+                $('#plot-mch-scatter').html(xhr.responseText);
+                $("#methylation-tsneUpdateBtn").attr('disabled', false);
             }
         });
     }
@@ -709,6 +713,10 @@ function updatesnATACScatterPlot(onlyUpdatetSNEandClustering=false) {
                 //Plotly.newPlot('plot-mch-scatter', data);
                 $('#plot-snATAC-scatter').html(data);
                 $("#methylation-tsneUpdateBtn").attr("disabled", false);
+            },
+            error: function(xhr) {
+                $('#plot-snATAC-scatter').html(xhr.responseText);
+                $("#methylation-tsneUpdateBtn").attr("disabled", false);
             }
         });
     }
@@ -878,6 +886,10 @@ function updateMCHBoxPlot() {
             $("#plot-mch-box").html(data);
             $('#gene_table_div').show();
             $("#methylation-box-heat-UpdateBtn").attr("disabled", false);
+        },
+        error: function(xhr) {
+            $("#plot-mch-box").html(xhr.responseText);
+            $("#methylation-box-heat-UpdateBtn").attr("disabled", false);
         }
     });
 
@@ -907,6 +919,10 @@ function updatesnATACBoxPlot() {
         success: function(data) {
             $('#plot-snATAC-box').html(data);
             $("#snATAC-box-heat-UpdateBtn").attr("disabled", false);
+        },
+        error: function(xhr) {
+            $('#plot-snATAC-box').html(xhr.responseText);
+            $("#snATAC-box-heat-UpdateBtn").attr("disabled", false);
         }
     });
 
@@ -971,6 +987,10 @@ function updateMethylationHeatmap() {
             $('#plot-mch-heat').html(data);
             $("#methylation-box-heat-UpdateBtn").attr("disabled", false);
             $('#methylation-box-heat-outlierToggle').bootstrapToggle('disable');
+        },
+        error: function(xhr) {
+            $('#plot-mch-heat').html(xhr.responseText);
+            $("#methylation-box-heat-UpdateBtn").attr("disabled", false);
         }
     });
 }
@@ -1008,6 +1028,10 @@ function updatesnATACHeatmap() {
             $('#plot-snATAC-heat').html(data);
             $('#snATAC-box-heat-outlierToggle').bootstrapToggle('disable');
             $("#snATAC-box-heat-UpdateBtn").attr("disabled", false);
+        },
+        error: function(xhr) {
+            $('#plot-snATAC-heat').html(xhr.responseText);
+            $("#snATAC-box-heat-UpdateBtn").attr("disabled", false);
         }
     });
 }
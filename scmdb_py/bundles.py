@@ -0,0 +1,37 @@
+"""Static asset bundles: name -> (source files, filter, output).
+
+Source files are looked up in assets/scripts and assets/styles. The bundles are registered with Flask-Assets by
+create_app and built ahead of time, fingerprinted and precompressed by scripts/build_assets.py.
+"""
+from collections import OrderedDict
+
+bundles = OrderedDict([
+    ('app_css', (['app_base.css'], 'cssmin', 'styles/app.css')),
+    ('app_js', (['app.js'], 'jsmin', 'scripts/app.js')),
+    ('vendor_css', (['vendor/semantic.min.css'], None, 'styles/vendor.css')),
+    ('vendor_js', (['vendor/jquery.min.js',
+                    'vendor/semantic.min.js',
+                    'vendor/tablesort.min.js',
+                    'vendor/zxcvbn.js'], 'jsmin', 'scripts/vendor.js')),
+    ('browser_js', (['vendor/plotly.min.js',
+                     'vendor/datatables.min.js',
+                     'vendor/bootstrap-toggle.min.js',
+                     'vendor/select2.min.js',
+                     'vendor/bootstrap-slider.min.js',
+                     'customview.js'], None, 'scripts/browser.js')),
+    ('browser_css', (['vendor/datatables.min.css',
+                      'vendor/bootstrap-toggle.min.css',
+                      'vendor/select2.min.css',
+                      'vendor/bootstrap-slider.min.css',
+                      'browser.css'], 'cssmin', 'styles/browser.css')),
+    ('tabular_rs1_js', (['vendor/datatables.min.js', 'tabular_dataset_rs1.js'], None, 'scripts/tabular_rs1.js')),
+    ('tabular_rs2_js', (['vendor/datatables.min.js', 'tabular_dataset_rs2.js'], None, 'scripts/tabular_rs2.js')),
+    ('tabular_ensemble_js', (['vendor/datatables.min.js', 'tabular_ensemble.js'], None,
+                             'scripts/tabular_ensemble.js')),
+    ('tabular_css', (['vendor/datatables.min.css'], 'cssmin', 'styles/tabular.css')),
+    ('request_new_ensemble_js', (['vendor/datatables.min.js', 'request_new_ensemble.js'], None,
+                                 'scripts/request_new_ensemble.js')),
+])
+
+# Directories of the source files, relative to the package.
+source_dirs = ['assets/styles', 'assets/scripts']
@@ -0,0 +1,228 @@
+"""In-memory catalog of the tables and columns in the data databases.
+
+Introspects each database bind once and answers table existence and tSNE/clustering option lookups from memory
+instead of querying the database on every request. The catalog is reloaded when the data version of a bind changes.
+
+Genes copied into the long-format gene_data table by scripts/migrate_gene_tables.py are looked up in gene_index.
+"""
+import datetime
+import hashlib
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import exc, inspect, text
+
+ensemble_table_pattern = re.compile(r'^Ens\d+$')
+gene_table_pattern = re.compile(r'^gene_(ENS[A-Z]*G\d+)(_\d+)?$')
+
+# Names, creation and last update times of the tables of a MySQL database, in one row. Updates of the tables written
+# by scripts/migrate_gene_tables.py are left out: they change with every chunk it copies.
+mysql_tables_query = """SELECT COUNT(*), SUM(CRC32(TABLE_NAME)), MAX(CREATE_TIME),
+    MAX(CASE WHEN TABLE_NAME NOT IN ('gene_index', 'gene_data') THEN UPDATE_TIME END)
+    FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()"""
+
+
+class EnsembleSchema(object):
+    """Columns of an ensemble table (Ens0, Ens1...) and the number of clusters of each clustering."""
+
+    def __init__(self, columns, num_clusters):
+        self.columns = columns
+        self.tsne_types = [x.split('tsne_x_')[1] for x in columns if x.startswith('tsne_x_')]
+        self.clustering_types = [x.split('cluster_')[1] for x in columns if x.startswith('cluster_')]
+        self.num_clusters = OrderedDict((clustering, num_clusters.get(clustering)) for clustering in self.clustering_types)
+
+
+class BindCatalog(object):
+    """Tables of a single database bind."""
+
+    def __init__(self, version, tables, gene_tables, ensembles, gene_indexes=None):
+        self.version = version
+        self.tables = tables
+        self.gene_tables = gene_tables
+        self.ensembles = ensembles
+        # gene_idx in gene_data of the gene tables that were migrated.
+        self.gene_indexes = gene_indexes or {}
+        # Column names of other tables, introspected on first use (see SchemaCatalog.table_columns).
+        self.columns = {}
+        self.checked = time.time()
+
+
+class SchemaCatalog(object):
+    """Catalog of gene tables, ensemble tables, tSNE/clustering columns and cluster counts for each bind.
+
+    The data version of a bind is DATA_VERSION from the app config if set, otherwise a fingerprint of the row
+    counts of the ensembles, datasets and cells tables, of the number of gene table migrations that finished (see
+    scripts/migrate_gene_tables.py) and of the tables themselves
+    (see table_fingerprint), so tables created, replaced or updated in place by the offline scripts are picked up. It
+    is checked at most every CATALOG_REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self._binds = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def init_app(self, app, db):
+        app.config.setdefault('CATALOG_REFRESH_INTERVAL', 300)
+        app.config.setdefault('CATALOG_PRELOAD', False)
+        self.app = app
+        self.db = db
+        app.extensions['schema_catalog'] = self
+
+        if app.config['CATALOG_PRELOAD']:
+            with app.app_context():
+                for bind in (app.config.get('SQLALCHEMY_BINDS') or {}):
+                    try:
+                        self.get(bind)
+                    except exc.SQLAlchemyError as e:
+                        now = datetime.datetime.now()
+                        print("[{}] ERROR in app(SchemaCatalog.init_app): Could not load {}: {}".format(str(now), bind, e))
+                        sys.stdout.flush()
+
+    def on_version_change(self, callback):
+        """Register a function to be called (with the bind name) after a bind is reloaded because its data changed."""
+        self._listeners.append(callback)
+
+    def engine(self, bind):
+        return self.db.get_engine(self.app, bind)
+
+    def data_version(self, bind):
+        """Return the current data version of a bind."""
+        if self.app.config.get('DATA_VERSION'):
+            return str(self.app.config['DATA_VERSION'])
+
+        engine = self.engine(bind)
+        counts = []
+        for query in ("SELECT COUNT(*) FROM ensembles", "SELECT COUNT(*) FROM datasets", "SELECT COUNT(*) FROM cells",
+                      "SELECT COUNT(*) FROM gene_migration"):
+            try:
+                counts.append(str(engine.execute(text(query)).scalar()))
+            except (exc.ProgrammingError, exc.OperationalError):
+                counts.append('-')
+        counts.append(self.table_fingerprint(engine))
+        return '.'.join(counts)
+
+    def table_fingerprint(self, engine):
+        """Return a hash of the table names of a database and, on MySQL, of their creation and update times.
+
+        MySQL 8 caches these times for information_schema_stats_expiry seconds (a day by default); set it lower, or
+        set DATA_VERSION, for updates made in place to be seen sooner.
+        """
+        if engine.dialect.name == 'mysql':
+            fingerprint = '/'.join(str(x) for x in engine.execute(text(mysql_tables_query)).fetchone())
+        else:
+            fingerprint = '\n'.join(sorted(inspect(engine).get_table_names()))
+        return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:12]
+
+    def load(self, bind, version=None):
+        """Introspect all tables of a bind."""
+        if version is None:
+            version = self.data_version(bind)
+        engine = self.engine(bind)
+        inspector = inspect(engine)
+
+        tables = set(inspector.get_table_names())
+        gene_tables = {}
+        ensembles = {}
+        for table in tables:
+            match = gene_table_pattern.match(table)
+            if match:
+                gene_tables[match.group(1)] = table
+            elif ensemble_table_pattern.match(table):
+                columns = [column['name'] for column in inspector.get_columns(table)]
+                clustering_columns = [x for x in columns if x.startswith('cluster_')]
+                num_clusters = {}
+                if clustering_columns:
+                    query = "SELECT " + ", ".join("MAX({0}) as {0}".format(x) for x in clustering_columns) + " FROM " + table
+                    result = engine.execute(text(query)).fetchone()
+                    num_clusters = {x.split('cluster_')[1]: n for x, n in zip(clustering_columns, result)}
+                ensembles[table] = EnsembleSchema(columns, num_clusters)
+
+        gene_indexes = {}
+        if 'gene_index' in tables and 'gene_data' in tables:
+            result = engine.execute(text("SELECT gene_idx, gene_id, table_name FROM gene_index WHERE migrated = 1"))
+            for gene_idx, gene_id, table_name in result:
+                gene_indexes[table_name] = gene_idx
+                # Per-gene tables may be dropped once migrated.
+                gene_tables.setdefault(gene_id, table_name)
+
+        return BindCatalog(version, tables, gene_tables, ensembles, gene_indexes)
+
+    def get(self, bind):
+        """Return the BindCatalog of a bind, loading or refreshing it if needed."""
+        catalog = self._binds.get(bind)
+        if catalog is not None and time.time() - catalog.checked < self.app.config['CATALOG_REFRESH_INTERVAL']:
+            return catalog
+
+        with self._lock:
+            catalog = self._binds.get(bind)
+            if catalog is not None and time.time() - catalog.checked < self.app.config['CATALOG_REFRESH_INTERVAL']:
+                return catalog
+
+            version = self.data_version(bind)
+            if catalog is not None and catalog.version == version:
+                catalog.checked = time.time()
+                return catalog
+
+            changed = catalog is not None
+            catalog = self.load(bind, version)
+            self._binds[bind] = catalog
+
+        if changed:
+            for callback in self._listeners:
+                callback(bind)
+        return catalog
+
+    @property
+    def version(self):
+        """Combined data version of all loaded binds."""
+        return ';'.join('{}={}'.format(bind, self._binds[bind].version) for bind in sorted(self._binds))
+
+    def current_version(self):
+        """Data version of all configured binds, loading or refreshing them first if needed."""
+        for bind in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            try:
+                self.get(bind)
+            except exc.SQLAlchemyError as e:
+                now = datetime.datetime.now()
+                print("[{}] ERROR in app(SchemaCatalog.current_version): Could not load {}: {}".format(str(now), bind, e))
+                sys.stdout.flush()
+        return self.version
+
+    def has_table(self, table_name, bind='methylation_data'):
+        return table_name in self.get(bind).tables
+
+    def gene_table(self, gene, bind='methylation_data'):
+        """Return the name of the table holding data for a gene, or None.
+
+        Arguments:
+            gene (str): Ensembl ID with or without the version number. ie. ENSMUSG00000026787 or ENSMUSG00000026787.3
+        """
+        return self.get(bind).gene_tables.get(gene.split('.')[0])
+
+    def gene_index(self, table_name, bind='methylation_data'):
+        """Return the gene_idx of a gene table in the long-format gene_data table, or None if it was not migrated."""
+        return self.get(bind).gene_indexes.get(table_name)
+
+    def ensemble(self, ensemble, bind='methylation_data'):
+        """Return the EnsembleSchema of an ensemble table, or None if it does not exist."""
+        return self.get(bind).ensembles.get(ensemble)
+
+    def table_columns(self, table_name, bind='methylation_data'):
+        """Return the column names of a table, introspected once per data version.
+
+        Raises NoSuchTableError if the table does not exist.
+        """
+        catalog = self.get(bind)
+        columns = catalog.columns.get(table_name)
+        if columns is None:
+            if table_name not in catalog.tables:
+                raise exc.NoSuchTableError(table_name)
+            columns = [column['name'] for column in inspect(self.engine(bind)).get_columns(table_name)]
+            catalog.columns[table_name] = columns
+        return columns
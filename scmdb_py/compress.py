@@ -1,6 +1,176 @@
-"""Instances of modules used to compress transfers."""
+"""Instances of modules used to compress transfers.
+
+PrecompressedCompress replaces the after_request hook of Flask-Compress, which gzipped every response again on every
+request even when the body came from the cache. Compressed bodies are stored in a response cache, keyed by the hash
+of the identity body and the encoding, so a repeated plot or summary is hashed and served from the cache instead of
+being compressed again. Brotli is used for clients that accept it when the brotli package is installed, gzip
+otherwise. The compression level depends on the size of the body: small bodies are compressed hardest, large ones
+with faster levels so that a cache miss on a multi-MB plot does not hold a worker for long.
+
+Streamed responses (ie. /content/metadata, /api/export) are left as they are instead of being buffered.
+
+SelectiveHTMLMIN replaces the after_request hook of Flask-HTMLmin, which ran the htmlmin parser over every text/html
+response, including the multi-MB plotly <div> fragments of the /plot routes. Those views are marked with
+@htmlmin.exempt, pages rendered from templates are minified once per distinct body and the result is cached.
+
+The response caches are SimpleCaches of their own, bounded by COMPRESS_CACHE_THRESHOLD and MINIFY_CACHE_THRESHOLD
+bodies, rather than the app cache: every distinct response would otherwise take an entry of the app cache and evict
+the memoized frames and plots it holds.
+"""
+import gzip
+import hashlib
+
+from flask import current_app, request
 from flask_compress import Compress
 from flask_htmlmin import HTMLMIN
+from werkzeug.contrib.cache import SimpleCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# (largest body size in bytes, gzip level, brotli quality), the last entry applies to larger bodies.
+default_levels = ((64 * 1024, 9, 11),
+                  (1024 * 1024, 6, 6),
+                  (None, 4, 4))
+
+
+def compression_levels(size, levels=default_levels):
+    """Return the gzip level and brotli quality for a body of the given size."""
+    for max_size, gzip_level, brotli_quality in levels:
+        if max_size is None or size <= max_size:
+            return gzip_level, brotli_quality
+    return levels[-1][1:]
+
+
+def response_cache(threshold, timeout):
+    """Return a cache holding at most threshold bodies, or None if threshold is 0."""
+    if not threshold:
+        return None
+    return SimpleCache(threshold=threshold, default_timeout=timeout)
+
+
+def compress_body(data, encoding, levels=default_levels):
+    """Compress a response body with gzip or brotli ("br")."""
+    gzip_level, brotli_quality = compression_levels(len(data), levels)
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level)
+
+
+class PrecompressedCompress(Compress):
+    """Flask-Compress with a cache of compressed bodies and brotli support.
+
+    Arguments of init_app:
+        app (Flask): Application.
+        cache (BaseCache): Cache the compressed bodies are stored in, for COMPRESS_CACHE_TIMEOUT seconds. Defaults to
+            a SimpleCache of COMPRESS_CACHE_THRESHOLD bodies. With a threshold of 0, bodies are compressed on every
+            request as Flask-Compress does.
+    """
+
+    def init_app(self, app, cache=None):
+        app.config.setdefault('COMPRESS_LEVELS', default_levels)
+        app.config.setdefault('COMPRESS_CACHE_TIMEOUT', 3600)
+        app.config.setdefault('COMPRESS_CACHE_THRESHOLD', 200)
+        app.config.setdefault('COMPRESS_BROTLI', True)
+        if cache is None:
+            cache = response_cache(app.config['COMPRESS_CACHE_THRESHOLD'], app.config['COMPRESS_CACHE_TIMEOUT'])
+        self.response_cache = cache
+        super(PrecompressedCompress, self).init_app(app)
+
+    def choose_encoding(self, app):
+        """Return "br" or "gzip" by the Accept-Encoding of the request, or None if it accepts neither."""
+        accepted = request.accept_encodings
+        if brotli is not None and app.config['COMPRESS_BROTLI'] and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def after_request(self, response):
+        app = self.app or current_app
+        if (response.mimetype not in app.config['COMPRESS_MIMETYPES'] or
+                not 200 <= response.status_code < 300 or
+                response.is_streamed or
+                (response.content_length is not None and
+                 response.content_length < app.config['COMPRESS_MIN_SIZE']) or
+                'Content-Encoding' in response.headers):
+            return response
+        encoding = self.choose_encoding(app)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if self.response_cache is None:
+            compressed = compress_body(data, encoding, app.config['COMPRESS_LEVELS'])
+        else:
+            key = 'compressed/{}/{}'.format(encoding, hashlib.sha1(data).hexdigest())
+            compressed = self.response_cache.get(key)
+            if compressed is None:
+                compressed = compress_body(data, encoding, app.config['COMPRESS_LEVELS'])
+                self.response_cache.set(key, compressed, timeout=app.config['COMPRESS_CACHE_TIMEOUT'])
+
+        response.direct_passthrough = False
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = response.content_length
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+class SelectiveHTMLMIN(HTMLMIN):
+    """Flask-HTMLmin skipping exempt views and caching minified pages.
+
+    Arguments of init_app:
+        app (Flask): Application.
+        cache (BaseCache): Cache the minified pages are stored in, keyed by the hash of the page, for
+            MINIFY_CACHE_TIMEOUT seconds. Defaults to a SimpleCache of MINIFY_CACHE_THRESHOLD pages. With a threshold
+            of 0, pages are minified on every request as Flask-HTMLmin does.
+    """
+
+    def __init__(self, app=None, **kwargs):
+        self._exempt_views = set()
+        self.response_cache = None
+        super(SelectiveHTMLMIN, self).__init__(app, **kwargs)
+
+    def init_app(self, app, cache=None):
+        app.config.setdefault('MINIFY_CACHE_TIMEOUT', 3600)
+        app.config.setdefault('MINIFY_CACHE_THRESHOLD', 200)
+        if cache is None:
+            cache = response_cache(app.config['MINIFY_CACHE_THRESHOLD'], app.config['MINIFY_CACHE_TIMEOUT'])
+        self.response_cache = cache
+        super(SelectiveHTMLMIN, self).init_app(app)
+
+    def exempt(self, view):
+        """Decorator excluding a view from minification, for views returning generated fragments (ie. plots)."""
+        self._exempt_views.add('{}.{}'.format(view.__module__, view.__name__))
+        return view
+
+    def is_exempt(self):
+        view = current_app.view_functions.get(request.endpoint)
+        return view is not None and '{}.{}'.format(view.__module__, view.__name__) in self._exempt_views
+
+    def response_minify(self, response):
+        if (response.content_type != 'text/html; charset=utf-8' or
+                not 200 <= response.status_code < 300 or
+                response.is_streamed or
+                self.is_exempt()):
+            return response
+
+        if self.response_cache is None:
+            minified = self.html_minify.minify(response.get_data(as_text=True))
+        else:
+            key = 'minified/' + hashlib.sha1(response.get_data()).hexdigest()
+            minified = self.response_cache.get(key)
+            if minified is None:
+                minified = self.html_minify.minify(response.get_data(as_text=True))
+                self.response_cache.set(key, minified, timeout=current_app.config['MINIFY_CACHE_TIMEOUT'])
+
+        response.direct_passthrough = False
+        response.set_data(minified)
+        return response
+
 
-compress = Compress()
-htmlmin = HTMLMIN()
+compress = PrecompressedCompress()
+htmlmin = SelectiveHTMLMIN()
@@ -10,19 +10,25 @@ from itertools import groupby, chain
 from random import sample
 
 import colorsys
-import colorlover as cl
-from flask import Blueprint, current_app, request
+from flask import Blueprint, Response, current_app, request, stream_with_context
 from sqlalchemy import exc, text
-import numpy as np
-from numpy import nan, linspace, arange, random
-import pandas as pd
-import plotly
-from plotly import tools
-from plotly.graph_objs import Layout, Annotation, Box, Scatter, Scattergl, Scatter3d, Heatmap
 import sqlite3
 from sqlite3 import Error
 
-from . import cache, db
+from . import cache, catalog, db, singleflight
+from .lazy import lazy_import
+from .correlation import search_correlated_genes
+from .decorators import http_cache
+from .frames import compact_frame, frozen, report_memory, sorted_positions, widen_float32
+
+# Imported on first use, see lazy.py.
+cl = lazy_import('colorlover')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+plotly = lazy_import('plotly')
+tools = lazy_import('plotly.tools')
+go = lazy_import('plotly.graph_objs')
+groupstats = lazy_import(__package__ + '.groupstats')
 
 content = Blueprint('content', __name__) # Flask "bootstrap"
 
@@ -30,22 +36,249 @@ cluster_annotation_order = ['mL2/3', 'mL4', 'mL5-1', 'mL5-2', 'mDL-1', 'mDL-2',
                             'mL6-1', 'mL6-2', 'mDL-3', 'mVip', 'mNdnf-1', \
                             'mNdnf-2', 'mPv', 'mSst-1', 'mSst-2', 'None']
 methylation_types_order = ['mCH', 'mCG', 'mCA', 'mCHmCG', 'mCHmCA', 'mCAmCG']
+# Pseudo-bulk levels aggregate sum(mc)/sum(c) over the cells of each group. Per-cell values are shown at the
+# corresponding per-cell level.
+pseudobulk_levels = {'pseudobulk': 'original', 'pseudobulk_normalized': 'normalized'}
 
 class FailToGraphException(Exception):
     """Fail to generate data or graph due to an internal error."""
     pass
 
+# Errors raised for a missing table or column. MySQL reports these as ProgrammingError, SQLite as OperationalError.
+query_errors = (exc.ProgrammingError, exc.OperationalError, exc.NoSuchTableError)
+
+
+# Data access
+# All queries go through these helpers so that the same SQL runs against the MySQL binds and against a local
+# SQLite copy of the databases (set the SQLALCHEMY_BINDS entries to sqlite:/// URIs). Queries use named
+# parameters (:name) and unquoted identifiers, which both dialects accept.
+def get_engine(bind='methylation_data'):
+    """Return the SQLAlchemy engine for a database bind.
+
+    Arguments:
+        bind (str): Name of the bind in SQLALCHEMY_BINDS. "methylation_data" or "snATAC_data".
+
+    Returns:
+        Engine
+    """
+    return db.get_engine(current_app, bind)
+
+
+def run_query(query, bind='methylation_data', **params):
+    """Execute a SQL query with named parameters.
+
+    Arguments:
+        query (str): SQL statement using :name placeholders.
+        bind (str): Name of the bind in SQLALCHEMY_BINDS.
+        **params: Values for the placeholders.
+
+    Returns:
+        ResultProxy
+    """
+    return get_engine(bind).execute(text(query), **params)
+
+
+def read_query(query, bind='methylation_data', **params):
+    """Same as run_query but returns the result as a DataFrame."""
+    return pd.read_sql(text(query), get_engine(bind), params=params)
+
+
+def stream_query(query, bind='methylation_data', chunk_size=10000, **params):
+    """Same as read_query but yields the result as DataFrames of at most chunk_size rows.
+
+    Rows are fetched from a server-side cursor (stream_results), so memory use does not grow with the size of the
+    result. The connection is held until the generator is exhausted or closed.
+    """
+    with get_engine(bind).connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(text(query), **params)
+        columns = list(result.keys())
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+
+def bind_list(name, values):
+    """Build placeholders for a variable number of values, e.g. for IN (...) or chained OR clauses.
+
+    Arguments:
+        name (str): Prefix for the generated parameter names.
+        values (list): Values to bind.
+
+    Returns:
+        list: Placeholder strings (":name_0", ":name_1", ...).
+        dict: Parameters to pass to run_query/read_query.
+
+    Example:
+        >>> bind_list('gene', ['Gad2', 'Sox6'])
+        ([':gene_0', ':gene_1'], {'gene_0': 'Gad2', 'gene_1': 'Sox6'})
+    """
+    names = ['{}_{}'.format(name, i) for i in range(len(values))]
+    return [':' + param for param in names], dict(zip(names, values))
+
+
+def table_exists(table_name, bind='methylation_data'):
+    """Check whether a table exists in a database bind."""
+    return get_engine(bind).has_table(table_name)
+
+
+def table_columns(table_name, bind='methylation_data'):
+    """List the column names of a table, from the schema catalog. Raises NoSuchTableError if it does not exist."""
+    return catalog.table_columns(table_name, bind)
+
+
+def datatables_request(args, table_columns):
+    """Read the DataTables server-side parameters of a request.
+
+    Columns are projected from columns[i][data], or from columns=a,b,c for plain (ie. NDJSON) requests, and
+    default to all columns. Names that are not columns of the table are ignored, so only known identifiers reach the
+    SQL.
+
+    Arguments:
+        args (MultiDict): Request arguments.
+        table_columns (list): Columns of the table.
+
+    Returns:
+        dict: draw, start, length (None for all rows, start is then ignored), columns, searchable, search (global
+            search value), column_searches ((column, value) pairs) and order ((column, 'ASC' or 'DESC') pairs).
+    """
+    columns, searchable, column_searches = [], [], []
+    # Columns by their index in the request, which order[i][column] refers to. None for unknown or unorderable ones.
+    orderable = []
+    i = 0
+    while 'columns[{}][data]'.format(i) in args:
+        column = args.get('columns[{}][data]'.format(i))
+        known = column in table_columns
+        orderable.append(column if known and args.get('columns[{}][orderable]'.format(i), 'true') == 'true' else None)
+        if known:
+            columns.append(column)
+            if args.get('columns[{}][searchable]'.format(i), 'true') == 'true':
+                searchable.append(column)
+            value = args.get('columns[{}][search][value]'.format(i), '')
+            if value:
+                column_searches.append((column, value))
+        i += 1
+    if not columns and args.get('columns'):
+        columns = [column for column in args.get('columns').split(',') if column in table_columns]
+    if not columns:
+        columns = list(table_columns)
+    if not searchable:
+        searchable = columns
+
+    order = []
+    i = 0
+    while 'order[{}][column]'.format(i) in args:
+        index = args.get('order[{}][column]'.format(i), type=int)
+        if index is not None and 0 <= index < len(orderable) and orderable[index] is not None:
+            direction = 'DESC' if args.get('order[{}][dir]'.format(i), 'asc').lower() == 'desc' else 'ASC'
+            order.append((orderable[index], direction))
+        i += 1
+
+    length = args.get('length', -1, type=int)
+    return {'draw': args.get('draw', type=int),
+            'start': max(args.get('start', 0, type=int), 0),
+            'length': length if length >= 0 else None,
+            'columns': columns,
+            'searchable': searchable,
+            'search': args.get('search[value]', ''),
+            'column_searches': column_searches,
+            'order': order}
+
+
+def datatables_queries(table, params, key='cell_id'):
+    """Build the SQL of a DataTables server-side request.
+
+    The global search matches any searchable column, column searches match their column (both as LIKE %value%).
+    Rows are ordered by key last so that pages are stable.
+
+    Returns:
+        tuple: Query counting the rows matching the searches and its parameters.
+        tuple: Query selecting the requested page of the matching rows and its parameters.
+    """
+    conditions, query_params = [], {}
+    if params['search']:
+        conditions.append('(' + ' OR '.join('{} LIKE :search'.format(column) for column in params['searchable']) + ')')
+        query_params['search'] = '%' + params['search'] + '%'
+    for i, (column, value) in enumerate(params['column_searches']):
+        conditions.append('{} LIKE :column_search_{}'.format(column, i))
+        query_params['column_search_{}'.format(i)] = '%' + value + '%'
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    order = list(params['order'])
+    if key not in [column for column, _ in order]:
+        order.append((key, 'ASC'))
+    limit = ''
+    page_params = dict(query_params)
+    if params['length'] is not None:
+        limit = ' LIMIT :limit OFFSET :offset'
+        page_params.update(limit=params['length'], offset=params['start'])
+
+    count_query = "SELECT COUNT(*) FROM {}{}".format(table, where)
+    select_query = "SELECT {} FROM {}{} ORDER BY {}{}".format(
+        ', '.join(params['columns']), table, where,
+        ', '.join('{} {}'.format(column, direction) for column, direction in order), limit)
+    return (count_query, query_params), (select_query, page_params)
+
+
+def json_rows(frames):
+    """Yield the rows of DataFrames as comma-separated JSON objects, without the enclosing brackets."""
+    first = True
+    for df in frames:
+        rows = df.to_json(orient='records')[1:-1]
+        if rows:
+            yield rows if first else ',' + rows
+            first = False
+
 
 @content.route('/content/metadata/')
+@http_cache('summaries')
 def get_metadata():
+    """ Cell metadata, following the DataTables server-side processing protocol.
 
-    result = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM cells;").fetchall()
-    result = [dict(r) for r in result]
+        Arguments (query string):
+            draw, start, length, search[value], order[i][column], order[i][dir], columns[i][data],
+            columns[i][searchable], columns[i][search][value]: see https://datatables.net/manual/server-side.
+            columns: Comma-separated columns to return, for requests not made by DataTables.
+            format: "json" (default) or "ndjson", one JSON object per line.
+
+        Returns:
+            JSON: {"draw", "recordsTotal", "recordsFiltered", "data": [rows]} for DataTables requests (with draw),
+                {"data": [rows]} otherwise. Without length, all matching rows are returned.
 
-    return json.dumps({"data": result})
+        Rows are read from a server-side cursor and written as they are read, so the whole table can be requested
+        without holding it in memory.
+    """
+    params = datatables_request(request.args, table_columns('cells'))
+    (count_query, count_params), (select_query, select_params) = datatables_queries('cells', params)
+    chunk_size = current_app.config.get('METADATA_ROWS_PER_CHUNK', 10000)
+    frames = stream_query(select_query, chunk_size=chunk_size, **select_params)
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for df in frames:
+                if len(df):
+                    yield df.to_json(orient='records', lines=True).rstrip('\n') + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    header = '{"data":['
+    if params['draw'] is not None:
+        total = run_query("SELECT COUNT(*) FROM cells").scalar()
+        filtered = total
+        if params['search'] or params['column_searches']:
+            filtered = run_query(count_query, **count_params).scalar()
+        header = '{{"draw":{},"recordsTotal":{},"recordsFiltered":{},"data":['.format(params['draw'], total, filtered)
+
+    def generate():
+        yield header
+        for rows in json_rows(frames):
+            yield rows
+        yield ']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 @content.route('/content/ensembles')
+@http_cache('summaries')
 def get_ensembles_summary():
     """ Retrieve data to be displayed in the "Ensembles" summary tabular page. 
         "/tabular/ensemble"
@@ -54,26 +287,26 @@ def get_ensembles_summary():
     regions_lower = [ region.lower() for region in regions ]
     
     ensemble_list=[]
-    ensemble_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles").fetchall()
+    ensemble_list = run_query("SELECT * FROM ensembles").fetchall()
 
-    total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall()
+    total_methylation_cell_each_dataset = run_query("SELECT dataset, COUNT(*) as num FROM cells GROUP BY dataset").fetchall()
     total_methylation_cell_each_dataset = [ {d['dataset']: d['num']} for d in total_methylation_cell_each_dataset ]
     total_methylation_cell_each_dataset = { k.split('_',maxsplit=1)[1]: v for d in total_methylation_cell_each_dataset for k, v in d.items() }
 
     ensembles_cell_counts = []
     for ensemble in ensemble_list:
         ensemble_tbl = 'Ens' + str(ensemble['ensemble_id'])
-        query_methylation = "SELECT dataset, COUNT(*) as `num` FROM cells INNER JOIN {} ON cells.cell_id = {}.cell_id GROUP BY dataset".format(ensemble_tbl, ensemble_tbl)
-        methylation_cell_counts = db.get_engine(current_app, 'methylation_data').execute(query_methylation).fetchall()
+        query_methylation = "SELECT dataset, COUNT(*) as num FROM cells INNER JOIN {} ON cells.cell_id = {}.cell_id GROUP BY dataset".format(ensemble_tbl, ensemble_tbl)
+        methylation_cell_counts = run_query(query_methylation).fetchall()
         methylation_cell_counts = [ {d['dataset']: d['num']} for d in methylation_cell_counts]
         methylation_cell_counts = { k.split('_',maxsplit=1)[1]: v for d in methylation_cell_counts for k, v in d.items() }
 
-        query_snATAC = "SELECT dataset, COUNT(*) as `num` FROM cells INNER JOIN {} ON cells.cell_id = {}.cell_id GROUP BY dataset".format(ensemble_tbl, ensemble_tbl)
+        query_snATAC = "SELECT dataset, COUNT(*) as num FROM cells INNER JOIN {} ON cells.cell_id = {}.cell_id GROUP BY dataset".format(ensemble_tbl, ensemble_tbl)
         try:
-            snATAC_cell_counts = db.get_engine(current_app, 'snATAC_data').execute(query_snATAC).fetchall()
+            snATAC_cell_counts = run_query(query_snATAC, bind='snATAC_data').fetchall()
             snATAC_cell_counts = [ {d['dataset']: d['num']} for d in snATAC_cell_counts]
             snATAC_cell_counts = { k.split('_',maxsplit=1)[1]: v for d in snATAC_cell_counts for k, v in d.items() }
-        except exc.ProgrammingError as e:
+        except query_errors as e:
             snATAC_cell_counts = None
 
         ensembles_cell_counts.append( {"id": ensemble['ensemble_id'], 
@@ -113,11 +346,12 @@ def get_ensembles_summary():
             ens_dict["target_regions_rs2_descriptive"] = ""
 
             if len(rs2_datasets_in_ensemble) != 0:
+                placeholders, params = bind_list('dataset', rs2_datasets_in_ensemble)
                 target_regions_query = "SELECT DISTINCT datasets.target_region, ABA_regions.ABA_description \
                     FROM datasets \
                     INNER JOIN ABA_regions ON ABA_regions.ABA_acronym=datasets.target_region \
-                    AND datasets.dataset in (" + ",".join(("%s",) * len(rs2_datasets_in_ensemble)) + ")"
-                target_regions_result = db.get_engine(current_app, 'methylation_data').execute(target_regions_query, tuple(rs2_datasets_in_ensemble,)).fetchall()
+                    AND datasets.dataset in (" + ",".join(placeholders) + ")"
+                target_regions_result = run_query(target_regions_query, **params).fetchall()
                 ens_dict["target_regions_rs2_acronym"] = ", ".join([ x.target_region for x in target_regions_result ])
                 ens_dict["target_regions_rs2_descriptive"] = ", ".join([ x.ABA_description for x in target_regions_result ])
 
@@ -132,8 +366,9 @@ def get_ensembles_summary():
             ens_dict["total_methylation_cells"] = total_methylation_cells
             ens_dict["total_snATAC_cells"] = total_snATAC_cells
 
-            ens_regions_query = "SELECT DISTINCT(ABA_acronym), ABA_description FROM ABA_regions WHERE `code` IN (" + ",".join("'"+x+"'" for x in list(slices_set)) + ")"
-            ens_regions_result = db.get_engine(current_app, 'methylation_data').execute(ens_regions_query).fetchall()
+            placeholders, params = bind_list('code', sorted(slices_set))
+            ens_regions_query = "SELECT DISTINCT(ABA_acronym), ABA_description FROM ABA_regions WHERE code IN (" + ",".join(placeholders) + ")"
+            ens_regions_result = run_query(ens_regions_query, **params).fetchall()
             ens_regions_acronyms = [d['ABA_acronym'] for d in ens_regions_result]
             ens_regions_descriptions = [d['ABA_description'] for d in ens_regions_result]
             ens_dict["ABA_regions_acronym"] = ", ".join(ens_regions_acronyms).replace('+',', ')
@@ -161,6 +396,7 @@ def get_ensembles_summary():
 
 
 @content.route('/content/datasets/<rs>')
+@http_cache('summaries')
 def get_datasets_summary(rs):
     """ Retrieve data to be displayed in the RS1 and RS2 summmary tabular page. 
         "/tabular/dataset/rs1"
@@ -171,17 +407,17 @@ def get_datasets_summary(rs):
     """
     
     if rs == "rs1":
-        dataset_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM datasets WHERE dataset NOT LIKE 'CEMBA_RS2_%%'").fetchall()
-        total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset NOT LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
-        total_snATAC_cell_each_dataset = db.get_engine(current_app, 'snATAC_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset NOT LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
+        dataset_list = run_query("SELECT * FROM datasets WHERE dataset NOT LIKE 'CEMBA_RS2_%'").fetchall()
+        total_methylation_cell_each_dataset = run_query("SELECT dataset, COUNT(*) as num FROM cells WHERE dataset NOT LIKE 'CEMBA_RS2_%' GROUP BY dataset").fetchall()
+        total_snATAC_cell_each_dataset = run_query("SELECT dataset, COUNT(*) as num FROM cells WHERE dataset NOT LIKE 'CEMBA_RS2_%' GROUP BY dataset", bind='snATAC_data').fetchall()
     elif rs == "rs2":
-        dataset_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM datasets WHERE dataset LIKE 'CEMBA_RS2_%%'").fetchall()
-        total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
-        total_snATAC_cell_each_dataset = db.get_engine(current_app, 'snATAC_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells WHERE dataset LIKE 'CEMBA_RS2_%%' GROUP BY dataset").fetchall()
+        dataset_list = run_query("SELECT * FROM datasets WHERE dataset LIKE 'CEMBA_RS2_%'").fetchall()
+        total_methylation_cell_each_dataset = run_query("SELECT dataset, COUNT(*) as num FROM cells WHERE dataset LIKE 'CEMBA_RS2_%' GROUP BY dataset").fetchall()
+        total_snATAC_cell_each_dataset = run_query("SELECT dataset, COUNT(*) as num FROM cells WHERE dataset LIKE 'CEMBA_RS2_%' GROUP BY dataset", bind='snATAC_data').fetchall()
     elif rs == "all":
-        dataset_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM datasets").fetchall()
-        total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall()
-        total_snATAC_cell_each_dataset = db.get_engine(current_app, 'snATAC_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall()
+        dataset_list = run_query("SELECT * FROM datasets").fetchall()
+        total_methylation_cell_each_dataset = run_query("SELECT dataset, COUNT(*) as num FROM cells GROUP BY dataset").fetchall()
+        total_snATAC_cell_each_dataset = run_query("SELECT dataset, COUNT(*) as num FROM cells GROUP BY dataset", bind='snATAC_data').fetchall()
     else:
         return
 
@@ -205,7 +441,7 @@ def get_datasets_summary(rs):
             brain_region_code = brain_region_code[-2:]
             research_segment = "RS2"
             
-        regions_sql = db.get_engine(current_app, 'methylation_data').execute("SELECT ABA_description FROM ABA_regions WHERE ABA_acronym=%s", (dataset['brain_region'],)).fetchone()
+        regions_sql = run_query("SELECT ABA_description FROM ABA_regions WHERE ABA_acronym=:acronym", acronym=dataset['brain_region']).fetchone()
         if regions_sql is not None:
             ABA_regions_descriptive = regions_sql['ABA_description'].replace('+', ', ')
         else: 
@@ -233,7 +469,7 @@ def get_datasets_summary(rs):
                                              "date_added": str(dataset['date_online']),
                                              "description": dataset['description'] })
         else:
-            target_region_sql = db.get_engine(current_app, 'methylation_data').execute("SELECT ABA_description FROM ABA_regions WHERE ABA_acronym=%s", (dataset['target_region'],)).fetchone()
+            target_region_sql = run_query("SELECT ABA_description FROM ABA_regions WHERE ABA_acronym=:acronym", acronym=dataset['target_region']).fetchone()
             if target_region_sql is not None:
                 target_region_descriptive = target_region_sql['ABA_description'].replace('+', ', ')
             else:
@@ -275,7 +511,7 @@ def check_ensemble_similarities(new_ensemble_name, new_ensemble_datasets):
     Used by the "request_new_ensemble" page. Checks if the new ensemble has any similarities with pre-existing ensembles to prevent duplication of ensembles.
     """
 
-    existing_ensembles = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles").fetchall()
+    existing_ensembles = run_query("SELECT * FROM ensembles").fetchall()
     existing_ensembles_list = [ dict(d) for d in existing_ensembles ]
     existing_ensembles_names_list = [ d['ensemble_name'] for d in existing_ensembles ]
 
@@ -285,8 +521,9 @@ def check_ensemble_similarities(new_ensemble_name, new_ensemble_datasets):
 
     new_ensemble_datasets = new_ensemble_datasets.split('+')
     
-    query = "SELECT cell_id FROM cells WHERE dataset IN (" + ",".join(('%s',)*len(new_ensemble_datasets)) + ")"
-    cells_in_new_ensemble = db.get_engine(current_app, 'methylation_data').execute(query, tuple(new_ensemble_datasets)).fetchall()
+    placeholders, params = bind_list('dataset', new_ensemble_datasets)
+    query = "SELECT cell_id FROM cells WHERE dataset IN (" + ",".join(placeholders) + ")"
+    cells_in_new_ensemble = run_query(query, **params).fetchall()
     cells_in_new_ensemble_set = set([ cell['cell_id'] for cell in cells_in_new_ensemble ])
 
     if len(cells_in_new_ensemble_set) <= 200:
@@ -302,7 +539,7 @@ def check_ensemble_similarities(new_ensemble_name, new_ensemble_datasets):
 
     for similar_ensemble in same_datasets_in_both:
         query = "SELECT cell_id FROM Ens{}".format(similar_ensemble['ensemble_id'])
-        cells_in_similar_ensemble = db.get_engine(current_app, 'methylation_data').execute(query).fetchall()
+        cells_in_similar_ensemble = run_query(query).fetchall()
         cells_in_similar_ensemble_set = set([ cell['cell_id'] for cell in cells_in_similar_ensemble ])
         different_cells = cells_in_new_ensemble_set ^ cells_in_similar_ensemble_set
 
@@ -334,7 +571,7 @@ def ensemble_exists(ensemble):
         bool: Whether if given ensemble exists
     """
 
-    return db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles WHERE ensemble_name=%s", (ensemble,)).fetchone() != None
+    return run_query("SELECT * FROM ensembles WHERE ensemble_name=:ensemble_name", ensemble_name=ensemble).fetchone() != None
 
 
 @cache.memoize(timeout=1800)
@@ -351,7 +588,7 @@ def gene_exists(ensemble, methylation_type, gene):
     """
 
     gene_table_name = 'gene_' + gene.replace(".", "_")
-    return len(db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM information_schema.tables WHERE table_name = %s", (gene_table_name,)).fetchall()) > 0
+    return catalog.has_table(gene_table_name) or catalog.gene_index(gene_table_name) is not None
 
 
 def build_hover_text(labels):
@@ -390,11 +627,11 @@ def generate_cluster_colors(num, grouping):
         return c
 
     if num>18:
-        # c = ['hsl('+str(round(h*1.8 % 360))+',50%,50%)' for h in linspace(0, 360, num)]
-        c = ['rgb'+str(colorsys.hls_to_rgb((h*1.8/360), 0.5, 0.5)) for h in linspace(0, 360, num)]
+        # c = ['hsl('+str(round(h*1.8 % 360))+',50%,50%)' for h in np.linspace(0, 360, num)]
+        c = ['rgb'+str(colorsys.hls_to_rgb((h*1.8/360), 0.5, 0.5)) for h in np.linspace(0, 360, num)]
     else:
-        # c = ['hsl('+str(round(h*1.3 % 360))+',50%,50%)' for h in linspace(0, 360, num)]
-        c = ['rgb'+str(colorsys.hls_to_rgb((h*1.3 / 360), 0.5, 0.5)) for h in linspace(0, 360, num)]
+        # c = ['hsl('+str(round(h*1.3 % 360))+',50%,50%)' for h in np.linspace(0, 360, num)]
+        c = ['rgb'+str(colorsys.hls_to_rgb((h*1.3 / 360), 0.5, 0.5)) for h in np.linspace(0, 360, num)]
 
     c=c+c
     return c
@@ -423,7 +660,7 @@ def set_color_by_percentile(this, start, end):
     return this
 
 
-@cache.cached(timeout=3600)
+@cache.memoize(timeout=3600)
 def all_gene_modules():
     """Generate list of gene modules for populating gene modules selector.
     Arguments:
@@ -432,7 +669,7 @@ def all_gene_modules():
         list of gene module names. 
     """
 
-    modules_result = db.get_engine(current_app, 'methylation_data').execute("SELECT DISTINCT(module) FROM gene_modules").fetchall()
+    modules_result = run_query("SELECT DISTINCT(module) FROM gene_modules").fetchall()
     modules = [{'module': module['module']} for module in modules_result]
 
     return modules
@@ -447,7 +684,7 @@ def get_genes_of_module(module):
         Dataframe of gene_name and gene_id of each gene in the module for the corresponding
     """
 
-    modules_result = db.get_engine(current_app, 'methylation_data').execute("SELECT module, mmu_gene_id, mmu_gene_name FROM gene_modules WHERE module=%s", (module,)).fetchall()
+    modules_result = run_query("SELECT module, mmu_gene_id, mmu_gene_name FROM gene_modules WHERE module=:module", module=module).fetchall()
     genes_in_module = [ {'module': d['module'], 'gene_id': d['mmu_gene_id'], 'gene_name': d['mmu_gene_name']} for d in modules_result ]
 
     return genes_in_module
@@ -461,33 +698,41 @@ def get_cluster_marker_genes(ensemble, clustering):
         clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering. ie. mCH_lv_npc50_k5
     Returns:
     list of dicts. ie [{'clustering': 'mCH_lv_npc50_k5', 'cluster': 1, 'rank': 1, 'gene_id': 'ENSMUSG_########', 'gene_name': 'Gad2'}]
+    None if the query failed, so that the failure is not cached.
     """
 
-    if ';' in ensemble:
+    if ';' in ensemble or not catalog.has_table('{}_cluster_marker_genes'.format(ensemble)):
         return []
 
     query = "SELECT clustering, cluster, rank, genes.gene_id, genes.gene_name \
         FROM {0}_cluster_marker_genes \
         INNER JOIN genes ON {0}_cluster_marker_genes.gene_id = genes.gene_id \
-        WHERE clustering = %s".format(ensemble)
+        WHERE clustering = :clustering \
+        ORDER BY cluster, rank".format(ensemble)
 
     try:
-        result = db.get_engine(current_app, 'methylation_data').execute(query, (clustering,)).fetchall()
-    except exc.ProgrammingError as e:
+        result = run_query(query, clustering=clustering).fetchall()
+    except query_errors as e:
         now = datetime.datetime.now()
         print("[{}] ERROR in app(get_cluster_marker_genes): {}".format(str(now), e))
         sys.stdout.flush()
+        return None
+
+    if not result:
         return []
 
-    result = [ dict(x) for x in result ]
-    num_genes = result[-1]['rank']
-    num_clusters = result[-1]['cluster']
+    # Clusters may have different numbers of marker genes, so group by cluster rather than assuming a fixed stride.
+    genes_by_cluster = {cluster: [gene.gene_name for gene in genes] for cluster, genes in groupby(result, key=lambda x: x.cluster)}
+    num_clusters = max(genes_by_cluster)
+    num_genes = max(len(genes) for genes in genes_by_cluster.values())
     columns = [ 'cluster_'+str(i+1) for i in range(num_clusters) ] 
 
     rows = []
     for i in range(num_genes):
         row = {}
-        row = dict(zip(columns, [ gene['gene_name'] for gene in result[i:: num_genes] ] ))
+        for cluster, column in enumerate(columns, 1):
+            genes = genes_by_cluster.get(cluster, [])
+            row[column] = genes[i] if i < len(genes) else ''
         row['rank'] = i+1
         rows.append(row)
 
@@ -499,72 +744,200 @@ def get_cluster_marker_genes(ensemble, clustering):
 
 
 @cache.memoize(timeout=3600)
-def median_cluster_mch(gene_info, grouping, clustering):
-    """Returns median mch level of a gene for each cluster.
+def get_cluster_marker_genes_json(ensemble, clustering):
+    """Retrieves the pre-serialized marker gene table of a clustering written by scripts/generate_marker_genes.py.
+    Arguments:
+        ensemble (str): Ensemble id. ie. Ens0, Ens1...
+        clustering (str): ie. mCH_lv_npc50_k5
+    Returns:
+        str: JSON in the same format as get_cluster_marker_genes, or None if it has not been generated.
+    """
+
+    table_name = '{}_cluster_marker_genes_json'.format(ensemble)
+    if ';' in ensemble or not catalog.has_table(table_name):
+        return None
+
+    try:
+        return run_query("SELECT data FROM {} WHERE clustering = :clustering".format(table_name), clustering=clustering).scalar()
+    except query_errors as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_cluster_marker_genes_json): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+
+def dataset_slice(dataset):
+    """Brain slice of a dataset. ie. CEMBA_3C_171206 -> 3C, CEMBA_RS2_Bm3C -> 3C"""
+    return dataset.split('_')[1] if 'RS2' not in dataset else dataset.split('_')[2][2:4]
+
+
+@frozen
+@singleflight.memoize(timeout=3600)
+def get_ensemble_cells(ensemble, clustering='ATAC', bind='methylation_data'):
+    """Returns the cells of an ensemble with their grouping variables as categorical columns.
+
+        Categories are sorted, so the integer codes of a column are stable for a given ensemble and clustering. The
+        slice of each cell is derived once per dataset.
 
         Arguments:
-            gene_info (dict): mCH data for each sample. Keys are samp(cell), tsne_x, tsne_y, cluster_label, cluster_ordered, original, normalized.
-            level (str): "original" or "normalized" methylation values.
+            ensemble (str): Ensemble identifier. ie. Ens0, Ens1...
+            clustering (str): Clustering of the annotation and cluster columns. "ATAC" for snATAC data.
+            bind (str): "methylation_data" or "snATAC_data".
 
         Returns:
-            dict: Cluster_label (key) : median mCH level (value).
+            DataFrame: cell_id, dataset, slice, annotation_<clustering> (missing annotations are "None"),
+                cluster_<clustering>, and target_region (missing regions are "N/A") and sex when the datasets table
+                has them. None if the query fails.
     """
+    if ';' in ensemble or ';' in clustering:
+        return None
 
-    if gene_info is not None:
-        if grouping == 'annotation':
-            gene_info.fillna({'annotation_'+clustering: 'None'}, inplace=True)
-            return gene_info.groupby('annotation_'+clustering, sort=False)[gene_info.columns[-1]].median()
-        elif grouping == 'cluster':
-            return gene_info.groupby('cluster_'+clustering, sort=False)[gene_info.columns[-1]].median()
-        elif grouping == 'dataset':
-            return gene_info.groupby('dataset', sort=False)[gene_info.columns[-1]].median()
-        elif grouping == 'target_region':
-            gene_info['target_region'].fillna('N/A', inplace=True)
-            return gene_info.groupby('target_region', sort=False)[gene_info.columns[-1]].median()
-        elif grouping == 'slice':
-            datasets_all_cells = gene_info['dataset'].tolist()
-            slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
-            gene_info['slice'] = slices_list
-            return gene_info.groupby('slice', sort=False)[gene_info.columns[-2]].median()
-        elif grouping == 'sex':
-            return gene_info.groupby('sex', sort=False)[gene_info.columns[-1]].median()
-        else:
-            return None
+    try:
+        dataset_columns = [column for column in ('target_region', 'sex') if column in table_columns('datasets', bind)]
+        query = "SELECT cells.cell_id, cells.dataset, {0}.annotation_{1}, {0}.cluster_{1}{2} \
+            FROM cells \
+            INNER JOIN {0} ON cells.cell_id = {0}.cell_id \
+            LEFT JOIN datasets ON cells.dataset = datasets.dataset".format(
+                ensemble, clustering, ''.join(', datasets.' + column for column in dataset_columns))
+        df = read_query(query, bind=bind)
+    except query_errors as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_ensemble_cells): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+    df['annotation_'+clustering] = df['annotation_'+clustering].fillna('None')
+    if 'target_region' in df.columns:
+        df['target_region'] = df['target_region'].fillna('N/A')
+    for column in df.columns.drop('cell_id'):
+        df[column] = df[column].astype('category')
+
+    datasets = df['dataset'].cat
+    slices = [dataset_slice(dataset) for dataset in datasets.categories]
+    slice_categories = sorted(set(slices))
+    # The extra last entry maps code -1 (no dataset) to itself.
+    slice_codes = np.array([slice_categories.index(s) for s in slices] + [-1])
+    df['slice'] = pd.Categorical.from_codes(slice_codes[datasets.codes.values], slice_categories)
+
+    return df
+
+
+@singleflight.memoize(timeout=3600)
+def get_cell_groups(ensemble, grouping, clustering='ATAC', bind='methylation_data'):
+    """Encodes the group of each cell of an ensemble as an integer code, for per-group statistics (see groupstats).
+
+        Codes are taken from the categorical columns of get_ensemble_cells.
+
+        Arguments:
+            ensemble (str): Ensemble identifier. ie. Ens0, Ens1...
+            grouping (str): "annotation", "cluster", "dataset", "target_region", "slice" or "sex".
+            clustering (str): Clustering of the annotation and cluster groupings. "ATAC" for snATAC data.
+            bind (str): "methylation_data" or "snATAC_data".
+
+        Returns:
+            GroupCodes: Keyed by cell_id. Groups are named like the columns returned by get_gene_methylation,
+                ie. annotation_mCH_lv_npc50_k5 or target_region. None if the grouping is unknown.
+    """
+    if grouping == 'annotation' or grouping == 'cluster':
+        column = grouping + '_' + clustering
+    elif grouping in ('dataset', 'slice', 'target_region', 'sex'):
+        column = grouping
     else:
         return None
 
+    cells = get_ensemble_cells(ensemble, clustering, bind)
+    if cells is None or column not in cells.columns:
+        return None
+    values = cells[column].cat
+    return groupstats.GroupCodes(values.codes.values, pd.Index(values.categories, name=column), keys=cells['cell_id'].values)
 
-@cache.memoize(timeout=3600)
-def median_cluster_snATAC(gene_info, grouping):
+
+def median_cluster_mch(gene_info, grouping, clustering, ensemble):
     """Returns median mch level of a gene for each cluster.
 
         Arguments:
-            gene_info (dict): mCH data for each sample. Keys are samp(cell), tsne_x, tsne_y, cluster_label, cluster_ordered, original, normalized.
-            level (str): "original" or "normalized" methylation values.
+            gene_info (DataFrame): mCH data for each cell, from get_gene_methylation. The last column is the mCH level.
+            grouping (str): Variable to group cells by. "cluster", "annotation", "dataset", "target_region", "slice" or "sex".
+            clustering (str): Different clustering algorithms and parameters.
+            ensemble (str): Ensemble identifier.
 
         Returns:
-            dict: Cluster_label (key) : median mCH level (value).
+            Series: median mCH level of each group, indexed by group.
     """
 
-    if grouping == 'annotation':
-        gene_info.fillna({'annotation_ATAC': 'None'}, inplace=True)
-    if grouping != 'dataset':
-        return gene_info.groupby(grouping+'_ATAC', sort=False)['normalized_counts'].median()
-    else:
-        return gene_info.groupby(grouping, sort=False)['normalized_counts'].median()
+    if gene_info is None:
+        return None
+    groups = get_cell_groups(ensemble, grouping, clustering)
+    if groups is None:
+        return None
+    return groups.for_keys(gene_info['cell_id'].values).median(gene_info[gene_info.columns[-1]].values)
 
-    if grouping == 'annotation':
-        gene_info.fillna({'annotation_ATAC': 'None'}, inplace=True)
-        return gene_info.groupby('annotation_ATAC', sort=False)['normalized_counts'].median()
-    elif grouping == 'cluster':
-        return gene_info.groupby('cluster_ATAC', sort=False)['normalized_counts'].median()
-    elif grouping == 'dataset':
-        return gene_info.groupby('dataset', sort=False)['normalized_counts'].median()
-    elif grouping == 'target_region':
-        gene_info['target_region'].fillna('N/A', inplace=True)
-        return gene_info.groupby('target_region', sort=False)['normalized_counts'].median()
-    else:
+
+def pseudobulk_cluster_mch(gene_infos, methylation_type, grouping, clustering, level, ensemble):
+    """Returns the pseudo-bulk methylation level, sum(mc) / sum(c), of genes for each cluster.
+
+        Counts of all genes are gathered into cells x genes arrays and summed per group in one pass. Since sums are
+        additive, results can be merged across datasets or updated as cells are added.
+
+        Arguments:
+            gene_infos (list): DataFrames from get_gene_methylation, one per gene. None for genes without data.
+            methylation_type (str): "mCH", "mCG"...
+            grouping (str): Variable to group cells by. "cluster", "annotation", "dataset", "target_region", "slice" or "sex".
+            clustering (str): Different clustering algorithms and parameters.
+            level (str): "pseudobulk" or "pseudobulk_normalized". Normalized levels are divided by the level expected
+                from the global methylation of each cell, sum(c * global) / sum(c).
+            ensemble (str): Ensemble identifier.
+
+        Returns:
+            DataFrame: groups x genes (in the order of gene_infos) pseudo-bulk levels.
+    """
+
+    groups = get_cell_groups(ensemble, grouping, clustering)
+    if groups is None:
         return None
+    context = methylation_type[1:]
+    normalized = pseudobulk_levels.get(level) == 'normalized'
+
+    mc = np.zeros((len(groups.codes), len(gene_infos)))
+    c = np.zeros((len(groups.codes), len(gene_infos)))
+    expected_mc = np.zeros((len(groups.codes), len(gene_infos)))
+    for i, gene_info in enumerate(gene_infos):
+        if gene_info is None:
+            continue
+        rows = groups.positions(gene_info['cell_id'].values)
+        gene_mc = gene_info[methylation_type].values
+        gene_c = gene_info[context].values
+        global_level = gene_info['global_'+methylation_type].values
+        valid = (rows >= 0) & ~np.isnan(gene_mc) & ~np.isnan(gene_c)
+        if normalized:
+            valid &= ~np.isnan(global_level)
+        mc[rows[valid], i] = gene_mc[valid]
+        c[rows[valid], i] = gene_c[valid]
+        expected_mc[rows[valid], i] = gene_c[valid] * global_level[valid]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        levels = groups.sums(mc) / groups.sums(expected_mc if normalized else c)
+    return pd.DataFrame(levels, index=groups.groups)
+
+
+def median_cluster_snATAC(gene_info, grouping, ensemble):
+    """Returns median snATAC normalized counts of a gene for each cluster.
+
+        Arguments:
+            gene_info (DataFrame): snATAC data for each cell, from get_gene_snATAC.
+            grouping (str): Variable to group cells by. "cluster", "annotation", "dataset" or "target_region".
+            ensemble (str): Ensemble identifier.
+
+        Returns:
+            Series: median normalized counts of each group, indexed by group.
+    """
+
+    if gene_info is None:
+        return None
+    groups = get_cell_groups(ensemble, grouping, 'ATAC', bind='snATAC_data')
+    if groups is None:
+        return None
+    return groups.for_keys(gene_info['cell_id'].values).median(gene_info['normalized_counts'].values)
 
 @cache.memoize(timeout=3600)
 def snATAC_data_exists(snmC_ensemble_id):
@@ -576,7 +949,7 @@ def snATAC_data_exists(snmC_ensemble_id):
         Returns:
             0 if data does not exist, 1 if data does exist
     """
-    result = db.get_engine(current_app, 'snATAC_data').execute("SELECT * FROM ensembles WHERE snmc_ensemble_id = %s", (snmC_ensemble_id,)).fetchone()
+    result = run_query("SELECT * FROM ensembles WHERE snmc_ensemble_id = :ensemble_id", bind='snATAC_data', ensemble_id=snmC_ensemble_id).fetchone()
 
     if result is None:
         return 0
@@ -591,10 +964,10 @@ def get_ensemble_info(ensemble_name=str(), ensemble_id=str()):
     """
     
     if ensemble_name:
-        result = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles WHERE ensemble_name=%s", (ensemble_name,)).fetchone()
+        result = run_query("SELECT * FROM ensembles WHERE ensemble_name=:ensemble_name", ensemble_name=ensemble_name).fetchone()
     else:
-        ensemble_id = int(filter(str.isdigit, ensemble_id))
-        result = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles WHERE ensemble_id=%s", (ensemble_id,)).fetchone()
+        ensemble_id = int(''.join(filter(str.isdigit, ensemble_id)))
+        result = run_query("SELECT * FROM ensembles WHERE ensemble_id=:ensemble_id", ensemble_id=ensemble_id).fetchone()
 
     return result
 
@@ -608,38 +981,20 @@ def get_methylation_tsne_options(ensemble):
     if ";" in ensemble: # Prevent SQL injection since table names aren't parameterizable
         return None
 
-    query = "SELECT * FROM %(ensemble)s LIMIT 1" % {'ensemble': ensemble,}
-    
-    try:
-        df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
-    except exc.ProgrammingError as e:
+    schema = catalog.ensemble(ensemble)
+    if schema is None:
         now = datetime.datetime.now()
-        print("[{}] ERROR in app(get_methylation_tsne_options): {}".format(str(now), e))
+        print("[{}] ERROR in app(get_methylation_tsne_options): No table for {}".format(str(now), ensemble))
         sys.stdout.flush()
         return None
 
-    df_tsne = df.filter(regex='^tsne_x_', axis='columns')
-    df_cluster = df.filter(regex='^cluster_', axis='columns')
-
-    list_tsne_types = [x.split('tsne_x_')[1] for x in df_tsne.columns.values]
+    list_tsne_types = schema.tsne_types
     list_mc_types_tsne = sorted(list(set([x.split('_')[0] for x in list_tsne_types])), key=lambda mC_type: methylation_types_order.index(mC_type))
     list_dims_tsne_first = sorted(list(set([int(x.split('_')[1].replace('ndim','')) for x in list_tsne_types if list_mc_types_tsne[0] == x.split('_')[0]])))
     list_perp_tsne_first = sorted(list(set([int(x.split('_')[2].replace('perp', '')) for x in list_tsne_types if (list_mc_types_tsne[0]+'_ndim'+str(list_dims_tsne_first[0])) == (x.split('_')[0] +'_'+ x.split('_')[1])])))
 
-    list_clustering_types = [x.split('cluster_')[1] for x in df_cluster.columns.values]
-
-    #generate query for getting number clusters for each clustering type
-    num_clusters_query = "SELECT "
-    for i, clustering in enumerate(list_clustering_types):
-        num_clusters_query += "MAX(cluster_{0}) as {0}, ".format(clustering)
-    num_clusters_query = num_clusters_query[:-2] #Gets rid of last ", " which causes a MySQL syntax error
-    num_clusters_query += " FROM {}".format(ensemble)
-
-    result = db.get_engine(current_app, 'methylation_data').execute(num_clusters_query).fetchone()
-
-    dict_clustering_types_and_numclusters = OrderedDict()
-    for clustering_type, num_clusters in zip(list_clustering_types, result):
-        dict_clustering_types_and_numclusters[clustering_type] = num_clusters
+    list_clustering_types = schema.clustering_types
+    dict_clustering_types_and_numclusters = schema.num_clusters
 
     list_algorithms_clustering = list(set([x.split('_')[1] for x in list_clustering_types]))
 
@@ -670,37 +1025,19 @@ def get_snATAC_tsne_options(ensemble):
     if ";" in ensemble: # Prevent SQL injection since table names aren't parameterizable
         return None
 
-    query = "SELECT * FROM %(ensemble)s LIMIT 1" % {'ensemble': ensemble,}
-    
-    try:
-        df = pd.read_sql(query, db.get_engine(current_app, 'snATAC_data'))
-    except exc.ProgrammingError as e:
+    schema = catalog.ensemble(ensemble, bind='snATAC_data')
+    if schema is None:
         now = datetime.datetime.now()
-        print("[{}] ERROR in app(get_snATAC_tsne_options): {}".format(str(now), e))
+        print("[{}] ERROR in app(get_snATAC_tsne_options): No table for {}".format(str(now), ensemble))
         sys.stdout.flush()
         return None
 
-    df_tsne = df.filter(regex='^tsne_x_', axis='columns')
-    df_cluster = df.filter(regex='^cluster_', axis='columns')
-
-    list_tsne_types = [x.split('tsne_x_')[1] for x in df_tsne.columns.values]
+    list_tsne_types = schema.tsne_types
     list_dims_tsne_first = sorted(list(set([int(x.split('_')[1].replace('ndim','')) for x in list_tsne_types])))
     list_perp_tsne_first = sorted(list(set([int(x.split('_')[2].replace('perp', '')) for x in list_tsne_types])))
 
-    list_clustering_types = [x.split('cluster_')[1] for x in df_cluster.columns.values]
-
-    #generate query for getting number clusters for each clustering type
-    num_clusters_query = "SELECT "
-    for i, clustering in enumerate(list_clustering_types):
-        num_clusters_query += "MAX(cluster_{0}) as {0}, ".format(clustering)
-    num_clusters_query = num_clusters_query[:-2] #Gets rid of last ", " which causes a MySQL syntax error
-    num_clusters_query += " FROM {}".format(ensemble)
-
-    result = db.get_engine(current_app, 'snATAC_data').execute(num_clusters_query).fetchone()
-
-    dict_clustering_types_and_numclusters = OrderedDict()
-    for clustering_type, num_clusters in zip(list_clustering_types, result):
-        dict_clustering_types_and_numclusters[clustering_type] = num_clusters
+    list_clustering_types = schema.clustering_types
+    dict_clustering_types_and_numclusters = schema.num_clusters
 
     list_algorithms_clustering = sorted(list(set([x.split('_')[1] for x in list_clustering_types])))
     list_npc_clustering = sorted(list(set([int(x.split('_')[2].replace('npc', '')) for x in list_clustering_types])))
@@ -730,10 +1067,10 @@ def get_gene_by_name(gene_query):
 
     gene_query = [ gene.lower()+"%" for gene in gene_query ]
 
-    sql_query = "SELECT * FROM genes WHERE " + "lower(gene_name) LIKE %s OR " * len(gene_query)
-    sql_query = sql_query[:-3]
+    placeholders, params = bind_list('gene', gene_query)
+    sql_query = "SELECT * FROM genes WHERE " + " OR ".join("lower(gene_name) LIKE " + p for p in placeholders)
 
-    df = pd.read_sql(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
+    df = read_query(sql_query, **params)
 
     return df.to_dict('records')
 
@@ -750,16 +1087,15 @@ def get_gene_by_name_exact(gene_query):
     """
 
     gene_query = [ gene.lower() for gene in gene_query ]
-    placeholders_str = "%s, " * len(gene_query)
-    placeholders_str = placeholders_str[:-2]
-    sql_query = "SELECT * FROM genes WHERE " + "lower(gene_name) IN (" + placeholders_str+ ")"
+    placeholders, params = bind_list('gene', gene_query)
+    sql_query = "SELECT * FROM genes WHERE " + "lower(gene_name) IN (" + ", ".join(placeholders) + ")"
     sql_query += " ORDER BY CASE lower(gene_name) "
 
-    for i, gene in enumerate(gene_query):
-        sql_query += "WHEN '{}' THEN {} ".format(gene, i+1)
+    for i, placeholder in enumerate(placeholders):
+        sql_query += "WHEN {} THEN {} ".format(placeholder, i+1)
     sql_query += "END"
 
-    df = pd.read_sql(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
+    df = read_query(sql_query, **params)
 
     return df.to_dict('records')
     
@@ -776,10 +1112,10 @@ def get_gene_by_id(gene_query):
     """
 
     gene_query_wildcard = [ gene+'%' for gene in gene_query ] 
-    sql_query = "SELECT * FROM genes WHERE " + "gene_id LIKE %s OR " * len(gene_query_wildcard)
-    sql_query = sql_query[:-3]
+    placeholders, params = bind_list('gene', gene_query_wildcard)
+    sql_query = "SELECT * FROM genes WHERE " + " OR ".join("gene_id LIKE " + p for p in placeholders)
 
-    df = pd.read_sql(sql_query, params=(gene_query_wildcard,), con=db.get_engine(current_app, 'methylation_data'))
+    df = read_query(sql_query, **params)
 
     #reorder genes to original order since SQL doesn't keep order.
     new_index = []
@@ -795,36 +1131,309 @@ def get_gene_by_id(gene_query):
 
 
 @cache.memoize(timeout=3600)
-def get_corr_genes(ensemble, query):
+def get_corr_genes(ensemble, query, limit=100, page=1):
     """Get correlated genes of a certain gene of a ensemble. 
     
         Arguments:
             ensemble(str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
             query(str): Gene ID.
+            limit(int): Number of genes per page.
+            page(int): Page number, starting from 1.
         
         Returns:
             dict: information of genes that are correlated with target gene.
+            None if the query failed, so that the failure is not cached.
     """
     if ";" in query:
         return []
 
+    offset = (page - 1) * limit
+    if not catalog.has_table('{}_correlated_genes'.format(ensemble)):
+        corr_genes = search_corr_genes(ensemble, [query], offset + limit)
+        return corr_genes[offset:] if corr_genes is not None else None
+
+    corr_table = '{}_correlated_genes'.format(ensemble)
+    sql_query = "SELECT {0}.gene2, {0}.correlation, genes.gene_name \
+        FROM {0} \
+        LEFT JOIN genes ON {0}.gene2 = genes.gene_id \
+        WHERE {0}.gene1 LIKE :gene \
+        ORDER BY {0}.correlation DESC \
+        LIMIT :limit OFFSET :offset".format(corr_table)
+
     try:
-        corr_genes = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM {}_correlated_genes WHERE gene1 LIKE %s".format(ensemble), (query+'%%',)).fetchall()
-    except exc.ProgrammingError as e:
+        corr_genes = run_query(sql_query, gene=query+'%', limit=limit, offset=offset).fetchall()
+    except query_errors as e:
         now = datetime.datetime.now()
         print("[{}] ERROR in app(get_corr_genes): {}".format(str(now), e))
         sys.stdout.flush()
-        return []
+        return None
 
-    corr_genes = [ {"rank": i+1, "gene_name": get_gene_by_id(row.gene2)[0]['gene_name'], "correlation": row.correlation, "gene_id": row.gene2} for i, row in enumerate(corr_genes)]
+    corr_genes = [ {"rank": offset+i+1, "gene_name": row.gene_name or row.gene2, "correlation": row.correlation, "gene_id": row.gene2} for i, row in enumerate(corr_genes)]
     return corr_genes
 
 
+@singleflight.memoize(timeout=3600)
+def search_corr_genes(ensemble, gene_ids, k=100):
+    """Compute the genes most correlated with a gene, or with the average profile of a gene module, on the fly.
+
+        Arguments:
+            ensemble(str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+            gene_ids(list): Gene IDs. The average profile is used when there are several.
+            k(int): Number of genes to return.
+
+        Returns:
+            list: information of genes that are correlated with the target gene(s), same format as get_corr_genes.
+            None if the normalized matrix could not be read.
+    """
+    gene_ids = tuple(gene_ids)
+    try:
+        corr_genes = search_correlated_genes(ensemble, gene_ids, k)
+    except (IOError, ValueError, KeyError) as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(search_corr_genes): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+    if not corr_genes:
+        return []
+
+    placeholders, params = bind_list('gene', [gene_id for gene_id, _ in corr_genes])
+    names = run_query("SELECT gene_id, gene_name FROM genes WHERE gene_id IN ({})".format(", ".join(placeholders)), **params).fetchall()
+    names = {row.gene_id: row.gene_name for row in names}
+
+    return [ {"rank": i+1, "gene_name": names.get(gene_id, gene_id), "correlation": correlation, "gene_id": gene_id} for i, (gene_id, correlation) in enumerate(corr_genes)]
+
+
+@frozen
+@singleflight.memoize(timeout=3600)
+def get_ensemble_cell_data(ensemble, methylation_type, clustering, tsne_type='mCH_ndim2_perp20'):
+    """Return the cells of an ensemble with the data gene plots show besides the gene itself.
+
+    The frame is cached once per ensemble and shared by all genes, with compact column types (see frames).
+
+    Arguments:
+        ensemble (str): Name of ensemble.
+        methylation_type (str): Type of methylation of the global methylation column. "mCH", "mCG", or "mCA"
+        clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
+        tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
+
+    Returns:
+        DataFrame: cell_id, cell_name, dataset, global methylation, annotation, cluster, tSNE coordinates,
+            target_region and sex of each cell. None if the query fails.
+    """
+
+    # Prevent SQL injected since column names cannot be parameterized.
+    if ";" in ensemble or ";" in methylation_type or ";" in clustering or ";" in tsne_type:
+        return None
+
+    tsne_columns = ["%(ensemble)s.tsne_x_%(tsne_type)s", "%(ensemble)s.tsne_y_%(tsne_type)s"]
+    if 'ndim2' not in tsne_type:
+        tsne_columns.append("%(ensemble)s.tsne_z_%(tsne_type)s")
+
+    query = ("SELECT cells.cell_id, cells.cell_name, cells.dataset, cells.global_%(methylation_type)s, \
+        %(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, " + ", ".join(tsne_columns) + ", \
+        datasets.target_region, datasets.sex \
+        FROM cells \
+        INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
+        LEFT JOIN datasets ON cells.dataset = datasets.dataset \
+        ORDER BY cells.cell_id") % {'ensemble': ensemble,
+                                    'tsne_type': tsne_type,
+                                    'methylation_type': methylation_type,
+                                    'clustering': clustering,}
+    try:
+        df = read_query(query)
+    except query_errors as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_ensemble_cell_data): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+    compact = compact_frame(df)
+    report_memory('get_ensemble_cell_data({}, {}, {}, {})'.format(ensemble, methylation_type, clustering, tsne_type),
+                  df, compact)
+    return compact
+
+
+@frozen
 @cache.memoize(timeout=3600)
+def get_ensemble_cell_ids(ensemble):
+    """Return the sorted cell_ids of an ensemble.
+
+    This is the canonical cell order of an ensemble: get_gene_counts caches gene counts in this order, so joining them
+    onto cells is an index gather.
+
+    Arguments:
+        ensemble (str): Name of ensemble.
+
+    Returns:
+        numpy.ndarray: int64 cell_ids of the cells of the ensemble. None if the query fails.
+    """
+    if ";" in ensemble:
+        return None
+
+    query = "SELECT cells.cell_id FROM cells \
+        INNER JOIN {0} ON cells.cell_id = {0}.cell_id \
+        ORDER BY cells.cell_id".format(ensemble)
+    try:
+        return read_query(query)['cell_id'].values.astype(np.int64)
+    except query_errors as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_ensemble_cell_ids): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+
+def align_gene_counts(cell_ids, df, methylation_type, name):
+    """Place the counts of a gene, read in any order, in the canonical cell order of an ensemble.
+
+    Arguments:
+        cell_ids (numpy.ndarray): Canonical cell order, from get_ensemble_cell_ids.
+        df (DataFrame): cell_id, methylated and total counts of the gene.
+        methylation_type (str): Type of methylation. "mCH", "mCG", or "mCA"
+        name (str): Name of the cache entry, for report_memory.
+
+    Returns:
+        DataFrame: float32 methylated and total counts, one row per cell, NaN for cells without data.
+    """
+    rows = sorted_positions(cell_ids, df['cell_id'].values)
+    found = rows >= 0
+    counts = pd.DataFrame(index=np.arange(len(cell_ids)))
+    for column in (methylation_type, methylation_type[1:]):
+        values = np.full(len(cell_ids), np.nan, dtype=np.float32)
+        values[rows[found]] = df[column].values[found]
+        counts[column] = values
+
+    report_memory(name, df, counts)
+    return counts
+
+
+def read_gene_counts(ensemble, methylation_type, gene_table_names):
+    """Read the methylated and total counts of genes in the cells of an ensemble.
+
+    Genes migrated to the long-format gene_data table (scripts/migrate_gene_tables.py) are all read with one query,
+    a range scan of its (gene_idx, cell_id) primary key per gene. Other genes are read from their own table, in
+    cell_id order and without joining it to the ensemble. Counts are placed in the canonical cell order of the
+    ensemble (get_ensemble_cell_ids) with np.searchsorted.
+
+    Arguments:
+        ensemble (str): Name of ensemble.
+        methylation_type (str): Type of methylation. "mCH", "mCG", or "mCA"
+        gene_table_names (list): Names of the gene tables, from catalog.gene_table.
+
+    Returns:
+        list: DataFrames of float32 methylated counts (ie. mCH) and total counts (ie. CH), one per gene table, with
+            one row per cell of the ensemble in get_ensemble_cell_ids order, NaN for cells without data.
+            None if a query fails.
+    """
+
+    # Prevent SQL injected since column names cannot be parameterized.
+    if ";" in ensemble or ";" in methylation_type or any(";" in table for table in gene_table_names):
+        return None
+
+    cell_ids = get_ensemble_cell_ids(ensemble)
+    if cell_ids is None:
+        return None
+
+    context = methylation_type[1:]
+    gene_indexes = {table: catalog.gene_index(table) for table in gene_table_names}
+    migrated = sorted(set(gene_idx for gene_idx in gene_indexes.values() if gene_idx is not None))
+    migrated_counts, table_counts = {}, {}
+    try:
+        if migrated:
+            params, values = bind_list('gene_idx', migrated)
+            query = "SELECT gene_idx, cell_id, %(methylation_type)s, %(context)s FROM gene_data \
+                WHERE gene_idx IN (%(params)s) \
+                ORDER BY gene_idx, cell_id" % {'methylation_type': methylation_type,
+                                               'context': context,
+                                               'params': ', '.join(params),}
+            df = read_query(query, **values)
+            gene_idx_values = df['gene_idx'].values
+            starts = np.searchsorted(gene_idx_values, migrated, side='left')
+            ends = np.searchsorted(gene_idx_values, migrated, side='right')
+            for gene_idx, start, end in zip(migrated, starts, ends):
+                migrated_counts[gene_idx] = df.iloc[start:end]
+
+        for table in gene_table_names:
+            if gene_indexes[table] is None and table not in table_counts:
+                query = "SELECT cell_id, %(methylation_type)s, %(context)s FROM %(gene_table_name)s \
+                    ORDER BY cell_id" % {'gene_table_name': table,
+                                         'methylation_type': methylation_type,
+                                         'context': context,}
+                table_counts[table] = read_query(query)
+    except query_errors as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(read_gene_counts): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+    counts_all = []
+    for table in gene_table_names:
+        df = migrated_counts[gene_indexes[table]] if gene_indexes[table] is not None else table_counts[table]
+        name = 'gene counts({}, {}, {})'.format(ensemble, methylation_type, table)
+        counts_all.append(align_gene_counts(cell_ids, df, methylation_type, name))
+    return counts_all
+
+
+@frozen
+@singleflight.memoize(timeout=3600)
+def get_gene_counts(ensemble, methylation_type, gene_table_name):
+    """Return the methylated and total counts of a gene in the cells of an ensemble, see read_gene_counts.
+
+    Arguments:
+        ensemble (str): Name of ensemble.
+        methylation_type (str): Type of methylation. "mCH", "mCG", or "mCA"
+        gene_table_name (str): Name of the gene table, from catalog.gene_table.
+
+    Returns:
+        DataFrame: float32 methylated counts (ie. mCH) and total counts (ie. CH), one row per cell of the ensemble
+            in get_ensemble_cell_ids order, NaN for cells without data. None if the query fails.
+    """
+    counts = read_gene_counts(ensemble, methylation_type, [gene_table_name])
+    if counts is None:
+        return None
+    return counts[0]
+
+
+def merge_gene_counts(cells, counts, methylation_type, cell_ids):
+    """Join gene counts onto the cells of an ensemble, in the column order of the gene plots.
+
+    Counts are gathered by position, without a SQL join or a pandas merge.
+
+    Arguments:
+        cells (DataFrame): From get_ensemble_cell_data.
+        counts (DataFrame): Methylated and total counts in the canonical cell order, ie. from get_gene_counts.
+        methylation_type (str): Type of methylation. "mCH", "mCG", or "mCA"
+        cell_ids (numpy.ndarray): Canonical cell order, from get_ensemble_cell_ids.
+
+    Returns:
+        DataFrame: cells columns with the counts (float64, NaN for cells without data) before target_region. tSNE
+            coordinates are float64.
+    """
+    context = methylation_type[1:]
+    cell_id = cells['cell_id'].values
+    if len(cell_id) == len(cell_ids) and np.array_equal(cell_id, cell_ids):
+        # Cells are in the canonical order already (both are read ORDER BY cell_id), counts line up as they are.
+        rows = np.arange(len(cell_ids))
+    else:
+        rows = sorted_positions(cell_ids, cell_id)
+    found = rows >= 0
+
+    # A new frame rather than a copy of cells: cells is frozen and shared.
+    data = OrderedDict()
+    for column in cells.columns:
+        if column not in ('target_region', 'sex'):
+            data[column] = widen_float32(cells[column].values) if column.startswith('tsne_') else cells[column].values
+    for column in (methylation_type, context):
+        data[column] = np.where(found, counts[column].values[rows], np.nan)
+    data['target_region'] = cells['target_region'].values
+    data['sex'] = cells['sex'].values
+    return pd.DataFrame(data, columns=list(data))
+
+
 def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, level, outliers, tsne_type='mCH_ndim2_perp20'):
     """Return mCH data points for a given gene.
 
-    Data from ID-to-Name mapping and tSNE points are combined for plot generation.
+    Data from ID-to-Name mapping and tSNE points are combined for plot generation. Cell data and gene counts are
+    cached separately, so the cell data is held once for all genes of an ensemble.
 
     Arguments:
         ensemble (str): Name of ensemble.
@@ -844,56 +1453,27 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
     if ";" in ensemble or ";" in methylation_type or ";" in grouping or ";" in clustering or ";" in tsne_type:
         return None
 
-    # This query is just to fix gene id's missing the ensemble version number. 
-    # Necessary because the table name must match exactly with whats on the MySQL database.
-    # Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
-    result = db.get_engine(current_app, 'methylation_data').execute("SELECT gene_id FROM genes WHERE gene_id LIKE %s", (gene+"%",)).fetchone()
-    gene_table_name = 'gene_' + result.gene_id.replace('.','_')
+    # Table names include the Ensembl version number, the catalog maps gene ids with or without it to the table.
+    # Ex. ENSMUSG00000026787 -> gene_ENSMUSG00000026787_3
+    gene_table_name = catalog.gene_table(gene)
+    if gene_table_name is None:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_gene_methylation): No table for {}".format(str(now), gene))
+        sys.stdout.flush()
+        return None
 
     context = methylation_type[1:]
 
-    if 'ndim2' in tsne_type:
-        query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, cells.global_%(methylation_type)s, \
-            %(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
-            %(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, \
-            %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
-            datasets.target_region, datasets.sex \
-            FROM cells \
-            INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-            LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-            LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble,
-                                                                       'gene_table_name': gene_table_name,
-                                                                       'tsne_type': tsne_type,
-                                                                       'methylation_type': methylation_type,
-                                                                       'context': context,
-                                                                       'clustering': clustering,}
-    else:
-        query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, cells.global_%(methylation_type)s, \
-            %(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
-            %(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, %(ensemble)s.tsne_z_%(tsne_type)s, \
-            %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
-            datasets.target_region, datasets.sex \
-            FROM cells \
-            INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-            LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-            LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble, 
-                                                                       'gene_table_name': gene_table_name,
-                                                                       'tsne_type': tsne_type,
-                                                                       'methylation_type': methylation_type,
-                                                                       'context': context,
-                                                                       'clustering': clustering,}
-    try:
-        df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
-    except exc.ProgrammingError as e:
-        now = datetime.datetime.now()
-        print("[{}] ERROR in app(get_gene_methylation): {}".format(str(now), e))
-        sys.stdout.flush()
+    cells = get_ensemble_cell_data(ensemble, methylation_type, clustering, tsne_type)
+    counts = get_gene_counts(ensemble, methylation_type, gene_table_name)
+    if cells is None or counts is None:
         return None
+    df = merge_gene_counts(cells, counts, methylation_type, get_ensemble_cell_ids(ensemble))
     
     if df[context].isnull().all(): # If no data in column, return None 
         return None
 
-    if level == 'original':
+    if pseudobulk_levels.get(level, level) == 'original':
         df[methylation_type + '/' + context + '_' + level] = df[methylation_type] / df[context]
     else:
         df[methylation_type + '/' + context + '_' + level] = (df[methylation_type] / df[context]) / df['global_'+methylation_type]
@@ -905,7 +1485,7 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
 
     
     if grouping == 'annotation':
-        df.fillna({'annotation_'+clustering: 'None'}, inplace=True)
+        df['annotation_'+clustering] = df['annotation_'+clustering].astype(object).fillna('None')
         df['annotation_cat'] = pd.Categorical(df['annotation_'+clustering], cluster_annotation_order)
         df.sort_values(by='annotation_cat', inplace=True)
         df.drop('annotation_cat', axis=1, inplace=True)
@@ -938,78 +1518,39 @@ def get_mult_gene_methylation(ensemble, methylation_type, genes, grouping, clust
         return None
 
     context = methylation_type[1:]
-    genes = [gene+"%" for gene in genes]
-
-    # This query is just to fix gene id's missing the Ensembl version number. 
-    # Necessary because the table name must match exactly with whats on the MySQL database.
-    # Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3
-    first_query = "SELECT gene_id FROM genes WHERE gene_id LIKE %s" + " OR gene_id LIKE %s" * (len(genes)-1)
-    result = db.get_engine(current_app, 'methylation_data').execute(first_query, (genes,)).fetchall()
-
-    gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
-
-    df_all = pd.DataFrame()
-    
-    first = True
-    for gene_table_name in gene_table_names:
-        if 'ndim2' in tsne_type:
-            query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, cells.global_%(methylation_type)s, \
-                %(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
-                %(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, \
-                %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
-                datasets.target_region, datasets.sex \
-                FROM cells \
-                INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-                LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-                LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble, 
-                                                                           'gene_table_name': gene_table_name,
-                                                                           'tsne_type': tsne_type,
-                                                                           'methylation_type': methylation_type,
-                                                                           'context': context,
-                                                                           'clustering': clustering,}
-        else:
-            query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, cells.global_%(methylation_type)s, \
-                %(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
-                %(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, %(ensemble)s.tsne_z_%(tsne_type)s, \
-                %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
-                datasets.target_region, datasets.sex \
-                FROM cells \
-                INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-                LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-                LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble, 
-                                                                           'gene_table_name': gene_table_name,
-                                                                           'tsne_type': tsne_type,
-                                                                           'methylation_type': methylation_type,
-                                                                           'context': context,
-                                                                           'clustering': clustering,}
-        try:
-            df_all = df_all.append(pd.read_sql(query, db.get_engine(current_app, 'methylation_data')))
-        except exc.ProgrammingError as e:
-            now = datetime.datetime.now()
-            print("[{}] ERROR in app(get_mult_gene_methylation): {}".format(str(now), e))
-            sys.stdout.flush()
-            return None
-        
-        if first:
-            df_coords = df_all
-        first = False
 
+    # Table names include the Ensembl version number, the catalog maps gene ids with or without it to the table.
+    gene_table_names = [catalog.gene_table(gene) for gene in genes]
+    gene_table_names = [table for table in gene_table_names if table is not None]
+    if not gene_table_names:
+        return None
 
-    df_all[[methylation_type, context]] = df_all[[methylation_type, context]].apply(pd.to_numeric)
+    cells = get_ensemble_cell_data(ensemble, methylation_type, clustering, tsne_type)
+    if cells is None:
+        return None
+    # One query for all migrated genes.
+    counts_all = read_gene_counts(ensemble, methylation_type, gene_table_names)
+    if counts_all is None:
+        return None
 
-    df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)[[methylation_type, context]].mean()
-    df_coords.update(df_avg_methylation)
+    # Counts of all genes are in the same cell order, so the average over genes with data is taken column-wise.
+    df_avg_methylation = pd.DataFrame()
+    for column in (methylation_type, context):
+        values = np.vstack([counts[column].values for counts in counts_all]).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df_avg_methylation[column] = np.nansum(values, axis=0) / (~np.isnan(values)).sum(axis=0)
+    df_coords = merge_gene_counts(cells, df_avg_methylation, methylation_type, get_ensemble_cell_ids(ensemble))
 
     if df_coords[context].isnull().all(): # If no data in column, return None 
         return None
     else:
-        if level == 'original':
+        if pseudobulk_levels.get(level, level) == 'original':
             df_coords[methylation_type + '/' + context + '_' + level] = df_coords[methylation_type] / df_coords[context]
         else:
             df_coords[methylation_type + '/' + context + '_' + level] = (df_coords[methylation_type] / df_coords[context]) / df_coords['global_'+methylation_type]
 
     if grouping == 'annotation':
-        df_coords.fillna({'annotation_'+clustering: 'None'}, inplace=True)
+        df_coords['annotation_'+clustering] = df_coords['annotation_'+clustering].astype(object).fillna('None')
         df_coords['annotation_cat'] = pd.Categorical(df_coords['annotation_'+clustering], cluster_annotation_order)
         df_coords.sort_values(by='annotation_cat', inplace=True)
         df_coords.drop('annotation_cat', axis=1, inplace=True)
@@ -1019,7 +1560,8 @@ def get_mult_gene_methylation(ensemble, methylation_type, genes, grouping, clust
     return df_coords
 
 
-@cache.memoize(timeout=3600)
+@frozen
+@singleflight.memoize(timeout=3600)
 def get_gene_snATAC(ensemble, gene, grouping, outliers):
     """Return snATAC data points for a given gene.
 
@@ -1041,11 +1583,14 @@ def get_gene_snATAC(ensemble, gene, grouping, outliers):
     if ";" in ensemble or ";" in grouping:
         return None
 
-    # This query is just to fix gene id's missing the ensemble version number. 
-    # Necessary because the table name must match exactly with whats on the MySQL database.
-    # Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3 -> gene_ENSMUSG00000026787_3 (table name in MySQL)
-    result = db.get_engine(current_app, 'snATAC_data').execute("SELECT gene_id FROM genes WHERE gene_id LIKE %s", (gene+"%",)).fetchone()
-    gene_table_name = 'gene_' + result['gene_id'].replace('.','_')
+    # Table names include the Ensembl version number, the catalog maps gene ids with or without it to the table.
+    # Ex. ENSMUSG00000026787 -> gene_ENSMUSG00000026787_3
+    gene_table_name = catalog.gene_table(gene, bind='snATAC_data')
+    if gene_table_name is None:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_gene_snATAC): No table for {}".format(str(now), gene))
+        sys.stdout.flush()
+        return None
     
     query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
         %(ensemble)s.annotation_ATAC, %(ensemble)s.cluster_ATAC, \
@@ -1059,8 +1604,8 @@ def get_gene_snATAC(ensemble, gene, grouping, outliers):
                                                                    'gene_table_name': gene_table_name,}
 
     try:
-        df = pd.read_sql(query, db.get_engine(current_app, 'snATAC_data'))
-    except exc.ProgrammingError as e:
+        df = read_query(query, bind='snATAC_data')
+    except query_errors as e:
         now = datetime.datetime.now()
         print("[{}] ERROR in app(get_gene_snATAC): {}".format(str(now), e))
         sys.stdout.flush()
@@ -1080,11 +1625,12 @@ def get_gene_snATAC(ensemble, gene, grouping, outliers):
     elif grouping == 'cluster':
         df.sort_values(by='cluster_ATAC', inplace=True)
 
-    df['normalized_counts'].fillna(0, inplace=True)
+    df['normalized_counts'] = df['normalized_counts'].fillna(0)
     
     return df
 
-@cache.memoize(timeout=1800)
+@frozen
+@singleflight.memoize(timeout=1800)
 def get_mult_gene_snATAC(ensemble, genes, grouping):
     """Return averaged methylation data ponts for a set of genes.
 
@@ -1105,15 +1651,11 @@ def get_mult_gene_snATAC(ensemble, genes, grouping):
     if ";" in ensemble or ";" in grouping:
         return None
 
-    genes = [gene+"%" for gene in genes]
-
-    # This query is just to fix gene id's missing the ensemble version number. 
-    # Necessary because the table name must match exactly with whats on the MySQL database.
-    # Ex. ENSMUSG00000026787 is fixed to ENSMUSG00000026787.3
-    first_query = "SELECT gene_id FROM genes WHERE gene_id LIKE %s" + " OR gene_id LIKE %s" * (len(genes)-1)
-    result = db.get_engine(current_app, 'methylation_data').execute(first_query, (genes,)).fetchall()
-
-    gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
+    # Table names include the Ensembl version number, the catalog maps gene ids with or without it to the table.
+    gene_table_names = [catalog.gene_table(gene, bind='snATAC_data') for gene in genes]
+    gene_table_names = [table for table in gene_table_names if table is not None]
+    if not gene_table_names:
+        return None
 
     df_all = pd.DataFrame()
     
@@ -1130,8 +1672,8 @@ def get_mult_gene_snATAC(ensemble, genes, grouping):
             LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble, 
                                                                        'gene_table_name': gene_table_name,}
         try:
-            df_all = df_all.append(pd.read_sql(query, db.get_engine(current_app, 'snATAC_data')))
-        except exc.ProgrammingError as e:
+            df_all = df_all.append(read_query(query, bind='snATAC_data'))
+        except query_errors as e:
             now = datetime.datetime.now()
             print("[{}] ERROR in app(get_mult_gene_snATAC): {}".format(str(now), e))
             sys.stdout.flush()
@@ -1147,7 +1689,7 @@ def get_mult_gene_snATAC(ensemble, genes, grouping):
         sys.stdout.flush()
         return None
 
-    df_all['normalized_counts'].fillna(0, inplace=True)
+    df_all['normalized_counts'] = df_all['normalized_counts'].fillna(0)
 
     df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)['normalized_counts'].mean()
     df_coords.update(df_avg_methylation)
@@ -1162,7 +1704,7 @@ def get_mult_gene_snATAC(ensemble, genes, grouping):
     return df_coords
 
 
-@cache.memoize(timeout=1800)
+@singleflight.memoize(timeout=1800)
 def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool):
     """Generate scatter plot and gene body mCH scatter plot using tSNE coordinates from methylation(snmC-seq) data.
 
@@ -1214,12 +1756,13 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
 
     datasets = points['dataset'].unique().tolist()
     annotation_additional_y = 0.00 
+    group_labels = points[grouping if grouping in ('dataset', 'target_region') else grouping+'_ATAC']
     if grouping == 'dataset':
         unique_groups = datasets
         num_clusters = len(unique_groups)
     elif grouping == 'target_region':
-        points['target_region'].fillna('N/A', inplace=True)
-        unique_groups = points['target_region'].unique().tolist()
+        group_labels = points['target_region'].fillna('N/A')
+        unique_groups = group_labels.unique().tolist()
         num_clusters = len(unique_groups)
     else:
         if grouping == 'cluster':
@@ -1267,7 +1810,7 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
 
     ## 2D tSNE coordinates ##
     for i, group in enumerate(unique_groups):
-        points_group = points[points[grouping_clustering]==group]
+        points_group = points[group_labels==group]
         if grouping_clustering.startswith('cluster'):
             group_str = 'cluster_' + str(group)
         elif grouping_clustering== "dataset":
@@ -1278,7 +1821,7 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
 
         color_num = i
         
-        trace2d = traces_tsne.setdefault(color_num, Scattergl(
+        trace2d = traces_tsne.setdefault(color_num, go.Scattergl(
             x=list(),
             y=list(),
             text=list(),
@@ -1317,16 +1860,16 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
     end = ATAC_dataframe.dropna().quantile(ptile_end).values[0].tolist()
     ATAC_colors = [set_color_by_percentile(x, start, end) for x in ATAC_counts]
 
-    colorbar_tickval = list(arange(start, end, (end - start) / 4))
+    colorbar_tickval = list(np.arange(start, end, (end - start) / 4))
     colorbar_tickval[0] = start
     colorbar_tickval.append(end)
     colorbar_ticktext = [
-        str(round(x, 3)) for x in arange(start, end, (end - start) / 4)
+        str(round(x, 3)) for x in np.arange(start, end, (end - start) / 4)
     ]
     colorbar_ticktext[0] = '<' + str(round(start, 3))
     colorbar_ticktext.append('>' + str(round(end, 3)))
 
-    trace_ATAC = Scattergl(
+    trace_ATAC = go.Scattergl(
         mode='markers',
         x=x,
         y=y,
@@ -1352,7 +1895,7 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
         xaxis='x2',
         hoverinfo='text')
 
-    layout = Layout(
+    layout = go.Layout(
         autosize=True,
         height=550,
         width=layout_width,
@@ -1431,7 +1974,7 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
     fig.append_trace(trace_ATAC, 1,2)
 
     fig['layout'].update(layout)
-    fig['layout']['annotations'].extend([Annotation(text=grouping.title(),
+    fig['layout']['annotations'].extend([go.Annotation(text=grouping.title(),
                                                     x=legend_x+0.05,
                                                     y=1.02 + annotation_additional_y,
                                                     xanchor="left",
@@ -1441,7 +1984,7 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
                                                     yref="paper",
                                                     font={'size': 12,
                                                           'color': 'gray',})])
-    fig['layout']['annotations'].extend([Annotation(text=title,
+    fig['layout']['annotations'].extend([go.Annotation(text=title,
                                                     x=0.5,
                                                     y=1.3,
                                                     xanchor="center",
@@ -1459,7 +2002,7 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
         include_plotlyjs=False)
 
 
-@cache.memoize(timeout=1800)
+@singleflight.memoize(timeout=1800)
 def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query, level, grouping, clustering, ptile_start, ptile_end, tsne_outlier_bool):
     """Generate scatter plot and gene body reads scatter plot using tSNE coordinates from snATAC-seq data.
 
@@ -1509,30 +2052,22 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
             clustering = "mCH_lv_npc50_k30"
             print("**** Using cluster_mCH_lv_npc50_k30")
 
-    datasets = points['dataset'].unique().tolist()
     annotation_additional_y = 0.00 
-    if grouping == 'dataset':
-        unique_groups = datasets
-        num_clusters = len(unique_groups)
-    elif grouping == 'target_region':
-        points['target_region'].fillna('N/A', inplace=True)
-        unique_groups = points['target_region'].unique().tolist()
-        num_clusters = len(unique_groups)
-    elif grouping == 'slice':
-        datasets_all_cells = points['dataset'].tolist()
-        slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
-        points['slice'] = slices_list
-        slices_set = set(slices_list)
-        unique_groups = list(slices_set)
-        num_clusters = len(unique_groups)
-    elif grouping == 'sex':
-        unique_groups = points['sex'].unique().tolist()
+    if grouping in ('dataset', 'target_region', 'slice', 'sex'):
+        # Groups come from the categorical columns of the ensemble, so slices are not derived per cell.
+        groups = get_cell_groups(ensemble, grouping, clustering)
+        if groups is None:
+            raise FailToGraphException
+        groups = groups.for_keys(points['cell_id'].values)
+        group_labels = pd.Series(groups.categorical(), index=points.index)
+        unique_groups = groups.groups.tolist()
         num_clusters = len(unique_groups)
     elif grouping == 'cluster' or grouping == 'annotation':
         if grouping == 'cluster':
             annotation_additional_y = 0.025 # Necessary because legend items overlap with legend title (annotation) when there are many legend items
         num_clusters = points['cluster_'+clustering].max()
         unique_groups = points[grouping+'_'+clustering].unique().tolist()
+        group_labels = points[grouping+'_'+clustering]
     else:
         raise FailToGraphException
     
@@ -1577,7 +2112,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
     ## 2D tSNE coordinates ##
     if 'ndim2' in tsne_type:
         for i, group in enumerate(unique_groups):
-            points_group = points[points[grouping_clustering]==group]
+            points_group = points[group_labels==group]
             if grouping_clustering.startswith('cluster'):
                 group_str = 'cluster_' + str(group)
             elif grouping_clustering== "dataset":
@@ -1588,7 +2123,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 
             color_num = i
             
-            trace2d = traces_tsne.setdefault(color_num, Scatter(
+            trace2d = traces_tsne.setdefault(color_num, go.Scatter(
                 x=list(),
                 y=list(),
                 text=list(),
@@ -1627,16 +2162,16 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
         end = mch_dataframe.dropna().quantile(ptile_end).values[0].tolist()
         mch_colors = [set_color_by_percentile(x, start, end) for x in mch]
 
-        colorbar_tickval = list(arange(start, end, (end - start) / 4))
+        colorbar_tickval = list(np.arange(start, end, (end - start) / 4))
         colorbar_tickval[0] = start
         colorbar_tickval.append(end)
         colorbar_ticktext = [
-            str(round(x, 3)) for x in arange(start, end, (end - start) / 4)
+            str(round(x, 3)) for x in np.arange(start, end, (end - start) / 4)
         ]
         colorbar_ticktext[0] = '<' + str(round(start, 3))
         colorbar_ticktext.append('>' + str(round(end, 3)))
 
-        trace_methylation = Scatter(
+        trace_methylation = go.Scatter(
             mode='markers',
             x=x,
             y=y,
@@ -1662,7 +2197,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
             xaxis='x2',
             hoverinfo='text')
 
-        layout = Layout(
+        layout = go.Layout(
             autosize=True,
             height=550,
             width=layout_width,
@@ -1742,7 +2277,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
         fig.append_trace(trace_methylation, 1,2)
 
         fig['layout'].update(layout)
-        fig['layout']['annotations'].extend([Annotation(text=grouping.title(),
+        fig['layout']['annotations'].extend([go.Annotation(text=grouping.title(),
                                                         x=legend_x+0.05,
                                                         y=1.02 + annotation_additional_y,
                                                         xanchor="left",
@@ -1753,7 +2288,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
                                                         font={'size': 12,
                                                               'color': 'gray',})])
 
-        fig['layout']['annotations'].extend([Annotation(text=title,
+        fig['layout']['annotations'].extend([go.Annotation(text=title,
                                                         x=0.5,
                                                         y=1.3,
                                                         xanchor="center",
@@ -1769,7 +2304,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
     else: 
         for i, group in enumerate(unique_groups):
 
-            points_group = points[points[grouping_clustering]==group]
+            points_group = points[group_labels==group]
             if grouping_clustering.startswith('cluster'):
                 group_str = 'cluster_' + str(group)
             elif grouping_clustering== "dataset":
@@ -1780,7 +2315,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 
             color_num = i
             
-            trace3d = traces_tsne.setdefault(color_num, Scatter3d(
+            trace3d = traces_tsne.setdefault(color_num, go.Scatter3d(
                 x=list(),
                 y=list(),
                 z=list(),
@@ -1821,16 +2356,16 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
         end = mch_dataframe.dropna().quantile(ptile_end).values[0].tolist()
         mch_colors = [set_color_by_percentile(x, start, end) for x in mch]
 
-        colorbar_tickval = list(arange(start, end, (end - start) / 4))
+        colorbar_tickval = list(np.arange(start, end, (end - start) / 4))
         colorbar_tickval[0] = start
         colorbar_tickval.append(end)
         colorbar_ticktext = [
-            str(round(x, 3)) for x in arange(start, end, (end - start) / 4)
+            str(round(x, 3)) for x in np.arange(start, end, (end - start) / 4)
         ]
         colorbar_ticktext[0] = '<' + str(round(start, 3))
         colorbar_ticktext.append('>' + str(round(end, 3)))
 
-        trace_methylation = Scatter3d(
+        trace_methylation = go.Scatter3d(
             mode='markers',
             x=x,
             y=y,
@@ -1856,7 +2391,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
             showlegend=False,
             hoverinfo='text')
 
-        layout = Layout(
+        layout = go.Layout(
             autosize=True,
             height=450,
             width=1000,
@@ -1949,7 +2484,7 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
         fig['layout']['scene1'].update(scene)
         fig['layout']['scene2'].update(scene)
     
-        fig['layout']['annotations'].extend([Annotation(text="Cluster Labels",
+        fig['layout']['annotations'].extend([go.Annotation(text="Cluster Labels",
                                                         x=-.09,
                                                         y=1.03 + annotation_additional_y,
                                                         xanchor="left",
@@ -1967,14 +2502,15 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
         include_plotlyjs=False)
 
 
-@cache.memoize(timeout=3600)
+@singleflight.memoize(timeout=3600)
 def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end, normalize_row, query):
     """Generate mCH heatmap comparing multiple genes.
 
     Arguments:
         ensemble (str): Name of ensemble.
         methylation_type (str): Type of methylation to visualize.        "mch" or "mcg"
-        level (str): "original" or "normalized" methylation values.
+        level (str): "original" or "normalized" median methylation of the cells of each group, or
+            "pseudobulk" or "pseudobulk_normalized" methylation of the pooled cells of each group.
         outliers (bool): Whether if outliers should be displayed.
         ptile_start (float): Lower end of color percentile. [0, 1].
         ptile_end (float): Upper end of color percentile. [0, 1].
@@ -1996,17 +2532,29 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
     genes= query.split()
 
     print(genes)
+    cell_level = pseudobulk_levels.get(level, level)
     gene_info_df = pd.DataFrame()
     gene_infos = get_gene_by_id(genes)
+    gene_methylation = []
     for i, gene in enumerate(gene_infos):
         gene_name = gene['gene_name']
         if i > 0 and i % 10 == 0:
             title += "<br>"
         title += gene_name + "+"
-        gene_info_df[gene_name] = median_cluster_mch(get_gene_methylation(ensemble, methylation_type, gene['gene_id'], grouping, clustering, level, True), grouping, clustering)
+        gene_info = get_gene_methylation(ensemble, methylation_type, gene['gene_id'], grouping, clustering, cell_level, True)
+        if level in pseudobulk_levels:
+            gene_methylation.append(gene_info)
+            continue
+        gene_info_df[gene_name] = median_cluster_mch(gene_info, grouping, clustering, ensemble)
         if gene_info_df[gene_name].empty:
             raise FailToGraphException
 
+    if level in pseudobulk_levels:
+        gene_info_df = pseudobulk_cluster_mch(gene_methylation, methylation_type, grouping, clustering, level, ensemble)
+        if gene_info_df is None or gene_info_df.empty or all(gene_info is None for gene_info in gene_methylation):
+            raise FailToGraphException
+        gene_info_df.columns = [gene['gene_name'] for gene in gene_infos]
+
     title = title[:-1] # Gets rid of last '+'
 
     gene_info_df.reset_index(inplace=True)
@@ -2064,11 +2612,11 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
     start = mch_dataframe.quantile(0.05)[0].tolist()
     end = mch_dataframe.quantile(0.95).values[0].tolist()
 
-    colorbar_tickval = list(arange(start, end, (end - start) / 4))
+    colorbar_tickval = list(np.arange(start, end, (end - start) / 4))
     colorbar_tickval[0] = start
     colorbar_tickval.append(end)
     colorbar_ticktext = [
-        str(round(x, 3)) for x in arange(start, end, (end - start) / 4)
+        str(round(x, 3)) for x in np.arange(start, end, (end - start) / 4)
     ]
     if normalize_row == True:
         colorbar_ticktext[0] = str(round(start, 3))
@@ -2089,7 +2637,7 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
         else:
             colorbar_ticktext.insert(0, '<' + str(round(start, 3)))
 
-    trace = Heatmap(
+    trace = go.Heatmap(
         x=x,
         y=y,
         z=mch,
@@ -2109,7 +2657,7 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
         hoverinfo='text'
         )
 
-    layout = Layout(
+    layout = go.Layout(
         # autosize=True,
         # height=550,
         height=max(550*len(genes)/20,300), # EAM Adjust the height of the heatmap according to the number of genes displayed
@@ -2201,7 +2749,7 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 
     layout['updatemenus'] = updatemenus
 
-    layout['annotations'].extend([Annotation(text=title,
+    layout['annotations'].extend([go.Annotation(text=title,
                                              x=0.5,
                                              y=1.3,
                                              xanchor="center",
@@ -2222,7 +2770,7 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
         include_plotlyjs=False)
 
 
-@cache.memoize(timeout=3600)
+@singleflight.memoize(timeout=3600)
 def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query):
     """Generate mCH heatmap comparing multiple genes.
 
@@ -2253,7 +2801,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
         if i > 0 and i % 10 == 0:
             title += "<br>"
         title += gene_name + "+"
-        gene_info_df[gene_name] = median_cluster_snATAC(get_gene_snATAC(ensemble, gene['gene_id'], grouping, True), grouping)
+        gene_info_df[gene_name] = median_cluster_snATAC(get_gene_snATAC(ensemble, gene['gene_id'], grouping, True), grouping, ensemble)
 
     title = title[:-1] # Gets rid of last '+'
 
@@ -2312,11 +2860,11 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
     start = snATAC_counts_dataframe.quantile(0.05)[0].tolist()
     end = snATAC_counts_dataframe.quantile(0.95).values[0].tolist()
 
-    colorbar_tickval = list(arange(start, end, (end - start) / 4))
+    colorbar_tickval = list(np.arange(start, end, (end - start) / 4))
     colorbar_tickval[0] = start
     colorbar_tickval.append(end)
     colorbar_ticktext = [
-        str(round(x, 3)) for x in arange(start, end, (end - start) / 4)
+        str(round(x, 3)) for x in np.arange(start, end, (end - start) / 4)
     ]
     if normalize_row == True:
         colorbar_ticktext[0] = str(round(start, 3))
@@ -2334,7 +2882,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
         else:
             colorbar_ticktext.insert(0, '<' + str(round(start, 3)))
 
-    trace = Heatmap(
+    trace = go.Heatmap(
         x=x,
         y=y,
         z=snATAC_counts,
@@ -2354,7 +2902,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
         hoverinfo='text'
         )
 
-    layout = Layout(
+    layout = go.Layout(
         autosize=True,
         height=550,
         width=1000,
@@ -2441,7 +2989,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 
     layout['updatemenus'] = updatemenus
 
-    layout['annotations'].extend([Annotation(text=title,
+    layout['annotations'].extend([go.Annotation(text=title,
                                              x=0.5,
                                              y=1.4,
                                              xanchor="center",
@@ -2463,7 +3011,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
         include_plotlyjs=False)
 
 
-@cache.memoize(timeout=3600)
+@singleflight.memoize(timeout=3600)
 def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, outliers):
     """Generate gene body mCH box plot.
 
@@ -2475,13 +3023,15 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
         gene (str):  Ensembl ID of gene for that ensemble.
         clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
         grouping (str): Variable to group cells by. "cluster", "annotation".
-        level (str): "original" or "normalized" methylation values.
+        level (str): "original" or "normalized" methylation values. "pseudobulk" or "pseudobulk_normalized" also
+            marks the pseudo-bulk level of each group over the boxes of the corresponding per-cell values.
         outliers (bool): Whether if outliers should be displayed.
 
     Returns:
         str: HTML generated by Plot.ly.
     """
-    points = get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, level, outliers)
+    cell_level = pseudobulk_levels.get(level, level)
+    points = get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, cell_level, outliers)
     context = methylation_type[1:]
 
     if points is None:
@@ -2490,39 +3040,19 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
         grouping = "cluster"
         print("**** Using cluster numbers")
 
-    traces = OrderedDict()
-    if grouping == "dataset":
-        unique_groups = points["dataset"].unique()
-    elif grouping == 'target_region':
-        points['target_region'].fillna('N/A', inplace=True)
-        unique_groups = points['target_region'].unique()
-    elif grouping == 'slice':
-        datasets_all_cells = points['dataset'].tolist()
-        slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
-        points['slice'] = slices_list
-        slices_set = set(slices_list)
-        unique_groups = np.array(list(slices_set))
-    elif grouping == 'sex':
-        unique_groups = points['sex'].unique()
-    elif grouping == 'cluster' or grouping == 'annotation':
-        unique_groups = points[grouping+'_'+clustering].unique()
-    else:
+    groups = get_cell_groups(ensemble, grouping, clustering)
+    if groups is None:
         raise FailToGraphException
-    num_clusters = len(unique_groups)
-
-    colors = generate_cluster_colors(num_clusters, grouping)
-    for point in points.to_dict('records'):
-        name_prepend = ""
-        if grouping == "dataset" or grouping == 'target_region' or grouping == 'slice' or grouping == 'sex':
-            color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
-            group = point[grouping]
-        else:
-            if grouping == "cluster":
-                name_prepend="cluster_"
-            color = colors[int(np.where(unique_groups==point[grouping+'_'+clustering])[0]) % len(colors)]
-            group = point[grouping+'_'+clustering]
-        trace = traces.setdefault(group, Box(
-                y=list(),
+    groups = groups.for_keys(points['cell_id'].values)
+
+    colors = generate_cluster_colors(groups.num_groups, grouping)
+    name_prepend = "cluster_" if grouping == "cluster" else ""
+    traces = []
+    values = points[methylation_type + '/' + context + '_' + cell_level].values
+    for i, (group, group_values) in enumerate(zip(groups.groups, groups.split(values))):
+        color = colors[i % len(colors)]
+        traces.append(go.Box(
+                y=group_values.tolist(),
                 name=name_prepend + str(group),
                 marker={
                     'color': color,
@@ -2533,11 +3063,28 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
                 visible=True,
                 showlegend=False,
                 ))
-        trace['y'].append(point[methylation_type + '/' + context + '_' + level])
+
+    if level in pseudobulk_levels:
+        # Pool all cells, outliers included.
+        all_points = points if outliers else get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, cell_level, True)
+        pseudobulk = pseudobulk_cluster_mch([all_points], methylation_type, grouping, clustering, level, ensemble)
+        if pseudobulk is not None:
+            traces.append(go.Scatter(
+                x=[name_prepend + str(group) for group in groups.groups],
+                y=pseudobulk[0].reindex(groups.groups).tolist(),
+                mode='markers',
+                name='Pseudo-bulk',
+                marker={
+                    'color': 'black',
+                    'symbol': 'diamond',
+                    'size': 9
+                },
+                showlegend=True,
+                ))
 
     gene_name = get_gene_by_id([ gene ])[0]['gene_name']
 
-    layout = Layout(
+    layout = go.Layout(
         autosize=True,
         height=450,
         width=700,
@@ -2566,7 +3113,7 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
             'mirror': True,
         },
         yaxis={
-            'title': gene_name + ' ' + level.capitalize() + ' ' + methylation_type,
+            'title': gene_name + ' ' + cell_level.capitalize() + ' ' + methylation_type,
             'titlefont': {
                 'size': 15
             },
@@ -2590,7 +3137,7 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
 
     return plotly.offline.plot(
         {
-            'data': list(traces.values()),
+            'data': traces,
             'layout': layout
         },
         output_type='div',
@@ -2598,7 +3145,7 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
         include_plotlyjs=False)
 
 
-@cache.memoize(timeout=3600)
+@singleflight.memoize(timeout=3600)
 def get_snATAC_box(ensemble, gene, grouping, outliers):
     """Generate gene body mCH box plot.
 
@@ -2618,36 +3165,25 @@ def get_snATAC_box(ensemble, gene, grouping, outliers):
     if points is None:
         raise FailToGraphException
 
-    if grouping == "dataset":
-        unique_groups = points["dataset"].unique()
-    elif grouping == "target_region":
-        points['target_region'].fillna('N/A', inplace=True)
-        unique_groups = points["target_region"].unique()
-    elif grouping == 'annotation' or grouping == 'cluster':
-        if grouping == 'annotation' and grouping+'_ATAC' not in points.columns: # If no cluster annotations available, group by cluster number instead
-            grouping = "cluster"
-            points = get_gene_snATAC(ensemble, gene, grouping, outliers)
-            print("**** Grouping by cluster")
-        unique_groups = points[grouping+'_ATAC'].unique()
-    else: 
+    if grouping == 'annotation' and points['annotation_ATAC'].nunique() <= 1: # If no cluster annotations available, group by cluster number instead
+        grouping = "cluster"
+        print("**** Grouping by cluster")
+    if grouping not in ('annotation', 'cluster', 'dataset', 'target_region'):
         raise FailToGraphException
+    groups = get_cell_groups(ensemble, grouping, 'ATAC', bind='snATAC_data')
+    if groups is None:
+        raise FailToGraphException
+    groups = groups.for_keys(points['cell_id'].values)
 
-    num_clusters = len(unique_groups)
-    colors = generate_cluster_colors(num_clusters, grouping)
-
-    name_prepend = ""
+    colors = generate_cluster_colors(groups.num_groups, grouping)
+    name_prepend = "cluster_" if grouping == "cluster" else ""
     x_label = grouping
-    if grouping != "dataset" or grouping != "target_region":
-        if grouping == "cluster":
-            name_prepend="cluster_"
-        grouping += "_ATAC"
-
-    traces = OrderedDict()
-    for point in points.to_dict('records'):
-        color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
-        group = point[grouping]
-        trace = traces.setdefault(group, Box(
-                y=list(),
+
+    traces = []
+    for i, (group, group_values) in enumerate(zip(groups.groups, groups.split(points['normalized_counts'].values))):
+        color = colors[i % len(colors)]
+        traces.append(go.Box(
+                y=group_values.tolist(),
                 name=name_prepend + str(group),
                 marker={
                     'color': color,
@@ -2658,11 +3194,10 @@ def get_snATAC_box(ensemble, gene, grouping, outliers):
                 visible=True,
                 showlegend=False,
                 ))
-        trace['y'].append(point['normalized_counts'])
 
     gene_name = get_gene_by_id([ gene ])[0]['gene_name']
 
-    layout = Layout(
+    layout = go.Layout(
         autosize=True,
         height=450,
         width=1000,
@@ -2714,7 +3249,7 @@ def get_snATAC_box(ensemble, gene, grouping, outliers):
 
     return plotly.offline.plot(
         {
-            'data': list(traces.values()),
+            'data': traces,
             'layout': layout
         },
         output_type='div',
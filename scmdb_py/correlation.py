@@ -0,0 +1,120 @@
+"""On-demand correlated gene search.
+
+Correlations are computed on the fly from a rank-normalized genes x cells matrix of an ensemble, written by
+`scripts/generate_correlation.py correlate ... --normalized-dir CORRELATION_DATA_DIR`. Each row of the matrix holds the
+ranks of a gene over the cells of the ensemble, centred, with missing cells set to 0 and scaled to unit length, so the
+correlation of a gene (or the average profile of a set of genes) with all genes is a single matrix-vector product.
+Filling missing cells with the mean rank makes this an approximation of the Spearman correlations in the
+<ensemble>_correlated_genes tables, close to them for genes covered in most cells.
+
+Matrices are loaded lazily and the CORRELATION_CACHE_SIZE most recently used ones are kept in memory.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from .lazy import lazy_import
+
+np = lazy_import('numpy')
+
+
+class NormalizedMatrix(object):
+    """Rank-normalized genes x cells matrix of an ensemble."""
+
+    def __init__(self, genes, values):
+        self.genes = genes
+        self.values = values
+        # Gene ids without the version number, ie. ENSMUSG00000026787
+        self.gene_index = {gene.split('.')[0]: i for i, gene in enumerate(genes)}
+
+    def profile(self, gene_ids):
+        """Return the normalized average profile of genes, with the indices of the genes found, or (None, [])."""
+        rows = [self.gene_index[gene.split('.')[0]] for gene in gene_ids if gene.split('.')[0] in self.gene_index]
+        if not rows:
+            return None, []
+        vector = np.asarray(self.values[rows], dtype=np.float32).mean(axis=0)
+        norm = np.sqrt(np.dot(vector, vector))
+        if norm == 0:
+            return None, rows
+        return vector / norm, rows
+
+    def top_k(self, vector, k=100, exclude=()):
+        """Return the k genes most correlated with a profile as a list of (gene id, correlation)."""
+        corr = self.values.dot(vector)
+        corr[list(exclude)] = -np.inf
+        k = min(k, len(corr) - len(exclude))
+        if k <= 0:
+            return []
+        best = np.argpartition(-corr, k - 1)[:k]
+        best = best[np.argsort(-corr[best])]
+        return [(self.genes[i], float(corr[i])) for i in best if np.isfinite(corr[i])]
+
+
+class NormalizedMatrixCache(object):
+    """LRU cache of NormalizedMatrix objects, reloaded when their file changes."""
+
+    def __init__(self):
+        self._matrices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def paths(self, ensemble):
+        data_dir = current_app.config.get('CORRELATION_DATA_DIR')
+        if not data_dir:
+            return None, None
+        base = os.path.join(data_dir, ensemble)
+        return base + '.npy', base + '.json'
+
+    def get(self, ensemble):
+        """Return the NormalizedMatrix of an ensemble, or None if it has not been generated."""
+        matrix_path, genes_path = self.paths(ensemble)
+        if matrix_path is None or not os.path.exists(matrix_path):
+            return None
+        mtime = os.path.getmtime(matrix_path)
+
+        with self._lock:
+            cached = self._matrices.get(ensemble)
+            if cached is not None and cached[0] == mtime:
+                self._matrices.move_to_end(ensemble)
+                return cached[1]
+
+            with open(genes_path) as f:
+                genes = json.load(f)['genes']
+            mmap_mode = 'r' if current_app.config.get('CORRELATION_MMAP', False) else None
+            matrix = NormalizedMatrix(genes, np.load(matrix_path, mmap_mode=mmap_mode))
+
+            self._matrices[ensemble] = (mtime, matrix)
+            self._matrices.move_to_end(ensemble)
+            while len(self._matrices) > current_app.config.get('CORRELATION_CACHE_SIZE', 2):
+                self._matrices.popitem(last=False)
+        return matrix
+
+    def clear(self):
+        with self._lock:
+            self._matrices.clear()
+
+
+normalized_matrices = NormalizedMatrixCache()
+
+
+def search_correlated_genes(ensemble, gene_ids, k=100):
+    """Find the genes most correlated with a gene, or with the average profile of a set of genes.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. ie. Ens0, Ens1...
+        gene_ids (list): Ensembl IDs, with or without version numbers.
+        k (int): Number of genes to return.
+
+    Returns:
+        list: (gene id, correlation) of the k most correlated genes, excluding the queried genes.
+        None if the ensemble has no normalized matrix or none of the genes are in it.
+    """
+    matrix = normalized_matrices.get(ensemble)
+    if matrix is None:
+        return None
+    vector, rows = matrix.profile(gene_ids)
+    if vector is None:
+        return None
+    return matrix.top_k(vector, k, exclude=rows)
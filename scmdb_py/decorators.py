@@ -1,10 +1,19 @@
+import hashlib
 from functools import wraps
 
-from flask import abort
+from flask import abort, current_app, request
 from flask_login import current_user
 
+from . import catalog
 from .user import Permission
 
+# Cache-Control of each route family, overridden by HTTP_CACHE_POLICIES in the config.
+default_cache_policies = {
+    'options': 'public, max-age=86400',
+    'plots': 'public, max-age=3600',
+    'summaries': 'public, max-age=600',
+}
+
 
 def permission_required(permission):
     """Restrict a view to users with the given permission."""
@@ -23,3 +32,47 @@ def permission_required(permission):
 
 def admin_required(f):
     return permission_required(Permission.ADMINISTER)(f)
+
+
+def http_cache(family):
+    """Add validators and the Cache-Control policy of a route family ("options", "plots", "summaries") to a view.
+
+    Responses of these views only depend on the path, the query string and the data, so the ETag is derived from
+    them and the data version of the catalog and is known before the view runs. Requests with a matching
+    If-None-Match are answered with 304 Not Modified without calling the view. There is no Last-Modified: the time
+    the data last changed is not known, only its version. Responses to logged-in users are private, so shared caches
+    only keep public data. Responses other than 200 get neither, so views must answer failures with an error
+    status (ie. 500) for them not to be kept by browsers and proxies.
+
+    Place it between the route and the cache decorators.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            policy = current_app.config.get('HTTP_CACHE_POLICIES', default_cache_policies).get(family)
+            if request.method not in ('GET', 'HEAD') or not policy:
+                return f(*args, **kwargs)
+            if current_user.is_authenticated:
+                policy = policy.replace('public', 'private')
+
+            key = '\n'.join([catalog.current_version(), str(current_app.config.get('HTTP_CACHE_VERSION', '')),
+                             family, request.full_path])
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            # Weak, since compression changes the bytes but not the meaning of the response.
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = policy
+            response.vary.add('Cookie')
+            return response
+
+        return decorated_function
+
+    return decorator
@@ -10,6 +10,44 @@ JSONIFY_PRETTYPRINT_REGULAR = False
 
 # Minify HTML to conserve network transfer
 MINIFY_PAGE = True
+# Minified pages are cached by the hash of the page, at most MINIFY_CACHE_THRESHOLD of them (0 disables the cache).
+# Plot fragments (@htmlmin.exempt views) are not minified.
+MINIFY_CACHE_TIMEOUT = 3600
+MINIFY_CACHE_THRESHOLD = 200
+
+# When to import numpy, pandas and plotly (see lazy.py): False on first use by a data route, True in create_app,
+# 'background' in a thread started by create_app.
+PRELOAD_MODULES = False
+# Whether create_app loads the schema catalog of every data database (see catalog.py), or the first request needing it.
+CATALOG_PRELOAD = False
+
+# Background plot rendering (/jobs/plot, see jobs.py): 'rq' runs jobs on RQ workers ("rq worker default"), 'thread' in
+# JOBS_THREADS threads of the web process, 'auto' uses RQ whenever Redis answers. Results are kept JOBS_RESULT_TIMEOUT
+# seconds. Threads are refused on a multi-process server unless CACHE_TYPE is shared by the processes.
+# Status polls wait at most JOBS_MAX_WAIT seconds and tell clients to poll again after JOBS_RETRY_AFTER seconds.
+JOBS_BACKEND = 'auto'
+JOBS_THREADS = 2
+JOBS_TIMEOUT = 600
+JOBS_RESULT_TIMEOUT = 3600
+JOBS_MAX_WAIT = 5
+JOBS_RETRY_AFTER = 2
+# Jobs a client (remote address) may have queued or running at a time.
+JOBS_MAX_PENDING = 4
+
+# App cache (Flask-Cache). 'simple' keeps at most CACHE_THRESHOLD entries in each process; with several processes
+# (mod_wsgi, RQ workers), use a cache they share:
+#CACHE_TYPE = 'redis'
+#CACHE_REDIS_URL = 'redis://localhost:6379/1'
+CACHE_TYPE = 'simple'
+CACHE_THRESHOLD = 1000
+
+# Concurrent calls of the memoized plot functions with the same arguments run once (see singleflight.py). Waiting
+# callers give up and compute the value themselves after SINGLEFLIGHT_MAX_WAIT seconds. Processes are coordinated
+# through the cache, which needs a CACHE_TYPE shared by them (ie. redis); SINGLEFLIGHT_LOCK_TIMEOUT bounds the lock
+# held by a process that dies while computing, SINGLEFLIGHT_POLL_INTERVAL is how often other processes check for it.
+SINGLEFLIGHT_MAX_WAIT = 120
+SINGLEFLIGHT_LOCK_TIMEOUT = 300
+SINGLEFLIGHT_POLL_INTERVAL = 0.1
 
 # Statement for enabling the development environment
 #DEBUG = True
@@ -32,6 +70,44 @@ MYSQL_SERVER_NAME = 'localhost'
 SQLALCHEMY_BINDS = {'methylation_data': 'mysql://' + MYSQL_USER + ':' + MYSQL_PW + '@' + MYSQL_SERVER_NAME + '/' + MYSQL_DB_methylation,
                     'snATAC_data': 'mysql://' + MYSQL_USER + ':' + MYSQL_PW + '@' + MYSQL_SERVER_NAME + '/' + MYSQL_DB_snATAC}
 
+# To run without MySQL (load tests, benchmarks), point the binds at local SQLite copies of the databases instead.
+# The queries in content.py are dialect-neutral, so both setups run the same SQL.
+#SQLALCHEMY_BINDS = {'methylation_data': 'sqlite:////path/to/CEMBA.sqlite',
+#                    'snATAC_data': 'sqlite:////path/to/CEMBA_snATAC.sqlite'}
+
+# Rank-normalized matrices for on-demand correlated gene search, written by
+# scripts/generate_correlation.py correlate ... --normalized-dir. Leave empty to disable.
+CORRELATION_DATA_DIR = ''
+# Number of ensemble matrices kept in memory, and whether to memory-map them instead of loading them.
+CORRELATION_CACHE_SIZE = 2
+CORRELATION_MMAP = False
+
+# Log the cached size of cell and gene frames before and after compaction, in bytes per cell.
+CACHE_MEMORY_REPORT = False
+
+# Bulk export API (/api/export/<ensemble>/...). Arrow and Parquet formats need pyarrow, CSV works without it.
+EXPORT_MAX_GENES = 1000
+# Genes read from the database per chunk, and cell rows fetched per chunk from the server-side cursor.
+EXPORT_GENES_PER_CHUNK = 20
+EXPORT_ROWS_PER_CHUNK = 50000
+
+# Rows fetched per chunk from the server-side cursor by /content/metadata.
+METADATA_ROWS_PER_CHUNK = 10000
+
+# Cache-Control of the option, plot and summary routes (see decorators.http_cache). Their ETags follow the data version
+# of the databases; change HTTP_CACHE_VERSION when a deployment changes what these routes return for the same data.
+HTTP_CACHE_POLICIES = {'options': 'public, max-age=86400',
+                       'plots': 'public, max-age=3600',
+                       'summaries': 'public, max-age=600'}
+HTTP_CACHE_VERSION = ''
+
+# Compressed responses are cached by the hash of their body for COMPRESS_CACHE_TIMEOUT seconds, in a cache of their own
+# holding at most COMPRESS_CACHE_THRESHOLD bodies (0 disables the cache). Brotli is used for clients that accept it if
+# the brotli package is installed and COMPRESS_BROTLI is set.
+COMPRESS_CACHE_TIMEOUT = 3600
+COMPRESS_CACHE_THRESHOLD = 200
+COMPRESS_BROTLI = True
+
 # Enable protection agains *Cross-site Request Forgery (CSRF)*
 CSRF_ENABLED = True
 
@@ -0,0 +1,274 @@
+"""Bulk data export API.
+
+    /api/export/<ensemble>/cells?format=parquet
+    /api/export/<ensemble>/genes?q=ENSMUSG00000026787+ENSMUSG00000033006&methylation_type=mCH&format=arrow
+    /api/export/<ensemble>/clusters?q=ENSMUSG00000026787&methylation_type=mCH&grouping=cluster&clustering=mCH_lv_npc50_k5
+
+cells: metadata of the cells of the ensemble, with their tSNE coordinates and clusterings.
+genes: gene x cell values in long format, one row per gene and cell with data (gene_id, cell_id, mc, c, level).
+clusters: summary of each gene in each group (gene_id, group, cells, mean, median and pseudobulk, sum(mc) / sum(c)).
+
+Formats are csv (gzip-compressed, the default), arrow (Arrow IPC stream) and parquet. Arrow and Parquet need pyarrow,
+which is optional; without it these formats answer 501.
+
+Responses are produced chunk by chunk and encoded as they go: cells are read from a server-side cursor, gene values and
+summaries a few genes at a time. No Content-Length is set, so responses use chunked transfer encoding, and the
+generators only advance as the WSGI server writes to the client, so a slow client holds back the database reads instead
+of buffering the response in memory.
+"""
+import importlib.util
+import re
+import zlib
+
+from flask import Blueprint, Response, abort, current_app, request, stream_with_context
+from flask_login import current_user
+
+from . import catalog
+from .content import (get_cell_groups, get_ensemble_cell_ids, get_ensemble_info, read_gene_counts, stream_query,
+                      table_columns)
+from .lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+if importlib.util.find_spec('pyarrow') is not None:
+    pyarrow = lazy_import('pyarrow')
+    parquet = lazy_import('pyarrow.parquet')
+else:
+    pyarrow = parquet = None
+
+export = Blueprint('export', __name__)
+
+export_formats = {
+    'csv': ('application/gzip', 'csv.gz'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow'),
+    'parquet': ('application/octet-stream', 'parquet'),
+}
+methylation_types = ('mCH', 'mCG', 'mCA')
+groupings = ('cluster', 'annotation', 'dataset', 'slice', 'target_region', 'sex')
+
+
+class ChunkSink(object):
+    """Write-only file object keeping what a writer wrote since the last drain()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def encode_csv(frames):
+    """Encode DataFrames as one gzip-compressed CSV, yielding compressed bytes as they are produced."""
+    # wbits 31 writes a gzip header and trailer.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    header = True
+    for df in frames:
+        data = compressor.compress(df.to_csv(index=False, header=header).encode('utf-8'))
+        header = False
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def arrow_table(df, schema=None):
+    """Convert a DataFrame to an Arrow table. Without a schema, columns without any value are typed as strings."""
+    if schema is not None:
+        return pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False)
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    fields = [pyarrow.field(field.name, pyarrow.string()) if field.type == pyarrow.null() else field
+              for field in table.schema]
+    return pyarrow.Table.from_pandas(df, schema=pyarrow.schema(fields), preserve_index=False)
+
+
+def encode_arrow(frames):
+    """Encode DataFrames as an Arrow IPC stream, one or more record batches per frame."""
+    sink = ChunkSink()
+    writer = schema = None
+    for df in frames:
+        table = arrow_table(df, schema)
+        if writer is None:
+            schema = table.schema
+            writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def encode_parquet(frames):
+    """Encode DataFrames as a Parquet file, one row group per frame. The footer is written last."""
+    sink = ChunkSink()
+    writer = schema = None
+    for df in frames:
+        table = arrow_table(df, schema)
+        if writer is None:
+            schema = table.schema
+            writer = parquet.ParquetWriter(sink, table.schema, compression='snappy')
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+encoders = {'csv': encode_csv, 'arrow': encode_arrow, 'parquet': encode_parquet}
+
+
+def export_response(frames, ensemble, name):
+    """Stream DataFrames in the format requested with ?format=, as an attachment."""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export_formats:
+        abort(400, 'format must be one of: ' + ', '.join(sorted(export_formats)))
+    if export_format != 'csv' and pyarrow is None:
+        abort(501, 'pyarrow is not installed, use format=csv')
+
+    mimetype, extension = export_formats[export_format]
+    response = Response(stream_with_context(encoders[export_format](frames)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="{}_{}.{}"'.format(ensemble, name, extension)
+    # Keep the body a stream, after_request handlers (ie. compression) must not buffer it.
+    response.direct_passthrough = True
+    return response
+
+
+def check_ensemble(ensemble):
+    """Abort with 404 for unknown ensembles and 403 for private ensembles when not logged in."""
+    if catalog.ensemble(ensemble) is None:
+        abort(404)
+    ensemble_info = get_ensemble_info(ensemble_id=ensemble)
+    if ensemble_info is None:
+        abort(404)
+    if ensemble_info['public_access'] != 1 and not current_user.is_authenticated:
+        abort(403)
+
+
+def requested_genes():
+    """Return (gene id, table name) of the genes in ?q=, separated by spaces, '+' or commas."""
+    genes = [gene for gene in re.split(r'[\s,+]+', request.args.get('q', '')) if gene]
+    if not genes:
+        abort(400, 'q must list at least one Ensembl gene ID')
+    if len(genes) > current_app.config.get('EXPORT_MAX_GENES', 1000):
+        abort(400, 'too many genes, the limit is {}'.format(current_app.config.get('EXPORT_MAX_GENES', 1000)))
+    tables = [(gene, catalog.gene_table(gene)) for gene in genes]
+    missing = [gene for gene, table in tables if table is None]
+    if missing:
+        abort(404, 'no data for ' + ', '.join(missing))
+    return tables
+
+
+def requested_methylation_type():
+    methylation_type = request.args.get('methylation_type', 'mCH')
+    if methylation_type not in methylation_types:
+        abort(400, 'methylation_type must be one of: ' + ', '.join(methylation_types))
+    return methylation_type
+
+
+def gene_chunks(ensemble, methylation_type, tables):
+    """Yield (gene ids, counts) for chunks of EXPORT_GENES_PER_CHUNK genes, see content.read_gene_counts."""
+    chunk_size = current_app.config.get('EXPORT_GENES_PER_CHUNK', 20)
+    for start in range(0, len(tables), chunk_size):
+        chunk = tables[start:start+chunk_size]
+        counts = read_gene_counts(ensemble, methylation_type, [table for _, table in chunk])
+        if counts is None:
+            raise IOError('Failed to read genes {} to {} of {}'.format(chunk[0][0], chunk[-1][0], ensemble))
+        yield [gene for gene, _ in chunk], counts
+
+
+@export.route('/api/export/<ensemble>/cells')
+def export_cells(ensemble):
+    check_ensemble(ensemble)
+
+    ensemble_columns = [column for column in catalog.ensemble(ensemble).columns if column != 'cell_id']
+    dataset_columns = [column for column in ('target_region', 'sex') if column in table_columns('datasets')]
+    query = "SELECT cells.cell_id, cells.cell_name, cells.dataset{1}{2} \
+        FROM cells \
+        INNER JOIN {0} ON cells.cell_id = {0}.cell_id \
+        LEFT JOIN datasets ON cells.dataset = datasets.dataset \
+        ORDER BY cells.cell_id".format(ensemble,
+                                       ''.join(', datasets.' + column for column in dataset_columns),
+                                       ''.join(', {}.{}'.format(ensemble, column) for column in ensemble_columns))
+    chunk_size = current_app.config.get('EXPORT_ROWS_PER_CHUNK', 50000)
+    return export_response(stream_query(query, chunk_size=chunk_size), ensemble, 'cells')
+
+
+@export.route('/api/export/<ensemble>/genes')
+def export_genes(ensemble):
+    check_ensemble(ensemble)
+    methylation_type = requested_methylation_type()
+    tables = requested_genes()
+
+    def frames():
+        cell_ids = get_ensemble_cell_ids(ensemble)
+        context = methylation_type[1:]
+        for genes, counts in gene_chunks(ensemble, methylation_type, tables):
+            for gene, gene_counts in zip(genes, counts):
+                mc = gene_counts[methylation_type].values
+                c = gene_counts[context].values
+                found = ~np.isnan(c)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    level = mc[found].astype(np.float64) / c[found]
+                yield pd.DataFrame({'gene_id': gene,
+                                    'cell_id': cell_ids[found],
+                                    'mc': mc[found],
+                                    'c': c[found],
+                                    'level': level},
+                                   columns=['gene_id', 'cell_id', 'mc', 'c', 'level'])
+
+    return export_response(frames(), ensemble, methylation_type + '_genes')
+
+
+@export.route('/api/export/<ensemble>/clusters')
+def export_clusters(ensemble):
+    check_ensemble(ensemble)
+    methylation_type = requested_methylation_type()
+    tables = requested_genes()
+    grouping = request.args.get('grouping', 'cluster')
+    if grouping not in groupings:
+        abort(400, 'grouping must be one of: ' + ', '.join(groupings))
+    clustering = request.args.get('clustering', 'mCH_lv_npc50_k5')
+    groups = get_cell_groups(ensemble, grouping, clustering)
+    if groups is None:
+        abort(404, 'no {} grouping for {}'.format(grouping, clustering))
+
+    def frames():
+        codes = groups.for_keys(get_ensemble_cell_ids(ensemble))
+        context = methylation_type[1:]
+        for genes, counts in gene_chunks(ensemble, methylation_type, tables):
+            for gene, gene_counts in zip(genes, counts):
+                mc = gene_counts[methylation_type].values.astype(np.float64)
+                c = gene_counts[context].values.astype(np.float64)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    level = mc / c
+                    sums = codes.sums(np.column_stack([np.nan_to_num(mc), np.nan_to_num(c)]))
+                    pseudobulk = sums[:, 0] / sums[:, 1]
+                yield pd.DataFrame({'gene_id': gene,
+                                    'group': [str(group) for group in codes.groups],
+                                    'cells': codes.count(level).values,
+                                    'mean': codes.mean(level).values,
+                                    'median': codes.median(level).values,
+                                    'pseudobulk': pseudobulk},
+                                   columns=['gene_id', 'group', 'cells', 'mean', 'median', 'pseudobulk'])
+
+    return export_response(frames(), ensemble, '{}_{}_summary'.format(methylation_type, grouping))
@@ -0,0 +1,124 @@
+"""Compact DataFrames for the cache.
+
+Cached frames are pickled by the cache on every set and get, so their size is the memory a cache entry holds. Labels
+repeated across cells are stored as categoricals, integral numbers as the smallest integer type that holds them and
+other numbers as float32. Columns of (mostly) unique strings, like cell names, are left as they are since a
+categorical would only add codes to them.
+
+Frames returned by cached functions are shared by every request that hits the cache, so they are frozen: their arrays
+are read-only and writing to them raises instead of changing what other requests see. Derived columns go into new
+Series or frames, ie. df[column].fillna(...) rather than df[column].fillna(..., inplace=True).
+"""
+import datetime
+import functools
+import pickle
+import sys
+
+from flask import current_app
+
+from .lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+def compact_frame(df):
+    """Return a copy of a DataFrame with compact column types.
+
+    Arguments:
+        df (DataFrame): Frame as read from the database.
+
+    Returns:
+        DataFrame: object columns with repeated values as categoricals, integral columns without missing values as
+            the smallest integer type and other numeric columns as float32.
+    """
+    compact = pd.DataFrame(index=df.index)
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_string_dtype(values):
+            if values.nunique() < len(values) // 2:
+                values = values.astype('category')
+        elif values.dtype.kind in 'iu':
+            values = pd.to_numeric(values, downcast='integer' if values.min() < 0 else 'unsigned')
+        elif values.dtype.kind == 'f':
+            if not values.isnull().any() and (values == np.round(values)).all():
+                values = pd.to_numeric(values.astype(np.int64), downcast='integer' if values.min() < 0 else 'unsigned')
+            else:
+                values = values.astype(np.float32)
+        compact[column] = values
+    return compact
+
+
+def freeze_array(values):
+    """Make an array read-only, along with the arrays it is a view of."""
+    while isinstance(values, np.ndarray):
+        values.flags.writeable = False
+        values = values.base
+
+
+def freeze_frame(df):
+    """Make the arrays of a DataFrame read-only, in place, and return it.
+
+    The values of a column are a view of the array pandas stores it in, so that array is frozen with them (see
+    freeze_array). Only columns backed by NumPy arrays are frozen. The codes of categorical columns are read-only
+    already.
+    """
+    for column in df.columns:
+        freeze_array(df[column].values)
+    return df
+
+
+def frozen(function):
+    """Decorator freezing the DataFrame or array a cached function returns, on cache misses and hits alike.
+
+    Place it above the cache decorator: the cache hands out unpickled copies, which have to be frozen on the way out.
+    """
+    @functools.wraps(function)
+    def decorated_function(*args, **kwargs):
+        result = function(*args, **kwargs)
+        if isinstance(result, pd.DataFrame):
+            freeze_frame(result)
+        elif isinstance(result, np.ndarray):
+            result.flags.writeable = False
+        return result
+    return decorated_function
+
+
+def sorted_positions(sorted_keys, keys):
+    """Return the position of each key in an array of sorted unique keys, -1 for keys not in it."""
+    keys = np.asarray(keys)
+    positions = np.full(len(keys), -1, dtype=np.int64)
+    if len(sorted_keys):
+        found_positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        found = sorted_keys[found_positions] == keys
+        positions[found] = found_positions[found]
+    return positions
+
+
+def widen_float32(values, digits=7):
+    """Convert float32 values to float64, rounded to the significant digits float32 holds.
+
+    float32 values converted as is print with spurious digits (ie. 17.0435 -> 17.043500900268555), which would end
+    up in the JSON of the plots.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = 10.0 ** (digits - 1 - np.floor(np.log10(np.abs(values))))
+        widened = np.round(values * scale) / scale
+    return np.where(np.isfinite(widened), widened, values)
+
+
+def cached_size(value):
+    """Size in bytes of a value once pickled by the cache."""
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def report_memory(name, original, compact):
+    """Log the cached size of a frame before and after compact_frame if CACHE_MEMORY_REPORT is set."""
+    if not current_app.config.get('CACHE_MEMORY_REPORT', False):
+        return
+    before, after = cached_size(original), cached_size(compact)
+    now = datetime.datetime.now()
+    print("[{}] CACHE MEMORY {}: {} rows, {} -> {} bytes ({:.1f} -> {:.1f} bytes per row)".format(
+        str(now), name, len(original), before, after, before / max(len(original), 1), after / max(len(original), 1)))
+    sys.stdout.flush()
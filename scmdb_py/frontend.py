@@ -16,9 +16,9 @@ from flask_mail import Mail, Message
 from flask_nav.elements import Navbar, Link, View, Text, Subgroup
 from flask_rq import get_queue
 
-from . import nav, cache, db, mail
+from . import nav, cache, db, htmlmin, mail, singleflight
 from .content import *
-from .decorators import admin_required
+from .decorators import admin_required, http_cache
 from .email import send_email
 from .forms import LoginForm, ChangeUserEmailForm, ChangeAccountTypeForm, InviteUserForm, CreatePasswordForm, NewUserForm, RequestResetPasswordForm, ResetPasswordForm, ChangePasswordForm
 from .user import User, Role
@@ -184,6 +184,8 @@ def nav_bar_screen():
 
 # API routes
 @frontend.route('/plot/methylation/scatter/<ensemble>/<tsne_type>/<methylation_type>/<level>/<grouping>/<clustering>/<ptile_start>/<ptile_end>/<tsne_outlier>')
+@htmlmin.exempt
+@http_cache('plots')
 def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, grouping, clustering, ptile_start, ptile_end, tsne_outlier):
 
     genes = request.args.get('q', 'MustHaveAQueryString')
@@ -210,10 +212,12 @@ def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, group
                                        float(ptile_end),
                                        tsne_outlier_bool)
     except FailToGraphException:
-        return "Failed to generate methylation tsne scatter plots for {}, please contact maintainer".format(ensemble)
+        return "Failed to generate methylation tsne scatter plots for {}, please contact maintainer".format(ensemble), 500
 
 
 @frontend.route('/plot/snATAC/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>')
+@htmlmin.exempt
+@http_cache('plots')
 def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier):
 
     genes_query = request.args.get('q', 'MustHaveAQueryString')
@@ -232,10 +236,11 @@ def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier
                                   float(ptile_end),
                                   tsne_outlier_bool)
     except FailToGraphException:
-        return "Failed to load snATAC-seq data for {}, please contact maintainer".format(ensemble)
+        return "Failed to load snATAC-seq data for {}, please contact maintainer".format(ensemble), 500
 
 @frontend.route('/plot/methylation/box/<ensemble>/<methylation_type>/<gene>/<grouping>/<clustering>/<level>/<outliers_toggle>')
-@cache.memoize(timeout=3600)
+@htmlmin.exempt
+@http_cache('plots')
 def plot_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, outliers_toggle):
 
     if outliers_toggle == 'outliers':
@@ -251,11 +256,12 @@ def plot_mch_box(ensemble, methylation_type, gene, grouping, clustering, level,
         return get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, outliers)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_mch_box): {}".format(e))
-        return 'Failed to produce mCH levels box plot. Contact maintainer.'
+        return 'Failed to produce mCH levels box plot. Contact maintainer.', 500
 
 
 @frontend.route('/plot/snATAC/box/<ensemble>/<gene>/<grouping>/<outliers_toggle>')
-@cache.memoize(timeout=3600)
+@htmlmin.exempt
+@http_cache('plots')
 def plot_snATAC_box(ensemble, gene, grouping, outliers_toggle):
 
     if outliers_toggle == 'outliers':
@@ -269,7 +275,7 @@ def plot_snATAC_box(ensemble, gene, grouping, outliers_toggle):
         return get_snATAC_box(ensemble, gene, grouping, outliers)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_snATAC_box): {}".format(e))
-        return 'Failed to produce snATAC normalized counts box plot. Contact maintainer.'
+        return 'Failed to produce snATAC normalized counts box plot. Contact maintainer.', 500
 
 
 # @frontend.route('/plot/box_combined/<methylation_type>/<gene_mmu>/<gene_hsa>/<level>/<outliers_toggle>')
@@ -287,6 +293,8 @@ def plot_snATAC_box(ensemble, gene, grouping, outliers_toggle):
 
 
 @frontend.route('/plot/methylation/heat/<ensemble>/<methylation_type>/<grouping>/<clustering>/<level>/<ptile_start>/<ptile_end>')
+@htmlmin.exempt
+@http_cache('plots')
 def plot_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end):
 
     query = request.args.get('q', 'MustHaveAQueryString')
@@ -304,10 +312,12 @@ def plot_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pt
         return get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end, normalize_row, query)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_mch_heatmap): {}".format(e))
-        return 'Failed to produce mCH levels heatmap plot. Contact maintainer.'
+        return 'Failed to produce mCH levels heatmap plot. Contact maintainer.', 500
 
 
 @frontend.route('/plot/snATAC/heat/<ensemble>/<grouping>/<ptile_start>/<ptile_end>')
+@htmlmin.exempt
+@http_cache('plots')
 def plot_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end):
 
     query = request.args.get('q', 'MustHaveAQueryString')
@@ -323,7 +333,7 @@ def plot_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end):
         return get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_snATAC_heatmap): {}".format(e))
-        return 'Failed to produce snATAC normalized counts heatmap plot. Contact maintainer.'
+        return 'Failed to produce snATAC normalized counts heatmap plot. Contact maintainer.', 500
 
 
 # @frontend.route('/plot/heat_two_ensemble/<ensemble>/<methylation_type>/<level>/<ptile_start>/<ptile_end>')
@@ -340,6 +350,7 @@ def plot_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end):
 #         return 'Failed to produce orthologous mCH levels heatmap plot. Contact maintainer.'
 
 @frontend.route('/gene/names')
+@http_cache('options')
 def search_gene_by_name():
     query = request.args.get('q', 'MustHaveAQueryString')
     if query == 'none' or query == '':
@@ -350,6 +361,7 @@ def search_gene_by_name():
 
 
 @frontend.route('/gene/names/exact')
+@http_cache('options')
 def search_gene_by_name_exact():
     query = request.args.get('q', 'MustHaveAQueryString')
     if query == 'none' or query == '':
@@ -360,6 +372,7 @@ def search_gene_by_name_exact():
 
 
 @frontend.route('/gene/id')
+@http_cache('options')
 def search_gene_by_id():
     query = request.args.get('q', '')
     if query == 'none' or query == '':
@@ -370,6 +383,7 @@ def search_gene_by_id():
 
 
 @frontend.route('/methylation_tsne_options/<ensemble>')
+@http_cache('options')
 @cache.memoize(timeout=3600)
 def methylation_tsne_options(ensemble):
     if ensemble == None or ensemble == "":
@@ -379,6 +393,7 @@ def methylation_tsne_options(ensemble):
 
 
 @frontend.route('/snATAC_tsne_options/<ensemble>')
+@http_cache('options')
 @cache.memoize(timeout=3600)
 def snATAC_tsne_options(ensemble):
     if ensemble == None or ensemble == '':
@@ -388,6 +403,7 @@ def snATAC_tsne_options(ensemble):
 
 
 @frontend.route('/gene/modules')
+@http_cache('options')
 def gene_modules():
     query = request.args.get('q')
     if query == None or query == '':
@@ -397,8 +413,15 @@ def gene_modules():
 
 
 @frontend.route('/cluster/marker_genes/<ensemble>/<clustering>')
+@http_cache('summaries')
 def cluster_specific_marker_genes(ensemble, clustering):
-    return jsonify(get_cluster_marker_genes(ensemble, clustering))
+    data = get_cluster_marker_genes_json(ensemble, clustering)
+    if data is not None:
+        return current_app.response_class(data, mimetype='application/json')
+    data = get_cluster_marker_genes(ensemble, clustering)
+    if data is None:
+        abort(500, 'Failed to load the marker genes')
+    return jsonify(data)
 
 
 # Legacy code from when the browser was used to also display human data
@@ -413,9 +436,32 @@ def cluster_specific_marker_genes(ensemble, clustering):
 
 
 @frontend.route('/gene/corr/<ensemble>/<gene_id>')
-@cache.memoize(timeout=3600)
+@http_cache('summaries')
 def correlated_genes(ensemble, gene_id):
-    return jsonify(get_corr_genes(ensemble, gene_id))
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    page = max(request.args.get('page', 1, type=int), 1)
+    corr_genes = get_corr_genes(ensemble, gene_id, limit, page)
+    if corr_genes is None:
+        abort(500, 'Failed to load the correlated genes')
+    return jsonify(corr_genes)
+
+
+@frontend.route('/gene/corr_search/<ensemble>')
+@http_cache('summaries')
+def correlated_genes_search(ensemble):
+    """Genes correlated with the gene ids in "q" (space separated, averaged if several) or with a gene module."""
+    module = request.args.get('module', '')
+    if module:
+        gene_ids = [gene['gene_id'] for gene in get_genes_of_module(module)]
+    else:
+        gene_ids = request.args.get('q', '').split()
+    if not gene_ids:
+        return jsonify([])
+    k = min(request.args.get('k', 100, type=int), 1000)
+    corr_genes = search_corr_genes(ensemble, sorted(gene_ids), k)
+    if corr_genes is None:
+        abort(500, 'Failed to search the correlated genes')
+    return jsonify(corr_genes)
 
 
 @frontend.route('/plot/delete_cache/<ensemble>/<grouping>')
@@ -424,6 +470,14 @@ def delete_cluster_cache(ensemble, grouping):
     return (ensemble + " cluster cache cleared") 
 
 
+@frontend.route('/metrics/singleflight')
+@login_required
+@admin_required
+def singleflight_metrics():
+    """Counters of the single-flight memoized functions of this worker process (see singleflight.py)."""
+    return jsonify({'pid': os.getpid(), 'functions': singleflight.metrics()})
+
+
 @frontend.route('/submit_new_ensemble/<new_ensemble_name>/<new_datasets>')
 def submit_new_ensemble_request(new_ensemble_name, new_datasets):
     description = request.args.get('description', "")
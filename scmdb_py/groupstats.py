@@ -0,0 +1,148 @@
+"""Per-group statistics over integer group codes.
+
+Grouping columns (annotation, cluster, dataset, slice, ...) are encoded once per ensemble as integer codes keyed by
+cell_id. A request then only maps the cell_ids of its frame onto those codes and computes counts, sums, means,
+medians and quantiles with np.bincount or a single sort, instead of hashing string columns in a pandas groupby.
+
+Sums over the columns of a cells x genes matrix are computed for all genes at once with np.add.reduceat.
+
+Results follow pandas groupby(sort=False): groups are in order of first appearance in the frame, rows with a missing
+group are left out, missing values are skipped and the result is a Series indexed by group, named after the grouping.
+"""
+import numpy as np
+import pandas as pd
+
+
+class GroupCodes(object):
+    """Integer group code of each row, -1 for rows without a group.
+
+    Arguments:
+        codes (numpy.ndarray): int64 code of each row, indexing groups.
+        groups (pandas.Index): Group labels, named after the grouping column.
+        keys (numpy.ndarray): Optional key (cell_id) of each row, to align other frames with for_keys.
+    """
+
+    def __init__(self, codes, groups, keys=None):
+        # Codes are shared by cached objects, so they are read-only. Operations return new GroupCodes.
+        self.codes = np.asarray(codes, dtype=np.int64).view()
+        self.codes.flags.writeable = False
+        self.groups = groups
+        self._sorted_keys = None
+        self._key_order = None
+        if keys is not None:
+            keys = np.asarray(keys)
+            self._key_order = np.argsort(keys, kind='mergesort')
+            self._sorted_keys = keys[self._key_order]
+            self._key_order.flags.writeable = False
+            self._sorted_keys.flags.writeable = False
+
+    @classmethod
+    def from_values(cls, values, name=None, keys=None):
+        """Encode group labels, in order of first appearance. Missing labels get code -1."""
+        codes, uniques = pd.factorize(np.asarray(values), sort=False)
+        return cls(codes, pd.Index(uniques, name=name), keys)
+
+    @property
+    def num_groups(self):
+        return len(self.groups)
+
+    def take(self, indexer):
+        """Return the codes of a subset of rows, keeping only the groups present, in order of first appearance."""
+        codes = self.codes[indexer]
+        present = codes >= 0
+        used, first = np.unique(codes[present], return_index=True)
+        used = used[np.argsort(first, kind='mergesort')]
+
+        # The extra last entry maps code -1 to itself.
+        remap = np.full(self.num_groups + 1, -1, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        return GroupCodes(remap[codes], self.groups[used])
+
+    def positions(self, keys):
+        """Return the row of each key (cell_id), -1 for unknown keys."""
+        keys = np.asarray(keys)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._sorted_keys):
+            positions = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+            found = self._sorted_keys[positions] == keys
+            rows[found] = self._key_order[positions[found]]
+        return rows
+
+    def for_keys(self, keys):
+        """Return the codes of the rows with the given keys (cell_ids), -1 for unknown keys."""
+        rows = self.positions(keys)
+        codes = np.where(rows >= 0, self.codes[rows], -1)
+        return GroupCodes(codes, self.groups).take(slice(None))
+
+    def categorical(self):
+        """Return the group of each row as a pandas Categorical, missing for rows without a group."""
+        return pd.Categorical.from_codes(self.codes, self.groups)
+
+    def _valid(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        valid = (self.codes >= 0) & ~np.isnan(values)
+        return self.codes[valid], values[valid]
+
+    def _series(self, result):
+        return pd.Series(result, index=self.groups)
+
+    def count(self, values):
+        codes, _ = self._valid(values)
+        return self._series(np.bincount(codes, minlength=self.num_groups))
+
+    def sum(self, values):
+        codes, values = self._valid(values)
+        return self._series(np.bincount(codes, weights=values, minlength=self.num_groups))
+
+    def mean(self, values):
+        codes, values = self._valid(values)
+        counts = np.bincount(codes, minlength=self.num_groups)
+        sums = np.bincount(codes, weights=values, minlength=self.num_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._series(sums / counts)
+
+    def quantile(self, values, q=0.5):
+        """Quantile of each group with linear interpolation, like pandas. NaN for groups without values."""
+        codes, values = self._valid(values)
+        order = np.lexsort((values, codes))
+        values = values[order]
+
+        counts = np.bincount(codes, minlength=self.num_groups)
+        starts = np.cumsum(counts) - counts
+        result = np.full(self.num_groups, np.nan)
+        has_values = counts > 0
+        position = starts[has_values] + q * (counts[has_values] - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        result[has_values] = values[low] + (values[high] - values[low]) * (position - low)
+        return self._series(result)
+
+    def median(self, values):
+        return self.quantile(values, 0.5)
+
+    def _group_order(self):
+        """Rows sorted by group (stable, so in row order within a group) and the number of rows of each group."""
+        present = np.flatnonzero(self.codes >= 0)
+        order = present[np.argsort(self.codes[present], kind='mergesort')]
+        return order, np.bincount(self.codes[present], minlength=self.num_groups)
+
+    def split(self, values):
+        """Return the values of each group, in row order, as a list of arrays (one per group)."""
+        if not self.num_groups:
+            return []
+        order, counts = self._group_order()
+        return np.split(np.asarray(values)[order], np.cumsum(counts)[:-1])
+
+    def sums(self, matrix):
+        """Sum each column of a rows x columns matrix over the rows of each group, for all columns in one pass.
+
+        Returns:
+            numpy.ndarray: groups x columns sums. Missing values must be replaced (ie. by 0) beforehand.
+        """
+        matrix = np.asarray(matrix)
+        result = np.zeros((self.num_groups, matrix.shape[1]), dtype=np.float64)
+        order, counts = self._group_order()
+        nonempty = counts > 0
+        if len(order):
+            result[nonempty] = np.add.reduceat(matrix[order], (np.cumsum(counts) - counts)[nonempty], axis=0)
+        return result
@@ -0,0 +1,311 @@
+"""Background rendering of plots.
+
+Large scatter plots and heatmaps take tens of seconds and used to tie up a web worker for all that time. Clients can
+instead submit the URL of a plot route as a job and poll for it:
+
+    POST /jobs/plot                 url=/plot/methylation/heat/Ens1/mCH/cluster/null/original/0/100?q=...
+        -> 202 {"job_id": ..., "status": "queued", "status_url": ..., "result_url": ...}
+        The request needs the CSRF token of the page (csrf_token() in templates), in the X-CSRFToken header or the
+        csrf_token form field. A client may have at most JOBS_MAX_PENDING jobs queued or running, further ones are
+        answered with 429 Too Many Requests.
+    GET /jobs/<job_id>?wait=2       -> {"job_id": ..., "status": "queued" | "started" | "finished" | "failed"}
+        With wait, the request is held until the job is done or for at most wait seconds (JOBS_MAX_WAIT, a few
+        seconds: a held request occupies a web worker). Responses for unfinished jobs carry a Retry-After header
+        (JOBS_RETRY_AFTER seconds), clients poll again after it rather than holding long requests.
+    GET /jobs/<job_id>/result       -> the plot, as the plot route returns it. 202 while the job runs.
+
+Jobs run the plot route like a request would (before and after request handlers and error handlers included), as an
+anonymous client: a job is shared by every client submitting its URL, so it runs without their session. A route
+answering with another status than 200 (the plot routes answer their failures with 500) fails the job. The job id
+is derived from the data version and the URL: submitting the same plot again while it is rendered or while its
+result is kept returns the same job instead of rendering it again. Failed jobs are run again when resubmitted.
+
+Jobs run on the RQ queue configured in create_app (JOBS_BACKEND 'rq'), by workers started from the directory
+holding the scmdb_py package with
+
+    rq worker default
+
+or in a thread pool of the web process (JOBS_BACKEND 'thread', JOBS_THREADS threads), for local development and
+tests without Redis. The states of thread jobs are kept in the app cache, so the thread backend is refused (503) when
+the web server runs several processes (wsgi.multiprocess) and the cache is not shared between them (CACHE_TYPE
+'simple'): a poll reaching another process would not find the job. With 'auto' (the default), RQ is used whenever
+Redis answers, checked at each request, and threads otherwise. The JOBS_MAX_PENDING count is also kept in the app
+cache, so it is per process unless the cache is shared.
+"""
+import datetime
+import hashlib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from flask import Blueprint, abort, current_app, jsonify, request, url_for
+from flask_rq import get_queue
+from redis.exceptions import RedisError
+from werkzeug.exceptions import HTTPException
+
+from . import cache, catalog
+
+jobs = Blueprint('jobs', __name__)
+
+# Routes that can be run as jobs.
+job_endpoints = ('frontend.plot_methylation_scatter',
+                 'frontend.plot_snATAC_scatter',
+                 'frontend.plot_mch_heatmap',
+                 'frontend.plot_snATAC_heatmap',
+                 'frontend.plot_mch_box',
+                 'frontend.plot_snATAC_box')
+
+
+def render(app, path):
+    """Run the route of a path (with its query string) as an anonymous request and return the response body.
+
+    Raises RuntimeError if the route does not answer with 200, so that the job fails.
+    """
+    with app.test_request_context(path):
+        response = app.full_dispatch_request()
+        if response.status_code != 200:
+            raise RuntimeError('{} answered with {}'.format(path, response.status_code))
+        return response.get_data(as_text=True)
+
+
+_worker_app = None
+
+
+def render_job(path):
+    """Job function of the RQ backend, run by RQ workers. Creates the app once per worker process."""
+    global _worker_app
+    if _worker_app is None:
+        from . import create_app
+        _worker_app = create_app()
+    return render(_worker_app, path)
+
+
+class ThreadJobs(object):
+    """Jobs run in a thread pool of the web process. Their states and results are kept in the app cache."""
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=app.config['JOBS_THREADS'])
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def _set(self, job_id, outcome, timeout):
+        with self.app.app_context():
+            cache.set('job/' + job_id, outcome, timeout=timeout)
+
+    def _run(self, job_id, path):
+        self._set(job_id, {'status': 'started'}, self.app.config['JOBS_TIMEOUT'])
+        try:
+            outcome = {'status': 'finished', 'result': render(self.app, path)}
+        except Exception as e:
+            now = datetime.datetime.now()
+            print("[{}] ERROR in app(ThreadJobs): {} failed: {}".format(str(now), path, e))
+            sys.stdout.flush()
+            outcome = {'status': 'failed', 'error': str(e)}
+        self._set(job_id, outcome, self.app.config['JOBS_RESULT_TIMEOUT'])
+        with self.lock:
+            self.futures.pop(job_id, None)
+
+    def submit(self, job_id, path):
+        with self.lock:
+            outcome = cache.get('job/' + job_id)
+            # A failed job is run again rather than its failure kept for JOBS_RESULT_TIMEOUT.
+            if job_id in self.futures or (outcome is not None and outcome['status'] != 'failed'):
+                return
+            self._set(job_id, {'status': 'queued'}, self.app.config['JOBS_TIMEOUT'])
+            self.futures[job_id] = self.executor.submit(self._run, job_id, path)
+
+    def status(self, job_id):
+        outcome = cache.get('job/' + job_id)
+        if outcome is not None:
+            return outcome['status']
+        # The entry may have been evicted from a bounded cache while the job runs.
+        future = self.futures.get(job_id)
+        if future is not None:
+            return 'started' if future.running() else 'queued'
+        return None
+
+    def result(self, job_id):
+        outcome = cache.get('job/' + job_id)
+        return outcome.get('result') if outcome is not None else None
+
+
+class RQJobs(object):
+    """Jobs run by RQ workers. Results are kept in Redis by RQ."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def queue(self):
+        return get_queue(self.app.config['JOBS_QUEUE'])
+
+    def submit(self, job_id, path):
+        queue = self.queue()
+        job = queue.fetch_job(job_id)
+        if job is not None and job.get_status() in ('queued', 'started', 'finished'):
+            return
+        queue.enqueue_call(render_job, args=(path,), job_id=job_id, timeout=self.app.config['JOBS_TIMEOUT'],
+                           result_ttl=self.app.config['JOBS_RESULT_TIMEOUT'])
+
+    def status(self, job_id):
+        job = self.queue().fetch_job(job_id)
+        return job.get_status() if job is not None else None
+
+    def result(self, job_id):
+        job = self.queue().fetch_job(job_id)
+        return job.result if job is not None else None
+
+
+def redis_available():
+    try:
+        return bool(get_queue().connection.ping())
+    except RedisError:
+        return False
+
+
+def shared_cache(app):
+    """Whether the app cache is shared by the processes of the web server (ie. redis, not the per-process simple)."""
+    return app.config.get('CACHE_TYPE', 'simple').rsplit('.', 1)[-1] not in ('simple', 'null')
+
+
+def backend():
+    """Return the job backend for the current request, creating it on first use.
+
+    With JOBS_BACKEND 'auto', Redis is checked at each call rather than once, so a process does not keep running jobs
+    in threads after Redis was briefly unavailable. Aborts with 503 when the thread backend would be used by a
+    multi-process server without a shared cache.
+    """
+    app = current_app._get_current_object()
+    kind = app.config.get('JOBS_BACKEND', 'auto')
+    if kind == 'auto':
+        kind = 'rq' if redis_available() else 'thread'
+    if kind == 'thread' and request.environ.get('wsgi.multiprocess', False) and not shared_cache(app):
+        abort(503, 'Background jobs need Redis, or a cache shared by the processes of the server')
+
+    backends = app.extensions.setdefault('scmdb_jobs', {})
+    job_backend = backends.get(kind)
+    if job_backend is None:
+        job_backend = backends.setdefault(kind, RQJobs(app) if kind == 'rq' else ThreadJobs(app))
+    return job_backend
+
+
+def init_app(app):
+    app.config.setdefault('JOBS_BACKEND', 'auto')
+    app.config.setdefault('JOBS_QUEUE', 'default')
+    app.config.setdefault('JOBS_THREADS', 2)
+    app.config.setdefault('JOBS_TIMEOUT', 600)
+    app.config.setdefault('JOBS_RESULT_TIMEOUT', 3600)
+    app.config.setdefault('JOBS_MAX_WAIT', 5)
+    app.config.setdefault('JOBS_RETRY_AFTER', 2)
+    app.config.setdefault('JOBS_MAX_PENDING', 4)
+    app.register_blueprint(jobs)
+
+
+def plot_path(url):
+    """Return the path and query string of a plot route URL, relative to the app, or abort with 400."""
+    parts = urlsplit(url)
+    path = parts.path
+    if path.startswith('./'):
+        path = path[1:]
+    if request.script_root and path.startswith(request.script_root + '/'):
+        path = path[len(request.script_root):]
+    if not path.startswith('/'):
+        path = '/' + path
+    try:
+        endpoint, _ = current_app.url_map.bind('localhost').match(path)
+    except HTTPException:
+        abort(400, 'url is not a route of this site')
+    if endpoint not in job_endpoints:
+        abort(400, 'url is not a plot route')
+    return path + ('?' + parts.query if parts.query else '')
+
+
+def pending_jobs(job_backend, client):
+    """Return the ids of the jobs submitted by a client (remote address) that are queued or running."""
+    return [job_id for job_id in cache.get('jobs/client/' + client) or []
+            if job_backend.status(job_id) in ('queued', 'started')]
+
+
+def job_status(job_id, status, status_code=200):
+    """Return the JSON status response of a job, with a Retry-After header while it is queued or running."""
+    response = jsonify({'job_id': job_id,
+                        'status': status,
+                        'status_url': url_for('jobs.get_job', job_id=job_id),
+                        'result_url': url_for('jobs.get_job_result', job_id=job_id)})
+    response.status_code = status_code
+    if status in ('queued', 'started'):
+        response.headers['Retry-After'] = str(current_app.config['JOBS_RETRY_AFTER'])
+    return response
+
+
+@jobs.route('/jobs/plot', methods=['POST'])
+def submit_plot():
+    """Submit a plot route URL (form field, JSON field or query argument "url") as a job."""
+    data = request.get_json(silent=True) or {}
+    url = data.get('url') or request.values.get('url')
+    if not url:
+        abort(400, 'url is required')
+    path = plot_path(url)
+    key = '\n'.join([catalog.current_version(), path])
+    job_id = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    job_backend = backend()
+    client = request.remote_addr or ''
+    pending = pending_jobs(job_backend, client)
+    if job_id not in pending:
+        if len(pending) >= current_app.config['JOBS_MAX_PENDING']:
+            abort(429, 'Too many plots are being rendered for you, wait for them to finish')
+        pending.append(job_id)
+        cache.set('jobs/client/' + client, pending, timeout=current_app.config['JOBS_TIMEOUT'])
+
+    job_backend.submit(job_id, path)
+    return job_status(job_id, job_backend.status(job_id), 202)
+
+
+def find_job(job_id):
+    """Return the backend holding a job and the status of the job (None if it is unknown).
+
+    With 'auto', a job submitted to the other backend, before Redis became available or unavailable, is still found.
+    """
+    job_backend = backend()
+    status = job_backend.status(job_id)
+    if status is None:
+        for other in list(current_app.extensions.get('scmdb_jobs', {}).values()):
+            if other is job_backend:
+                continue
+            try:
+                status = other.status(job_id)
+            except RedisError:
+                continue
+            if status is not None:
+                return other, status
+    return job_backend, status
+
+
+@jobs.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Status of a job. With ?wait=seconds, wait until it is done (at most JOBS_MAX_WAIT seconds)."""
+    wait = min(max(request.args.get('wait', 0, type=float), 0), current_app.config['JOBS_MAX_WAIT'])
+    deadline = time.time() + wait
+    job_backend, status = find_job(job_id)
+    while status in ('queued', 'started') and time.time() < deadline:
+        time.sleep(0.25)
+        status = job_backend.status(job_id)
+    if status is None:
+        abort(404)
+    return job_status(job_id, status)
+
+
+@jobs.route('/jobs/<job_id>/result')
+def get_job_result(job_id):
+    """Result of a finished job, as the plot route returned it."""
+    job_backend, status = find_job(job_id)
+    if status is None:
+        abort(404)
+    if status == 'failed':
+        abort(500, 'The job failed')
+    if status != 'finished':
+        return job_status(job_id, status, 202)
+    return current_app.response_class(job_backend.result(job_id), mimetype='text/html')
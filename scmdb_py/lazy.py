@@ -0,0 +1,87 @@
+"""Lazy imports of the scientific stack.
+
+numpy, pandas, plotly and colorlover take seconds to import, and importing content.py (which frontend.py does at
+app creation) used to import all of them. Every mod_wsgi worker spawn or reload paid for it before serving any
+request, even /login. Modules now bind them with lazy_import:
+
+    np = lazy_import('numpy')
+
+which returns a placeholder module that imports the real one on first attribute access, ie. when a data route first
+runs. Their attributes are then copied onto the placeholder so later accesses cost no more than with a normal import.
+
+preload() imports all of them at once. create_app calls it according to PRELOAD_MODULES:
+
+    False: import on first use (default).
+    True: import in create_app, as before.
+    'background': import in a background thread started by create_app, so the worker serves requests that don't need
+        them right away. Requests that need a module while it is being imported wait for the import to finish.
+"""
+import datetime
+import importlib
+import sys
+import threading
+import time
+import types
+
+_lazy_modules = []
+
+
+class LazyModule(types.ModuleType):
+    """Placeholder for a module, imported on first attribute access."""
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update((key, value) for key, value in module.__dict__.items() if key != '__name__')
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        # Only called for attributes missing from the placeholder: before the import, and for submodules imported
+        # after it (ie. pyarrow.parquet).
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<lazy module {!r} ({})>'.format(
+            self.__name__, 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded')
+
+
+def lazy_import(name):
+    """Return a module, imported on first attribute access unless it was imported already."""
+    if name in sys.modules:
+        return sys.modules[name]
+    module = LazyModule(name)
+    _lazy_modules.append(module)
+    return module
+
+
+def preload():
+    """Import all modules bound with lazy_import.
+
+    Returns:
+        float: Seconds spent.
+    """
+    start = time.time()
+    for module in list(_lazy_modules):
+        module._load()
+    elapsed = time.time() - start
+    now = datetime.datetime.now()
+    print("[{}] Preloaded {} modules in {:.2f} s".format(str(now), len(_lazy_modules), elapsed))
+    sys.stdout.flush()
+    return elapsed
+
+
+def preload_in_background():
+    """Run preload in a daemon thread and return the thread."""
+    thread = threading.Thread(target=preload, name='preload')
+    thread.daemon = True
+    thread.start()
+    return thread
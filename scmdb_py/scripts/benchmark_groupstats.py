@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Benchmark the groupstats kernel against the pandas groupby path it replaces.
+
+    benchmark_groupstats.py --cells 100000 --groups 40 --repeat 20
+
+Builds a synthetic gene frame like get_gene_methylation returns (cell_id, string annotation column with missing
+values, mCH level) and times, per request:
+
+    pandas: fillna on the grouping column, then groupby(sort=False) median/mean/count, and the per-record loop
+        that built the box plot traces.
+    groupstats: aligning the frame with ensemble-level codes by cell_id (GroupCodes.for_keys), then
+        median/mean/count and split. Encoding the ensemble (once per ensemble in the app) is timed separately.
+
+Results of both paths are compared before timing.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from package_modules import load_module
+
+groupstats = load_module('groupstats')
+
+
+def make_frame(num_cells, num_groups, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = np.array(['cluster_{}'.format(i) for i in range(num_groups)] + [None], dtype=object)
+    df = pd.DataFrame({'cell_id': rng.permutation(num_cells) + 1,
+                       'annotation': labels[rng.randint(0, len(labels), num_cells)],
+                       'mCH/CH_original': rng.rand(num_cells)})
+    df.loc[rng.rand(num_cells) < 0.05, 'mCH/CH_original'] = np.nan
+    return df
+
+
+def pandas_path(df):
+    df = df.fillna({'annotation': 'None'})
+    grouped = df.groupby('annotation', sort=False)['mCH/CH_original']
+    result = grouped.median(), grouped.mean(), grouped.count()
+    traces = {}
+    for point in df.to_dict('records'):
+        traces.setdefault(point['annotation'], []).append(point['mCH/CH_original'])
+    return result, traces
+
+
+def groupstats_path(ensemble_codes, df):
+    groups = ensemble_codes.for_keys(df['cell_id'].values)
+    values = df['mCH/CH_original'].values
+    result = groups.median(values), groups.mean(values), groups.count(values)
+    traces = dict(zip(groups.groups, groups.split(values)))
+    return result, traces
+
+
+def encode(df):
+    return groupstats.GroupCodes.from_values(df['annotation'].fillna('None').values, name='annotation',
+                                             keys=df['cell_id'].values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cells', type=int, default=100000, help='Number of cells.')
+    parser.add_argument('--groups', type=int, default=40, help='Number of groups.')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs of each path.')
+    args = parser.parse_args()
+
+    df = make_frame(args.cells, args.groups)
+    ensemble_codes = encode(df)
+    # Requests see the frame in a different order than the ensemble, ie. sorted by annotation.
+    request_df = df.sample(frac=1, random_state=1)
+
+    (expected, expected_traces), (result, traces) = pandas_path(request_df), groupstats_path(ensemble_codes, request_df)
+    for a, b in zip(expected, result):
+        assert list(a.index) == list(b.index) and np.allclose(a.values, b.values, equal_nan=True)
+    assert all(np.allclose(expected_traces[group], traces[group], equal_nan=True) for group in expected_traces)
+
+    timings = [
+        ('encode ensemble (once)', timeit.repeat(lambda: encode(df), number=1, repeat=args.repeat)),
+        ('pandas groupby + records', timeit.repeat(lambda: pandas_path(request_df), number=1, repeat=args.repeat)),
+        ('groupstats', timeit.repeat(lambda: groupstats_path(ensemble_codes, request_df), number=1, repeat=args.repeat)),
+    ]
+    print('{} cells, {} groups, best of {}'.format(args.cells, args.groups, args.repeat))
+    for name, times in timings:
+        print('{:<30}{:>10.2f} ms'.format(name, min(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
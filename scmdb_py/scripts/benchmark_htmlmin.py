@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Benchmark the CPU HTML minification costs per plot request.
+
+    benchmark_htmlmin.py --points 50000 --traces 20 --repeat 5
+
+Builds a synthetic plot fragment like the /plot routes return (a plotly <div> and the <script> holding the JSON of
+Scattergl traces with x, y and hover text for every cell) and times, per request:
+
+    minify: decoding the body, the htmlmin parser over it and encoding the result, as Flask-HTMLmin did for every
+        text/html response.
+    cached page: hashing a page and looking up its minified form, as SelectiveHTMLMIN does for pages rendered from
+        templates after the first request.
+
+Exempt plot views (@htmlmin.exempt) skip minification, so the minify time is the CPU saved per plot request. The
+bytes minification removes from the fragment are printed as well.
+"""
+import argparse
+import hashlib
+import json
+import timeit
+
+import numpy as np
+from htmlmin import Minifier
+
+# Options of Flask-HTMLmin.
+minifier = Minifier(remove_comments=True, reduce_empty_attributes=True, remove_optional_attribute_quotes=False)
+
+
+def make_fragment(num_points, num_traces, seed=0):
+    rng = np.random.RandomState(seed)
+    traces = []
+    for i, points in enumerate(np.array_split(np.arange(num_points), num_traces)):
+        traces.append({'type': 'scattergl',
+                       'mode': 'markers',
+                       'name': 'cluster_{}'.format(i),
+                       'x': np.round(rng.randn(len(points)) * 20, 4).tolist(),
+                       'y': np.round(rng.randn(len(points)) * 20, 4).tolist(),
+                       'text': ['Annotation: mL2/3<br>Cluster: {}<br>Cell: CEMBA_{}'.format(i, p) for p in points],
+                       'marker': {'size': 4, 'opacity': 0.8}})
+    layout = {'height': 550, 'hovermode': 'closest', 'legend': {'orientation': 'h'}}
+    plot_id = 'b5e8e9f2-3a3c-4f9a-9a0e-6c1c2b2f4d11'
+    return ('<div id="{0}" style="height: 100%; width: 100%;" class="plotly-graph-div"></div>'
+            '<script type="text/javascript">window.PLOTLY_ENV=window.PLOTLY_ENV || {{}};'
+            'Plotly.newPlot("{0}", {1}, {2}, {{"displaylogo": false}})</script>').format(
+                plot_id, json.dumps(traces, separators=(',', ':')), json.dumps(layout, separators=(',', ':')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=50000, help='Number of cells in the plot.')
+    parser.add_argument('--traces', type=int, default=20, help='Number of traces (groups).')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each path.')
+    args = parser.parse_args()
+
+    fragment = make_fragment(args.points, args.traces)
+    body = fragment.encode('utf-8')
+    minified = minifier.minify(fragment)
+    cached = {hashlib.sha1(body).hexdigest(): minified}
+
+    def minify():
+        return minifier.minify(body.decode('utf-8')).encode('utf-8')
+
+    def cached_page():
+        return cached.get(hashlib.sha1(body).hexdigest()).encode('utf-8')
+
+    timings = [
+        ('minify', timeit.repeat(minify, number=1, repeat=args.repeat)),
+        ('cached page', timeit.repeat(cached_page, number=1, repeat=args.repeat)),
+    ]
+    print('{} points, {} traces, {:.1f} MB fragment, best of {}'.format(
+        args.points, args.traces, len(fragment) / 1e6, args.repeat))
+    for name, times in timings:
+        print('{:<30}{:>10.2f} ms'.format(name, min(times) * 1000))
+    print('{:<30}{:>10} bytes'.format('removed by minify', len(fragment) - len(minified)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Build the static asset bundles ahead of time.
+
+    build_assets.py
+    build_assets.py --output scmdb_py/static/dist --no-brotli
+
+For each bundle of bundles.py, the source files are concatenated and minified (jsmin or cssmin, as configured for the
+bundle) and written to the output directory (static/dist by default) as <name>.<hash>.<ext>, where hash is taken from
+the content, so a file never changes under a given name. Each file is also written precompressed as .gz (gzip level
+9) and .br (brotli quality 11, if the brotli package is installed). manifest.json maps bundle names to files and
+their encodings; the app reads it at startup (see assets.AssetManifest) and serves the files with immutable caching.
+
+Run it on deployment, before starting the app. Files of previous builds are kept for pages cached by clients, use
+--clean to remove them.
+
+Exit codes: 0 success, 2 usage error, 4 missing source file.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+EXIT_OK = 0
+EXIT_USAGE = 2
+EXIT_NO_DATA = 4
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from package_modules import load_module, package_dir
+
+bundles = load_module('bundles')
+
+
+def find_source(filename):
+    """Return the path of a source file in the source directories of bundles.py, or None."""
+    for directory in bundles.source_dirs:
+        path = os.path.join(package_dir, directory, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def minify(content, filters):
+    if filters == 'jsmin':
+        from jsmin import jsmin
+        return jsmin(content)
+    if filters == 'cssmin':
+        from cssmin import cssmin
+        return cssmin(content)
+    return content
+
+
+def build_bundle(name, files, filters, output, output_dir, use_brotli=True):
+    """Build one bundle.
+
+    Returns:
+        dict: Manifest entry of the bundle, {"file": ..., "encodings": [...]}.
+    """
+    parts = []
+    for filename in files:
+        path = find_source(filename)
+        if path is None:
+            raise IOError('{}: source file {} not found'.format(name, filename))
+        with open(path, encoding='utf-8') as source:
+            parts.append(source.read())
+    extension = os.path.splitext(output)[1]
+    # Scripts that do not end with a semicolon must not run into the next one.
+    separator = ';\n' if extension == '.js' else '\n'
+    data = minify(separator.join(parts), filters).encode('utf-8')
+
+    base = os.path.splitext(os.path.basename(output))[0]
+    filename = '{}.{}{}'.format(base, hashlib.sha256(data).hexdigest()[:12], extension)
+    path = os.path.join(output_dir, filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    encodings = []
+    if use_brotli and brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+        encodings.append('br')
+    with open(path + '.gz', 'wb') as f:
+        # mtime=0 so that rebuilding the same content writes the same bytes.
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    encodings.append('gzip')
+    print('{:<28}{:<40}{:>10} bytes'.format(name, filename, len(data)))
+    return OrderedDict([('file', filename), ('encodings', encodings)])
+
+
+def clean(output_dir, manifest):
+    """Remove the files of previous builds that are not in the manifest."""
+    keep = set(['manifest.json'])
+    for entry in manifest.values():
+        keep.add(entry['file'])
+        keep.update(entry['file'] + suffix for suffix in ('.br', '.gz'))
+    for filename in os.listdir(output_dir):
+        if filename not in keep:
+            os.remove(os.path.join(output_dir, filename))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=os.path.join(package_dir, 'static', 'dist'),
+                        help='Output directory (default: static/dist).')
+    parser.add_argument('--no-brotli', action='store_true', help='Do not write .br files.')
+    parser.add_argument('--clean', action='store_true', help='Remove files of previous builds.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(args.output))):
+        print('Parent directory of {} does not exist.'.format(args.output))
+        return EXIT_USAGE
+    os.makedirs(args.output, exist_ok=True)
+    if not args.no_brotli and brotli is None:
+        print('brotli is not installed, writing gzip files only.')
+
+    manifest = OrderedDict()
+    try:
+        for name, (files, filters, output) in bundles.bundles.items():
+            manifest[name] = build_bundle(name, files, filters, output, args.output, not args.no_brotli)
+    except IOError as e:
+        print(e)
+        return EXIT_NO_DATA
+
+    # Written last and replaced atomically, so a running app never reads a manifest listing missing files.
+    manifest_path = os.path.join(args.output, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    if args.clean:
+        clean(args.output, manifest)
+    print('Wrote ' + manifest_path)
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
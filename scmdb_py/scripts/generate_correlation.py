@@ -1,20 +1,44 @@
 #!/usr/bin/env python3
 """Generate mCH correlation with other genes.
 
-This script will ask for an input folder, which contains files of mCH data for each gene.
-Correlation will be computed for other genes and a file named after the input gene ID will be output into the specified
-    output folder.
+Spearman correlation is computed between all genes of an ensemble and the top correlated genes of each gene are
+loaded into the <ensemble>_correlated_genes table.
+
+    generate_correlation.py ingest /path/to/mCH_files/ matrix.npy
+    generate_correlation.py correlate matrix.npy Ens1 Ens2 --config scmdb_py/default_config.py
+    generate_correlation.py update matrix.npy Ens1 --state-dir corr_state/ --config scmdb_py/default_config.py
+
+The ingest command loads the *_mCH.txt file of each gene into an on-disk cells x genes matrix and can be resumed.
+The correlate command restricts the matrix to the cells of each ensemble, computes correlations and loads the results.
+The update command keeps state between runs and, when cells are added to an ensemble, only recomputes what changed.
+
+Exit codes: 0 success, 2 usage error, 3 configuration error, 4 no data, 5 database error.
+
+Correlations are computed as Pearson correlation of ranks. Each gene is ranked once over the cells it has data for,
+then genes are correlated tile by tile with float32 matrix products, using pairwise masks for missing values.
+Only the top k partners of each gene are kept, so memory use depends on the tile size and not on the number of genes.
 """
+import argparse
+import json
 import os
-import time
 import sys
+import time
 import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
 from glob import glob
-from multiprocessing.dummy import Pool as ThreadPool
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
+from sqlalchemy import Column, Float, Index, MetaData, String, Table, create_engine, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
 
-df_current = None
+EXIT_OK = 0
+EXIT_USAGE = 2
+EXIT_CONFIG = 3
+EXIT_NO_DATA = 4
+EXIT_DATABASE = 5
 
 
 def find_target_files(directory):
@@ -31,76 +55,1014 @@ def find_target_files(directory):
     return glob(os.path.join(directory, '*_mCH.txt'))
 
 
-def process_gene_samples(csv_path):
-    """Read into DataFrame and pivot mCH data files.
+mch_file_columns = ['geneId', 'samp', 'original', 'normalized']
+mch_file_dtypes = {'geneId': str, 'samp': str, 'original': np.float32, 'normalized': np.float32}
+
+
+def read_gene_file(csv_path, columns=('geneId', 'samp', 'original')):
+    """Read a gene mCH file with typed columns.
 
     Arguments:
         csv_path (str): Target path of gene mCH CSV file.
+        columns (tuple): Columns to parse.
 
     Returns:
-        pandas.DataFrame: pivoted dataframe.
+        pandas.DataFrame
     """
-    # Progress indicator.
-    print('.', end='')
-    sys.stdout.flush()
-
-    df_gene = pd.read_csv(
+    return pd.read_csv(
         csv_path,
         sep='\t',
         header=None,
-        names=['geneId', 'samp', 'original', 'normalized'])
-    df_pivot = df_gene.pivot(index='geneId', values='original', columns='samp')
-    df_pivot.index.name = None
-    return df_pivot
+        names=mch_file_columns,
+        usecols=list(columns),
+        dtype={column: mch_file_dtypes[column] for column in columns},
+        engine='c')
 
 
-def wizard():
-    print(
-        'This script generates a correlation matrix for the mCH data of a species.'
-    )
-    print('Use absolute paths with ending slash please.')
-    print('-' * 10)
-    print('Input path containing mCH files for that species:')
-    input_path = input('> ')
-    targets = find_target_files(input_path)
-    print('-' * 10 +
-          '\nFound {} files. Please ENTER to continue, Ctrl+C to quit.'.format(
-              len(targets)))
-    input('> ')
-    if len(targets) == 0:
-        print('Nothing to do.')
-        exit()
-
-    print('Gathering sample data', end='')
-    pivot_pool = ThreadPool(32)
-    pivot_results = pivot_pool.map(process_gene_samples, targets)
-    pivot_pool.close()
-    pivot_pool.join()
-
-    print('\nConcatenating dataframes...', end='')
-    sys.stdout.flush()
+def read_file_cells(csv_path):
+    """Return the set of cells (samples) in a gene mCH file."""
+    return set(read_gene_file(csv_path, columns=('samp',))['samp'])
+
+
+_worker = {}
+
+
+def _init_ingest_worker(matrix_path, cells):
+    _worker['matrix'] = np.load(matrix_path, mmap_mode='r+')
+    _worker['cell_index'] = pd.Series(np.arange(len(cells)), index=cells)
+
+
+def ingest_gene_file(task):
+    """Pivot one gene mCH file into its column of the cells x genes matrix.
+
+    Arguments:
+        task (tuple): (column index of the gene, path of the gene mCH file)
+
+    Returns:
+        tuple: column index, gene id and number of rows read.
+    """
+    gene_idx, csv_path = task
+    matrix = _worker['matrix']
+
+    df_gene = read_gene_file(csv_path)
+    rows = _worker['cell_index'].reindex(df_gene['samp'].values).values
+    found = ~np.isnan(rows)
+
+    column = np.full(matrix.shape[0], np.nan, dtype=np.float32)
+    column[rows[found].astype(np.int64)] = df_gene['original'].values[found]
+    matrix[:, gene_idx] = column
+
+    gene_id = df_gene['geneId'].iloc[0] if len(df_gene) else os.path.basename(csv_path)[:-len('_mCH.txt')]
+    return gene_idx, gene_id, len(df_gene)
+
+
+def save_manifest(manifest, manifest_path):
+    """Atomically write the ingestion manifest (checkpoint)."""
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def ingest(input_path, matrix_path, processes=None, checkpoint_every=500):
+    """Load all gene mCH files of a directory into an on-disk cells x genes float32 matrix.
+
+    Files are parsed by a process pool, each worker writes its gene's column directly into the matrix, which is a
+    Fortran-ordered .npy file so every column is contiguous on disk. Progress is checkpointed to a JSON manifest
+    next to the matrix (matrix_path + '.json'); running again with the same paths resumes an interrupted load.
+
+    Arguments:
+        input_path (str): Directory containing *_mCH.txt files.
+        matrix_path (str): Path of the .npy matrix to write.
+        processes (int): Number of worker processes. Defaults to the number of CPUs.
+        checkpoint_every (int): Number of genes between manifest checkpoints.
+
+    Returns:
+        dict: Manifest with keys files, cells, genes (gene id of each column, None if not loaded) and completed.
+    """
+    manifest_path = matrix_path + '.json'
+    targets = sorted(find_target_files(input_path))
+
+    manifest = None
+    if os.path.exists(manifest_path) and os.path.exists(matrix_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['files'] != targets:
+            print('Input files changed since the last run, starting over.')
+            manifest = None
+        else:
+            print('Resuming: {}/{} genes already loaded.'.format(len(manifest['completed']), len(targets)))
+
+    pool = Pool(processes)
+    try:
+        if manifest is None:
+            print('Collecting cells from {} files...'.format(len(targets)))
+            cells = set()
+            for file_cells in pool.imap_unordered(read_file_cells, targets, chunksize=16):
+                cells.update(file_cells)
+            cells = sorted(cells)
+            matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32,
+                                               shape=(len(cells), len(targets)), fortran_order=True)
+            del matrix
+            manifest = {'files': targets, 'cells': cells, 'genes': [None] * len(targets), 'completed': []}
+            save_manifest(manifest, manifest_path)
+    finally:
+        pool.close()
+        pool.join()
+
+    completed = set(manifest['completed'])
+    pending = [(i, path) for i, path in enumerate(targets) if i not in completed]
+
     start = timeit.default_timer()
-    concat_result = pd.concat(pivot_results)
-    stop = timeit.default_timer()
-    print('done in {} seconds.'.format(stop - start))
-    output_path = 'concat_{}.csv'.format(int(time.time()))
-    print('Writing concatenated DFs to {}...'.format(output_path))
-    concat_result.to_csv(output_path, sep='\t', na_rep='NA')
+    num_rows = 0
+    pool = Pool(processes, initializer=_init_ingest_worker, initargs=(matrix_path, manifest['cells']))
+    try:
+        for done, (gene_idx, gene_id, rows) in enumerate(pool.imap_unordered(ingest_gene_file, pending, chunksize=4), 1):
+            manifest['genes'][gene_idx] = gene_id
+            manifest['completed'].append(gene_idx)
+            num_rows += rows
+
+            if done % checkpoint_every == 0 or done == len(pending):
+                save_manifest(manifest, manifest_path)
+            elapsed = max(timeit.default_timer() - start, 1e-6)
+            rate = done / elapsed
+            print('\rLoaded {}/{} genes, {:.1f} genes/s, {:.0f} rows/s, {:.0f} s remaining'.format(
+                len(manifest['completed']), len(targets), rate, num_rows / elapsed, (len(pending) - done) / rate), end='')
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        save_manifest(manifest, manifest_path)
+    print()
+
+    return manifest
+
+
+def rank_rows(values, out=None, block_size=1024, columns=None):
+    """Rank each row (gene) of a genes x cells matrix over its non-missing cells.
+
+    Ties get their average rank and missing values stay NaN. Ranks are centred and scaled by the number of ranked
+    cells so they lie in [-0.5, 0.5], which keeps float32 sums accurate.
+
+    Arguments:
+        values (array): genes x cells matrix, may be a numpy memmap.
+        out (array): Optional float32 genes x cells array (ie. memmap) to write the ranks into.
+        block_size (int): Number of genes ranked at a time.
+        columns (array): Optional indices of the cells to rank over. Other cells are left out of the result.
+
+    Returns:
+        numpy.ndarray: float32 genes x cells matrix of ranks.
+    """
+    num_cells = values.shape[1] if columns is None else len(columns)
+    if out is None:
+        out = np.empty((values.shape[0], num_cells), dtype=np.float32)
+
+    for start in range(0, values.shape[0], block_size):
+        block = np.asarray(values[start:start+block_size], dtype=np.float64)
+        if columns is not None:
+            block = block[:, columns]
+        block = pd.DataFrame(block).rank(axis=1)
+        num_ranked = block.count(axis=1).values[:, None]
+        ranks = (block.values - (num_ranked + 1) / 2) / np.maximum(num_ranked, 1)
+        out[start:start+block_size] = ranks.astype(np.float32)
+
+    return out
+
+
+def correlate_blocks(a, b, min_cells=10):
+    """Pearson correlation between every row of a and every row of b, using only cells where both rows have data.
+
+    Arguments:
+        a (numpy.ndarray): float32 genes x cells block, NaN for missing values.
+        b (numpy.ndarray): float32 genes x cells block, NaN for missing values.
+        min_cells (int): Pairs with fewer shared cells get a NaN correlation.
+
+    Returns:
+        numpy.ndarray: float32 len(a) x len(b) correlation matrix.
+    """
+    mask_a = ~np.isnan(a)
+    mask_b = ~np.isnan(b)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if mask_a.all() and mask_b.all():
+            # No missing values: correlation is the dot product of standardized rows.
+            za = a - a.mean(axis=1, keepdims=True)
+            za /= np.sqrt((za * za).sum(axis=1, keepdims=True))
+            zb = b - b.mean(axis=1, keepdims=True)
+            zb /= np.sqrt((zb * zb).sum(axis=1, keepdims=True))
+            corr = za @ zb.T
+            if a.shape[1] < min_cells:
+                corr[:] = np.nan
+            return corr
+
+        xa = np.where(mask_a, a, 0).astype(np.float32)
+        xb = np.where(mask_b, b, 0).astype(np.float32)
+        ma = mask_a.astype(np.float32)
+        mb = mask_b.astype(np.float32)
+
+        # Sums over the cells shared by each pair of rows.
+        n = ma @ mb.T
+        sum_a = xa @ mb.T
+        sum_b = ma @ xb.T
+        sum_aa = (xa * xa) @ mb.T
+        sum_bb = ma @ (xb * xb).T
+        sum_ab = xa @ xb.T
+
+        cov = sum_ab - sum_a * sum_b / n
+        var_a = sum_aa - sum_a * sum_a / n
+        var_b = sum_bb - sum_b * sum_b / n
+        corr = cov / np.sqrt(var_a * var_b)
+
+    corr[n < min_cells] = np.nan
+    return corr
+
+
+def update_top_k(top_corr, top_idx, rows, corr, col_offset, col_index=None):
+    """Merge a block of correlations into the running top k of each row.
+
+    Arguments:
+        top_corr (numpy.ndarray): genes x k correlations, modified in place.
+        top_idx (numpy.ndarray): genes x k partner gene indices, modified in place.
+        rows (slice): Rows of top_corr/top_idx the block belongs to. May also be an array of row indices.
+        corr (numpy.ndarray): Block of correlations, NaN for pairs to ignore.
+        col_offset (int): Gene index of the first column of the block.
+        col_index (numpy.ndarray): Gene index of each column of the block, for blocks of non-contiguous genes.
+    """
+    k = top_corr.shape[1]
+    if col_index is None:
+        col_index = np.arange(col_offset, col_offset + corr.shape[1])
+    block_idx = np.broadcast_to(np.asarray(col_index, dtype=np.int32), corr.shape)
+    candidate_corr = np.concatenate([top_corr[rows], np.where(np.isnan(corr), -np.inf, corr)], axis=1)
+    candidate_idx = np.concatenate([top_idx[rows], block_idx], axis=1)
+
+    best = np.argpartition(-candidate_corr, k - 1, axis=1)[:, :k]
+    row_numbers = np.arange(candidate_corr.shape[0])[:, None]
+    top_corr[rows] = candidate_corr[row_numbers, best]
+    top_idx[rows] = candidate_idx[row_numbers, best]
+
+
+def sort_top_k(top_idx, top_corr):
+    """Sort the partners of each gene, most correlated first, and mark empty slots with -1 and NaN."""
+    order = np.argsort(-top_corr, axis=1)
+    row_numbers = np.arange(top_corr.shape[0])[:, None]
+    top_corr = top_corr[row_numbers, order]
+    top_idx = top_idx[row_numbers, order]
+    missing = ~np.isfinite(top_corr)
+    top_idx[missing] = -1
+    top_corr[missing] = np.nan
+    return top_idx, top_corr
+
+
+def correlate_top_k(ranks, k=100, block_size=512, min_cells=10, absolute=False, progress=True):
+    """Find the k most correlated genes of every gene.
+
+    Arguments:
+        ranks (array): float32 genes x cells matrix of ranks from rank_rows, may be a numpy memmap.
+        k (int): Number of partners to keep for each gene.
+        block_size (int): Number of genes per tile. Memory use is about 12 * block_size * number of cells * 4 bytes.
+        min_cells (int): Minimum number of cells shared by two genes to correlate them.
+        absolute (bool): Rank partners by absolute correlation instead of correlation.
+        progress (bool): Print progress.
+
+    Returns:
+        numpy.ndarray: int32 genes x k partner gene indices, most correlated first. -1 where there are fewer than k partners.
+        numpy.ndarray: float32 genes x k correlations.
+    """
+    num_genes = ranks.shape[0]
+    k = min(k, num_genes - 1)
+    top_corr = np.full((num_genes, k), -np.inf, dtype=np.float32)
+    top_idx = np.full((num_genes, k), -1, dtype=np.int32)
+
+    starts = list(range(0, num_genes, block_size))
+    num_tiles = len(starts) * (len(starts) + 1) // 2
+    done = 0
+    for i, start_i in enumerate(starts):
+        rows_i = slice(start_i, min(start_i + block_size, num_genes))
+        block_i = np.asarray(ranks[rows_i], dtype=np.float32)
+        for start_j in starts[i:]:
+            rows_j = slice(start_j, min(start_j + block_size, num_genes))
+            block_j = block_i if start_j == start_i else np.asarray(ranks[rows_j], dtype=np.float32)
+
+            corr = correlate_blocks(block_i, block_j, min_cells)
+            if start_j == start_i:
+                np.fill_diagonal(corr, np.nan)
+            score = np.abs(corr) if absolute else corr
+
+            # Correlation is symmetric, so each tile updates both its rows and its columns.
+            update_top_k(top_corr, top_idx, rows_i, score, start_j)
+            if start_j != start_i:
+                update_top_k(top_corr, top_idx, rows_j, score.T, start_i)
+
+            done += 1
+            if progress:
+                print('\rCorrelating tiles: {}/{}'.format(done, num_tiles), end='')
+                sys.stdout.flush()
+    if progress:
+        print()
+
+    top_idx, top_corr = sort_top_k(top_idx, top_corr)
+
+    if absolute:
+        # Report the signed correlation of the selected partners.
+        for start in starts:
+            rows = slice(start, min(start + block_size, num_genes))
+            block = np.asarray(ranks[rows], dtype=np.float32)
+            for row, partners in zip(range(rows.start, rows.stop), top_idx[rows]):
+                valid = partners >= 0
+                top_corr[row, valid] = correlate_blocks(block[row - rows.start][None, :],
+                                                        np.asarray(ranks[partners[valid]], dtype=np.float32),
+                                                        min_cells)[0]
+
+    return top_idx, top_corr
+
+
+def write_top_k(output_path, genes, top_idx, top_corr):
+    """Write the top correlated genes of each gene as a tab separated file with columns gene1, gene2, correlation, rank."""
+    with open(output_path, 'w') as output:
+        output.write('gene1\tgene2\tcorrelation\trank\n')
+        for gene, partners, correlations in zip(genes, top_idx, top_corr):
+            for rank, (partner, correlation) in enumerate(zip(partners, correlations)):
+                if partner < 0:
+                    break
+                output.write('{}\t{}\t{:.6f}\t{}\n'.format(gene, genes[partner], correlation, rank + 1))
+
+# Incremental updates
+#
+# State of an ensemble is kept in <state dir>/<ensemble>/: state.json lists the method, genes and cells, and the top
+# partners of each gene are kept in top_idx.npy/top_corr.npy. Twice as many partners as reported are kept, so a gene
+# whose partners change can usually be updated without correlating it against every other gene again.
+#
+# pearson: Pearson correlation of mCH levels, from per pair sufficient statistics. New cells are added to the
+#   statistics of the pairs of genes that have data in them, so the cost of an update scales with the number of new
+#   cells. The statistics of a pair of genes i <= j are kept in packed float32 upper triangles (row-major, diagonal
+#   included): the number of shared cells (n.npy), the sum of products (sp.npy), and the sums and sums of squares of
+#   gene i (s_row.npy, ss_row.npy) and of gene j (s_col.npy, ss_col.npy) over the shared cells. That is 24 bytes per
+#   pair of genes, 4.8 GB for 20000 genes. Each update adds to them sums computed in float64.
+# spearman: Spearman correlation, as computed by the correlate command, from the ranks of each gene (ranks.npy).
+#   Only genes with data in the new cells are re-ranked, then their correlations with all genes are recomputed.
+#
+# Pearson and Spearman correlations of the same genes differ, so the method is recorded in the state, in the
+# <ensemble>_correlated_genes table and in the manifest of the normalized matrices. The update command does not
+# replace the correlations of an ensemble with ones computed with another method unless --rebuild is given.
+
+stat_names = ('n', 'sp', 's_row', 's_col', 'ss_row', 'ss_col')
+stats_layout = 'upper_triangle_float32'
+
+
+def read_state(state_path):
+    try:
+        with open(os.path.join(state_path, 'state.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_state(state, state_path, top_idx, top_corr):
+    """Save the top partners and then the state, so an interrupted save leaves the previous state.json pending."""
+    for name, values in (('top_idx', top_idx), ('top_corr', top_corr)):
+        np.save(os.path.join(state_path, name + '.tmp.npy'), values)
+        os.replace(os.path.join(state_path, name + '.tmp.npy'), os.path.join(state_path, name + '.npy'))
+    state['pending'] = False
+    save_manifest(state, os.path.join(state_path, 'state.json'))
+
+
+def row_blocks(rows, block_size):
+    return [rows[start:start+block_size] for start in range(0, len(rows), block_size)]
+
+
+def triangle_size(num_genes):
+    return num_genes * (num_genes + 1) // 2
+
+
+def triangle_index(i, j, num_genes):
+    """Position of the pairs of genes (i, j), i <= j, in a packed upper triangle."""
+    i = np.asarray(i, dtype=np.int64)
+    return i * num_genes - i * (i - 1) // 2 + (np.asarray(j, dtype=np.int64) - i)
+
+
+def accumulate_stats(stats, values, genes, columns, num_genes, block_size=512, progress=True):
+    """Add cells to the Pearson sufficient statistics of every pair of genes.
+
+    Arguments:
+        stats (dict): Packed upper triangles (float32 memmaps) of each statistic of stat_names, modified in place.
+        values (array): genes x cells matrix of mCH levels, NaN for missing values.
+        genes (numpy.ndarray): Sorted indices of the genes with data in the added cells.
+        columns (numpy.ndarray): Indices of the added cells in values.
+        num_genes (int): Number of genes of the triangles.
+        block_size (int): Number of genes per tile.
+        progress (bool): Print progress.
+    """
+    def load(rows):
+        block = np.asarray(values[rows], dtype=np.float64)[:, columns]
+        mask = ~np.isnan(block)
+        return np.where(mask, block, 0), mask.astype(np.float64)
+
+    blocks = row_blocks(genes, block_size)
+    for i, rows_i in enumerate(blocks):
+        x_i, m_i = load(rows_i)
+        for j in range(i, len(blocks)):
+            x_j, m_j = (x_i, m_i) if i == j else load(blocks[j])
+            first, second = np.meshgrid(rows_i, blocks[j], indexing='ij')
+            upper = first <= second
+            index = triangle_index(first[upper], second[upper], num_genes)
+            tile = {'n': m_i @ m_j.T,
+                    'sp': x_i @ x_j.T,
+                    's_row': x_i @ m_j.T,
+                    's_col': m_i @ x_j.T,
+                    'ss_row': (x_i * x_i) @ m_j.T,
+                    'ss_col': m_i @ (x_j * x_j).T}
+            for name, sums in tile.items():
+                stats[name][index] += sums[upper].astype(np.float32)
+        if progress:
+            print('\rAccumulating statistics: {}/{} blocks'.format(i + 1, len(blocks)), end='')
+            sys.stdout.flush()
+    if progress:
+        print()
+
+
+def stats_correlation(stats, rows, num_genes, min_cells=10):
+    """Pearson correlation of genes (rows) with every gene from the sufficient statistics.
+
+    Returns:
+        numpy.ndarray: float32 len(rows) x genes correlation matrix, NaN for pairs with fewer than min_cells cells.
+    """
+    rows = np.asarray(rows)[:, np.newaxis]
+    partners = np.arange(num_genes)[np.newaxis, :]
+    index = triangle_index(np.minimum(rows, partners), np.maximum(rows, partners), num_genes)
+    # Whether the gene of the row is the first gene (i) of each pair.
+    row_first = rows <= partners
+
+    def gather(name):
+        return np.asarray(stats[name][index.ravel()], dtype=np.float64).reshape(index.shape)
 
-    del pivot_results
+    def split(name):
+        """Statistic of the gene of the row and of its partner."""
+        of_first, of_second = gather(name + '_row'), gather(name + '_col')
+        return np.where(row_first, of_first, of_second), np.where(row_first, of_second, of_first)
 
-    print('Calculating correlations...', end='')
+    n = gather('n')
+    s, s_partner = split('s')
+    ss, ss_partner = split('ss')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = gather('sp') - s * s_partner / n
+        var = (ss - s * s / n) * (ss_partner - s_partner * s_partner / n)
+        corr = (cov / np.sqrt(var)).astype(np.float32)
+    corr[n < min_cells] = np.nan
+    return corr
+
+
+def ranks_correlation(ranks, rows, block_size=512, min_cells=10):
+    """Spearman correlation of genes (rows) with every gene from their ranks.
+
+    Returns:
+        numpy.ndarray: float32 len(rows) x genes correlation matrix.
+    """
+    block = np.asarray(ranks[rows], dtype=np.float32)
+    return np.concatenate([correlate_blocks(block, np.asarray(ranks[start:start+block_size], dtype=np.float32), min_cells)
+                           for start in range(0, ranks.shape[0], block_size)], axis=1)
+
+
+def refresh_top_k(top_idx, top_corr, affected, k, correlate_rows, block_size=512, partners_changed=True, progress=True):
+    """Update the top partners of each gene after the correlations of some genes changed.
+
+    Affected genes are correlated against all genes again. When partners_changed is set (Spearman), the
+    correlations of other genes with affected genes changed as well: their stale partners are dropped and the new
+    correlations merged in. This is exact as long as a gene keeps at least k unaffected partners, genes left with
+    fewer are correlated against all genes again.
+
+    Arguments:
+        top_idx (numpy.ndarray): int32 genes x keep partner indices from a previous run, -1 for empty slots.
+        top_corr (numpy.ndarray): float32 genes x keep correlations from a previous run, NaN for empty slots.
+        affected (numpy.ndarray): Indices of the genes whose correlations changed.
+        k (int): Number of partners that will be reported.
+        correlate_rows (function): Returns the len(rows) x genes correlation matrix of an array of gene indices.
+        block_size (int): Number of genes correlated at a time.
+        partners_changed (bool): Whether the correlations of other genes with affected genes changed.
+        progress (bool): Print progress.
+
+    Returns:
+        numpy.ndarray: int32 genes x keep partner gene indices, most correlated first.
+        numpy.ndarray: float32 genes x keep correlations.
+    """
+    num_genes, keep = top_idx.shape
+    is_affected = np.zeros(num_genes, dtype=bool)
+    is_affected[affected] = True
+
+    valid = top_idx >= 0
+    kept = valid & ~(partners_changed & is_affected[np.where(valid, top_idx, 0)])
+    recompute = is_affected | ((valid.sum(axis=1) == keep) & (kept.sum(axis=1) < k))
+    top_idx = np.where(kept, top_idx, -1).astype(np.int32)
+    top_corr = np.where(kept, top_corr, -np.inf).astype(np.float32)
+    top_idx[recompute] = -1
+    top_corr[recompute] = -np.inf
+    merge_rows = np.flatnonzero(~recompute)
+
+    blocks = row_blocks(np.flatnonzero(recompute), block_size)
+    for i, rows in enumerate(blocks):
+        corr = correlate_rows(rows)
+        corr[np.arange(len(rows)), rows] = np.nan
+        update_top_k(top_corr, top_idx, rows, corr, 0)
+
+        changed = is_affected[rows]
+        if partners_changed and changed.any() and len(merge_rows):
+            update_top_k(top_corr, top_idx, merge_rows, corr[changed][:, merge_rows].T, 0, col_index=rows[changed])
+        if progress:
+            print('\rUpdating partners: {}/{} blocks'.format(i + 1, len(blocks)), end='')
+            sys.stdout.flush()
+    if progress:
+        print()
+
+    return sort_top_k(top_idx, top_corr)
+
+
+def update_ensemble(state_path, matrix, genes, cell_names, columns, method, k, keep, block_size=512, min_cells=10,
+                    rebuild=False):
+    """Bring the correlations of an ensemble up to date with its cells.
+
+    Arguments:
+        state_path (str): State directory of the ensemble.
+        matrix (array): cells x genes matrix written by ingest.
+        genes (list): Gene id of each column of matrix.
+        cell_names (list): Names of the cells of the ensemble.
+        columns (list): Row of each cell of the ensemble in matrix.
+        method (str): 'pearson' or 'spearman'.
+        k (int): Number of partners that will be reported.
+        keep (int): Number of partners kept in the state.
+        block_size (int): Number of genes per tile.
+        min_cells (int): Minimum number of cells shared by two genes to correlate them.
+        rebuild (bool): Discard the existing state.
+
+    Returns:
+        numpy.ndarray: int32 genes x keep partner gene indices, most correlated first, or None if nothing changed.
+        numpy.ndarray: float32 genes x keep correlations.
+    """
+    if not os.path.exists(state_path):
+        os.makedirs(state_path)
+    num_genes = len(genes)
+    keep = min(keep, num_genes - 1)
+
+    state = None if rebuild else read_state(state_path)
+    if state is not None:
+        reason = None
+        if state.get('pending'):
+            reason = 'the previous update was interrupted'
+        elif state['method'] != method or state['genes'] != genes or state['keep'] != keep or state['min_cells'] != min_cells:
+            reason = 'the method, genes or parameters changed'
+        elif method == 'pearson' and state.get('stats') != stats_layout:
+            reason = 'the statistics were saved in an older format'
+        elif set(state['cells']) - set(cell_names):
+            reason = 'cells were removed from the ensemble'
+        if reason:
+            print('Rebuilding, {}.'.format(reason))
+            state = None
+
+    if state is None:
+        state = {'method': method, 'genes': genes, 'keep': keep, 'min_cells': min_cells, 'cells': []}
+        if method == 'pearson':
+            state['stats'] = stats_layout
+        top_idx = np.full((num_genes, keep), -1, dtype=np.int32)
+        top_corr = np.full((num_genes, keep), np.nan, dtype=np.float32)
+        create = True
+    else:
+        top_idx = np.load(os.path.join(state_path, 'top_idx.npy'))
+        top_corr = np.load(os.path.join(state_path, 'top_corr.npy'))
+        create = False
+
+    known = set(state['cells'])
+    new = [(name, column) for name, column in zip(cell_names, columns) if name not in known]
+    if not new:
+        return None, None
+    print('{} new cells.'.format(len(new)))
+    new_columns = np.array([column for _, column in new], dtype=np.int64)
+    affected = np.flatnonzero(~np.isnan(np.asarray(matrix[new_columns])).all(axis=0))
+    print('{}/{} genes have data in the new cells.'.format(len(affected), num_genes))
+
+    state['pending'] = True
+    save_manifest(state, os.path.join(state_path, 'state.json'))
+
+    if method == 'pearson':
+        paths = {name: os.path.join(state_path, name + '.npy') for name in stat_names}
+        if create:
+            stats = {name: np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                                     shape=(triangle_size(num_genes),))
+                     for name, path in paths.items()}
+        else:
+            stats = {name: np.load(path, mmap_mode='r+') for name, path in paths.items()}
+        accumulate_stats(stats, matrix.T, affected, new_columns, num_genes, block_size)
+        for values in stats.values():
+            values.flush()
+        top_idx, top_corr = refresh_top_k(top_idx, top_corr, affected, k,
+                                          lambda rows: stats_correlation(stats, rows, num_genes, min_cells),
+                                          block_size, partners_changed=False)
+    else:
+        ranks_path = os.path.join(state_path, 'ranks.npy')
+        # Columns of the existing ranks are in the order the cells were added.
+        cell_columns = dict(zip(cell_names, columns))
+        all_columns = np.array([cell_columns[name] for name in state['cells']] + list(new_columns), dtype=np.int64)
+        old_ranks = None if create else np.load(ranks_path, mmap_mode='r')
+        tmp_path = os.path.join(state_path, 'ranks.tmp.npy')
+        ranks = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(num_genes, len(all_columns)))
+        num_old = len(all_columns) - len(new_columns)
+        for start in range(0, num_genes, block_size):
+            if old_ranks is not None:
+                ranks[start:start+block_size, :num_old] = old_ranks[start:start+block_size]
+            ranks[start:start+block_size, num_old:] = np.nan
+        for rows in row_blocks(affected, block_size):
+            ranks[rows] = rank_rows(np.asarray(matrix.T[rows]), columns=all_columns)
+        del ranks, old_ranks
+        os.replace(tmp_path, ranks_path)
+
+        ranks = np.load(ranks_path, mmap_mode='r')
+        if create:
+            top_idx, top_corr = correlate_top_k(ranks, k=keep, block_size=block_size, min_cells=min_cells)
+        else:
+            top_idx, top_corr = refresh_top_k(top_idx, top_corr, affected, k,
+                                              lambda rows: ranks_correlation(ranks, rows, block_size, min_cells),
+                                              block_size, partners_changed=True)
+
+    state['cells'] = state['cells'] + [name for name, _ in new]
+    save_state(state, state_path, top_idx, top_corr)
+    return top_idx, top_corr
+
+
+def write_normalized(ranks, output_dir, ensemble, genes, block_size=1024):
+    """Write the rank-normalized matrix used by the web app for on-demand correlated gene search (correlation.py).
+
+    Missing ranks are set to 0 (the mean rank) and each gene is scaled to unit length, so the dot product of two rows
+    approximates their Spearman correlation.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    tmp_path = os.path.join(output_dir, ensemble + '.tmp.npy')
+    normalized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=ranks.shape)
+    for start in range(0, ranks.shape[0], block_size):
+        block = np.nan_to_num(np.asarray(ranks[start:start+block_size], dtype=np.float32))
+        norm = np.sqrt((block * block).sum(axis=1, keepdims=True))
+        normalized[start:start+block_size] = block / np.where(norm > 0, norm, 1)
+    del normalized
+
+    save_manifest({'genes': genes, 'method': 'spearman'}, os.path.join(output_dir, ensemble + '.json'))
+    os.replace(tmp_path, os.path.join(output_dir, ensemble + '.npy'))
+
+
+@contextmanager
+def stage(name, timings):
+    """Time a stage of the pipeline, print its duration and record it in timings."""
+    print('[{}] started'.format(name))
     sys.stdout.flush()
     start = timeit.default_timer()
-    corr = concat_result.T.corr(method='spearman')
-    stop = timeit.default_timer()
-    print('done in {} seconds.'.format(stop - start))
+    yield
+    timings[name] = timeit.default_timer() - start
+    print('[{}] done in {:.1f} seconds'.format(name, timings[name]))
+    sys.stdout.flush()
+
+
+def load_config(config_path):
+    """Read settings from a Flask config file (ie. scmdb_py/default_config.py)."""
+    config = {}
+    with open(config_path) as f:
+        exec(compile(f.read(), config_path, 'exec'), config)
+    return config
+
+
+def database_uri(args):
+    """Return the methylation database URI from the command line, the config file or SCMDB_DATABASE_URI."""
+    if args.database_uri:
+        return args.database_uri
+    if args.config:
+        return load_config(args.config)['SQLALCHEMY_BINDS']['methylation_data']
+    return os.environ.get('SCMDB_DATABASE_URI')
+
+
+def ensemble_cells(engine, ensemble):
+    """Return the names of the cells in an ensemble."""
+    result = engine.execute(text(
+        "SELECT cells.cell_name FROM cells INNER JOIN {0} ON cells.cell_id = {0}.cell_id".format(ensemble))).fetchall()
+    return [row[0] for row in result]
+
+
+def top_k_rows(genes, top_idx, top_corr):
+    """Yield (gene1, gene2, correlation) for every kept pair, most correlated partners first."""
+    for gene, partners, correlations in zip(genes, top_idx, top_corr):
+        for partner, correlation in zip(partners, correlations):
+            if partner < 0:
+                break
+            yield gene, genes[partner], float(correlation)
+
+
+def replace_table(engine, table_name, columns, rows=(), batch_size=10000, indexes=(), load=None):
+    """Load rows into a new copy of a table and swap it in for the existing one, so readers never see a partial table.
+
+    Arguments:
+        engine (Engine): Database to load into.
+        table_name (str): Name of the table to replace.
+        columns (list): sqlalchemy Column objects of the table.
+        rows (iterable): dicts of column values, inserted with batched multi-row inserts.
+        batch_size (int): Rows per insert.
+        indexes (list): Names of the columns to index.
+        load (function): Called with (connection, staging table name) instead of inserting rows, returns the row count.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    staging_name = table_name + '_new'
+    staging = Table(staging_name, MetaData(), *[column.copy() for column in columns])
+    # Index names are global in SQLite, make them unique so they don't clash with those of the table being replaced.
+    suffix = '{:x}'.format(int(time.time() * 1e6))
+    for column in indexes:
+        Index('ix_{}_{}_{}'.format(table_name, column, suffix), staging.c[column])
+    staging.drop(engine, checkfirst=True)
+    staging.create(engine)
+
+    num_rows = 0
+    with engine.begin() as conn:
+        if load is not None:
+            num_rows = load(conn, staging_name)
+        else:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    conn.execute(staging.insert(), batch)
+                    num_rows += len(batch)
+                    batch = []
+            if batch:
+                conn.execute(staging.insert(), batch)
+                num_rows += len(batch)
+
+    swap_table(engine, staging_name, table_name)
+    return num_rows
+
+
+def swap_table(engine, staging_name, table_name):
+    """Replace a table with a staging table.
+
+    On MySQL, RENAME TABLE renames both tables in one atomic statement, so readers see either the old or the new
+    table, then the old one is dropped. SQLite has no such statement: the table is dropped and the staging table
+    renamed in its place, leaving a moment without the table.
+    """
+    if engine.dialect.name == 'mysql':
+        old_name = table_name + '_old'
+        Table(old_name, MetaData()).drop(engine, checkfirst=True)
+        if engine.has_table(table_name):
+            engine.execute(text("RENAME TABLE {0} TO {1}, {2} TO {0}".format(table_name, old_name, staging_name)))
+            Table(old_name, MetaData()).drop(engine)
+        else:
+            engine.execute(text("RENAME TABLE {} TO {}".format(staging_name, table_name)))
+    else:
+        Table(table_name, MetaData()).drop(engine, checkfirst=True)
+        engine.execute(text("ALTER TABLE {} RENAME TO {}".format(staging_name, table_name)))
+
+
+def table_method(engine, ensemble):
+    """Return the method the correlations in <ensemble>_correlated_genes were computed with, None if there are none.
+
+    Tables loaded before the method was recorded were loaded by the correlate command, with Spearman correlations.
+    """
+    table_name = '{}_correlated_genes'.format(ensemble)
+    if not engine.has_table(table_name):
+        return None
+    if 'method' not in [column['name'] for column in inspect(engine).get_columns(table_name)]:
+        return 'spearman'
+    return engine.execute(text("SELECT method FROM {} LIMIT 1".format(table_name))).scalar()
+
+
+def load_correlations(engine, ensemble, rows, method='spearman', batch_size=10000, tsv_path=None):
+    """Bulk load top-k correlations into the <ensemble>_correlated_genes table read by content.get_corr_genes.
+
+    Rows are loaded with batched multi-row inserts, or with LOAD DATA LOCAL INFILE when tsv_path is given (MySQL only).
+    The method ('spearman' or 'pearson') is stored in every row.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    columns = [Column('gene1', String(40), nullable=False),
+               Column('gene2', String(40), nullable=False),
+               Column('correlation', Float, nullable=False),
+               Column('method', String(16), nullable=False)]
+
+    load = None
+    if tsv_path is not None:
+        def load(conn, staging_name):
+            return conn.execute(text(
+                "LOAD DATA LOCAL INFILE :path INTO TABLE {} FIELDS TERMINATED BY '\\t' IGNORE 1 LINES "
+                "(gene1, gene2, correlation, @rank) SET method = :method".format(staging_name)),
+                path=tsv_path, method=method).rowcount
+
+    rows = ({'gene1': gene1, 'gene2': gene2, 'correlation': correlation, 'method': method}
+            for gene1, gene2, correlation in rows)
+    return replace_table(engine, '{}_correlated_genes'.format(ensemble), columns, rows, batch_size,
+                         indexes=['gene1'], load=load)
+
+
+def command_ingest(args):
+    with stage('ingest', {}):
+        manifest = ingest(args.input_path, args.matrix_path, args.processes, args.checkpoint_every)
+    if not manifest['completed']:
+        print('No *_mCH.txt files found in {}'.format(args.input_path))
+        return EXIT_NO_DATA
+    return EXIT_OK
+
+
+def read_matrix_manifest(matrix_path):
+    """Return the manifest of a matrix written by ingest, or an exit code if it is missing or incomplete."""
+    try:
+        with open(matrix_path + '.json') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError) as e:
+        print('Could not read the manifest of {}: {}'.format(matrix_path, e))
+        return EXIT_CONFIG
+    if len(manifest['completed']) != len(manifest['genes']):
+        print('{} is incomplete, rerun the ingest command.'.format(matrix_path))
+        return EXIT_NO_DATA
+    return manifest
+
+
+def connect(args, uri):
+    connect_args = {'local_infile': True} if args.load == 'load-data' else {}
+    return create_engine(uri, connect_args=connect_args)
+
+
+def publish(args, engine, ensemble, genes, top_idx, top_corr, method, work_dir, timings):
+    """Write the top-k correlations of an ensemble to a TSV file and/or load them into the database."""
+    tsv_path = None
+    if args.output_dir or args.load == 'load-data':
+        tsv_path = os.path.join(args.output_dir or work_dir, '{}_correlated_genes.tsv'.format(ensemble))
+        with stage(ensemble + ' write', timings):
+            write_top_k(tsv_path, genes, top_idx, top_corr)
+
+    if args.load != 'none':
+        with stage(ensemble + ' load', timings):
+            num_rows = load_correlations(engine, ensemble, top_k_rows(genes, top_idx, top_corr), method,
+                                         batch_size=args.batch_size,
+                                         tsv_path=tsv_path if args.load == 'load-data' else None)
+        print('Loaded {} rows into {}_correlated_genes'.format(num_rows, ensemble))
+
+
+def print_timings(timings):
+    print('-' * 10)
+    for name, seconds in timings.items():
+        print('{:<40}{:>10.1f} s'.format(name, seconds))
+
+
+def command_correlate(args):
+    timings = OrderedDict()
+
+    uri = database_uri(args)
+    if args.load != 'none' and not uri:
+        print('No database configured, use --database-uri, --config or SCMDB_DATABASE_URI.')
+        return EXIT_CONFIG
+    manifest = read_matrix_manifest(args.matrix_path)
+    if not isinstance(manifest, dict):
+        return manifest
+
+    matrix = np.load(args.matrix_path, mmap_mode='r')
+    genes = manifest['genes']
+    cell_index = {cell: i for i, cell in enumerate(manifest['cells'])}
+    engine = connect(args, uri) if uri else None
+
+    try:
+        for ensemble in args.ensembles:
+            print('-' * 10 + '\n' + ensemble)
+            if engine is not None:
+                with stage(ensemble + ' cells', timings):
+                    columns = [cell_index[cell] for cell in ensemble_cells(engine, ensemble) if cell in cell_index]
+                if not columns:
+                    print('No cells of {} found in {}'.format(ensemble, args.matrix_path))
+                    return EXIT_NO_DATA
+            else:
+                columns = None
+
+            ranks_path = os.path.join(args.work_dir, '{}_ranks.npy'.format(ensemble))
+            with stage(ensemble + ' rank', timings):
+                num_cells = matrix.shape[0] if columns is None else len(columns)
+                ranks = np.lib.format.open_memmap(ranks_path, mode='w+', dtype=np.float32, shape=(len(genes), num_cells))
+                rank_rows(matrix.T, out=ranks, columns=columns)
+
+            with stage(ensemble + ' correlate', timings):
+                top_idx, top_corr = correlate_top_k(ranks, k=args.top_k, block_size=args.block_size,
+                                                    min_cells=args.min_cells)
+
+            if args.normalized_dir:
+                with stage(ensemble + ' normalize', timings):
+                    write_normalized(ranks, args.normalized_dir, ensemble, genes)
+            del ranks
+            if not args.keep_ranks:
+                os.remove(ranks_path)
+
+            publish(args, engine, ensemble, genes, top_idx, top_corr, 'spearman', args.work_dir, timings)
+    except SQLAlchemyError as e:
+        print('Database error: {}'.format(e))
+        return EXIT_DATABASE
+
+    print_timings(timings)
+    return EXIT_OK
+
+
+def command_update(args):
+    timings = OrderedDict()
+
+    uri = database_uri(args)
+    if not uri:
+        print('No database configured, use --database-uri, --config or SCMDB_DATABASE_URI.')
+        return EXIT_CONFIG
+    manifest = read_matrix_manifest(args.matrix_path)
+    if not isinstance(manifest, dict):
+        return manifest
+
+    matrix = np.load(args.matrix_path, mmap_mode='r')
+    genes = manifest['genes']
+    cell_index = {cell: i for i, cell in enumerate(manifest['cells'])}
+    engine = connect(args, uri)
+
+    try:
+        for ensemble in args.ensembles:
+            print('-' * 10 + '\n' + ensemble)
+            with stage(ensemble + ' cells', timings):
+                cell_names = [cell for cell in ensemble_cells(engine, ensemble) if cell in cell_index]
+            if not cell_names:
+                print('No cells of {} found in {}'.format(ensemble, args.matrix_path))
+                return EXIT_NO_DATA
+
+            loaded_method = table_method(engine, ensemble)
+            if loaded_method not in (None, args.method) and not args.rebuild:
+                print('The correlations of {} were computed with {}, use --method {} or --rebuild to replace them '
+                      'with {} correlations.'.format(ensemble, loaded_method, loaded_method, args.method))
+                return EXIT_USAGE
+
+            state_path = os.path.join(args.state_dir, ensemble)
+            with stage(ensemble + ' update', timings):
+                top_idx, top_corr = update_ensemble(state_path, matrix, genes, cell_names,
+                                                    [cell_index[cell] for cell in cell_names], args.method,
+                                                    args.top_k, args.keep or 2 * args.top_k, args.block_size,
+                                                    args.min_cells, args.rebuild)
+            if top_idx is None:
+                print('{} is up to date.'.format(ensemble))
+                continue
+
+            publish(args, engine, ensemble, genes, top_idx[:, :args.top_k], top_corr[:, :args.top_k], args.method,
+                    state_path, timings)
+    except SQLAlchemyError as e:
+        print('Database error: {}'.format(e))
+        return EXIT_DATABASE
+
+    print_timings(timings)
+    return EXIT_OK
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    ingest_parser = subparsers.add_parser('ingest', help='Load *_mCH.txt gene files into an on-disk cells x genes matrix.')
+    ingest_parser.add_argument('input_path', help='Directory containing *_mCH.txt files.')
+    ingest_parser.add_argument('matrix_path', help='Output .npy matrix. Rerunning with the same path resumes the load.')
+    ingest_parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: number of CPUs).')
+    ingest_parser.add_argument('--checkpoint-every', type=int, default=500, help='Genes between checkpoints.')
+    ingest_parser.set_defaults(func=command_ingest)
+
+    def add_common_arguments(command_parser):
+        command_parser.add_argument('matrix_path', help='.npy matrix written by the ingest command.')
+        command_parser.add_argument('ensembles', nargs='+', help='Ensemble tables to compute correlations for. ie. Ens1 Ens2')
+        command_parser.add_argument('--config', help='Flask config file to read SQLALCHEMY_BINDS from.')
+        command_parser.add_argument('--database-uri', help='SQLAlchemy URI of the methylation database.')
+        command_parser.add_argument('--top-k', type=int, default=100, help='Correlated genes to keep per gene.')
+        command_parser.add_argument('--block-size', type=int, default=512, help='Genes per correlation tile.')
+        command_parser.add_argument('--min-cells', type=int, default=10, help='Minimum shared cells to correlate two genes.')
+        command_parser.add_argument('--load', choices=['insert', 'load-data', 'none'], default='insert',
+                                    help='How to load results into <ensemble>_correlated_genes. load-data uses MySQL LOAD DATA LOCAL INFILE.')
+        command_parser.add_argument('--batch-size', type=int, default=10000, help='Rows per insert batch.')
+        command_parser.add_argument('--output-dir', help='Also write <ensemble>_correlated_genes.tsv files here.')
+
+    correlate_parser = subparsers.add_parser('correlate', help='Compute top-k correlated genes for ensembles and load them into the database.')
+    add_common_arguments(correlate_parser)
+    correlate_parser.add_argument('--work-dir', default='.', help='Directory for temporary rank matrices.')
+    correlate_parser.add_argument('--keep-ranks', action='store_true', help='Keep the <ensemble>_ranks.npy matrices.')
+    correlate_parser.add_argument('--normalized-dir', help='Also write rank-normalized matrices for on-demand search here (CORRELATION_DATA_DIR).')
+    correlate_parser.set_defaults(func=command_correlate)
+
+    update_parser = subparsers.add_parser('update', help='Incrementally update correlations after cells were added to ensembles.')
+    add_common_arguments(update_parser)
+    update_parser.add_argument('--state-dir', required=True, help='Directory keeping the state of each ensemble between runs.')
+    update_parser.add_argument('--method', choices=['spearman', 'pearson'], default='spearman',
+                               help='spearman re-ranks genes with new data, pearson keeps sufficient statistics (24 bytes per pair of genes on disk).')
+    update_parser.add_argument('--keep', type=int, default=None, help='Partners kept in the state per gene (default: 2 * top-k).')
+    update_parser.add_argument('--rebuild', action='store_true',
+                               help='Discard the state and start over, replacing correlations computed with another method.')
+    update_parser.set_defaults(func=command_update)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        parser.exit(EXIT_USAGE)
+    return args
+
 
-    output_path = 'correlations_{}.csv'.format(int(time.time()))
-    print('Writing output to {}'.format(output_path))
-    concat_result.index.name = None
-    corr.to_csv(output_path, sep='\t')
+def main(argv=None):
+    args = parse_args(argv)
+    return args.func(args)
 
 
 if __name__ == '__main__':
-    wizard()
+    sys.exit(main())
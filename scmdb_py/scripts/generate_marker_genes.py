@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Generate marker genes for every clustering of an ensemble.
+
+    generate_marker_genes.py matrix.npy Ens1 Ens2 --config scmdb_py/default_config.py
+
+matrix.npy is the cells x genes mCH matrix written by `generate_correlation.py ingest`. In every clustering, each gene
+is compared between the cells of a cluster and the rest of the ensemble:
+
+    mean difference: mean mCH of the cluster minus mean mCH of the other cells.
+    AUROC: probability that a cell of the cluster has higher mCH than a cell outside of it, from the rank sum of the
+        cluster (Mann-Whitney U). Genes are ranked once per ensemble, the rank sums of all clusters of a clustering are
+        then a single matrix product.
+
+Marker genes of a cluster are the genes with lower mCH in the cluster (gene body hypomethylation marks expressed genes),
+ranked by 1 - AUROC. Use --direction high for the opposite. Clusterings are processed in parallel.
+
+Results are written to <ensemble>_cluster_marker_genes. The table served by /cluster/marker_genes/ for each clustering
+is also pre-serialized into <ensemble>_cluster_marker_genes_json.
+
+Exit codes: 0 success, 2 usage error, 3 configuration error, 4 no data, 5 database error.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, Float, Integer, String, Text, create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+# The shared helpers are in generate_correlation.py, next to this script.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generate_correlation import (EXIT_OK, EXIT_CONFIG, EXIT_NO_DATA, EXIT_DATABASE, database_uri,
+                                  print_timings, read_matrix_manifest, replace_table, stage)
+
+
+def ensemble_clusters(engine, ensemble):
+    """Return a DataFrame with the cell_name and the cluster_* columns of the cells of an ensemble."""
+    df = pd.read_sql(text("SELECT cells.cell_name, {0}.* FROM cells INNER JOIN {0} ON cells.cell_id = {0}.cell_id".format(ensemble)),
+                     engine)
+    return df[['cell_name'] + [column for column in df.columns if column.startswith('cluster_')]]
+
+
+def gene_names(engine):
+    """Return {Ensembl ID without version: (gene_id, gene_name)} for all genes in the genes table."""
+    result = engine.execute(text("SELECT gene_id, gene_name FROM genes")).fetchall()
+    return {row.gene_id.split('.')[0]: (row.gene_id, row.gene_name) for row in result}
+
+
+def prepare(matrix, rows, values_path, ranks_path, block_size=1024):
+    """Write the mCH levels and the ranks of each gene over the cells of an ensemble as genes x cells matrices.
+
+    Arguments:
+        matrix (array): cells x genes matrix written by ingest.
+        rows (list): Rows of the cells of the ensemble in matrix.
+        values_path (str): Output path of the values.
+        ranks_path (str): Output path of the ranks (1 to number of cells with data, ties averaged, NaN if missing).
+    """
+    num_genes = matrix.shape[1]
+    values = np.lib.format.open_memmap(values_path, mode='w+', dtype=np.float32, shape=(num_genes, len(rows)))
+    ranks = np.lib.format.open_memmap(ranks_path, mode='w+', dtype=np.float32, shape=(num_genes, len(rows)))
+    for start in range(0, num_genes, block_size):
+        block = np.asarray(matrix[:, start:start+block_size])[rows].T
+        values[start:start+block_size] = block
+        ranks[start:start+block_size] = pd.DataFrame(block, dtype=np.float64).rank(axis=1).values
+    del values, ranks
+
+
+def cluster_statistics(values, ranks, labels, block_size=1024):
+    """Compare every gene between the cells of each cluster and all other cells.
+
+    Arguments:
+        values (array): genes x cells mCH levels, NaN for missing values.
+        ranks (array): genes x cells ranks from prepare.
+        labels (numpy.ndarray): Cluster of each cell, NaN for cells without a cluster (they only count as other cells).
+        block_size (int): Number of genes processed at a time.
+
+    Returns:
+        numpy.ndarray: Cluster ids.
+        numpy.ndarray: genes x clusters AUROC.
+        numpy.ndarray: genes x clusters mean difference.
+        numpy.ndarray: genes x clusters number of cells with data in the smaller of the cluster and the other cells.
+    """
+    clusters = np.unique(labels[~np.isnan(labels)])
+    onehot = (labels[None, :] == clusters[:, None]).astype(np.float64)
+
+    num_genes = values.shape[0]
+    auroc = np.full((num_genes, len(clusters)), np.nan, dtype=np.float32)
+    mean_diff = np.full((num_genes, len(clusters)), np.nan, dtype=np.float32)
+    counts = np.zeros((num_genes, len(clusters)), dtype=np.float32)
+
+    for start in range(0, num_genes, block_size):
+        rows = slice(start, min(start + block_size, num_genes))
+        block = np.asarray(values[rows], dtype=np.float64)
+        mask = ~np.isnan(block)
+        x = np.where(mask, block, 0)
+        r = np.where(mask, np.asarray(ranks[rows], dtype=np.float64), 0)
+        m = mask.astype(np.float64)
+
+        n_in = m @ onehot.T
+        sum_in = x @ onehot.T
+        rank_sum_in = r @ onehot.T
+        n_out = m.sum(axis=1, keepdims=True) - n_in
+        sum_out = x.sum(axis=1, keepdims=True) - sum_in
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            auroc[rows] = (rank_sum_in - n_in * (n_in + 1) / 2) / (n_in * n_out)
+            mean_diff[rows] = sum_in / n_in - sum_out / n_out
+        counts[rows] = np.minimum(n_in, n_out)
+
+    return clusters, auroc, mean_diff, counts
+
+
+_worker = {}
+
+
+def _init_worker(values_path, ranks_path):
+    _worker['values'] = np.load(values_path, mmap_mode='r')
+    _worker['ranks'] = np.load(ranks_path, mmap_mode='r')
+
+
+def clustering_markers(task):
+    """Find the top marker genes of each cluster of a clustering.
+
+    Arguments:
+        task (tuple): (clustering, cluster of each cell, number of genes per cluster, 'low' or 'high',
+            minimum number of cells, block size)
+
+    Returns:
+        str: clustering
+        OrderedDict: {cluster: [(gene index, AUROC, mean difference), ...]} best marker first.
+        float: Seconds spent.
+    """
+    clustering, labels, top_n, direction, min_cells, block_size = task
+    start = timeit.default_timer()
+
+    clusters, auroc, mean_diff, counts = cluster_statistics(_worker['values'], _worker['ranks'], labels, block_size)
+    if direction == 'low':
+        score, diff = 1 - auroc, -mean_diff
+    else:
+        score, diff = auroc, mean_diff
+    with np.errstate(invalid='ignore'):
+        score[(counts < min_cells) | ~(diff > 0)] = np.nan
+    score = np.where(np.isnan(score), -np.inf, score)
+
+    markers = OrderedDict()
+    for j, cluster in enumerate(clusters):
+        best = np.argsort(-score[:, j], kind='mergesort')[:top_n]
+        best = best[np.isfinite(score[best, j])]
+        markers[int(cluster)] = [(int(gene), float(auroc[gene, j]), float(mean_diff[gene, j])) for gene in best]
+
+    return clustering, markers, timeit.default_timer() - start
+
+
+def marker_table_json(markers):
+    """Serialize the marker genes of a clustering as returned by content.get_cluster_marker_genes.
+
+    Arguments:
+        markers (OrderedDict): {cluster: [(gene id, gene name), ...]}
+    """
+    num_clusters = max(markers) if markers else 0
+    num_genes = max((len(genes) for genes in markers.values()), default=0)
+    columns = ['cluster_' + str(i + 1) for i in range(num_clusters)]
+
+    rows = []
+    for i in range(num_genes):
+        row = {}
+        for cluster, column in enumerate(columns, 1):
+            genes = markers.get(cluster, [])
+            row[column] = genes[i][1] if i < len(genes) else ''
+        row['rank'] = i + 1
+        rows.append(row)
+
+    return json.dumps({'columns': columns, 'rows': rows}, separators=(',', ':'))
+
+
+marker_columns = [Column('clustering', String(100), nullable=False),
+                  Column('cluster', Integer, nullable=False),
+                  Column('rank', Integer, nullable=False),
+                  Column('gene_id', String(40), nullable=False),
+                  Column('auroc', Float),
+                  Column('mean_difference', Float)]
+
+marker_json_columns = [Column('clustering', String(100), nullable=False),
+                       Column('data', Text(length=2**24), nullable=False)]
+
+
+def marker_rows(pool, tasks, genes, json_rows):
+    """Yield the marker gene rows of each clustering as soon as a worker finishes it.
+
+    The pre-serialized table of each clustering is appended to json_rows.
+    """
+    for clustering, markers, seconds in pool.imap_unordered(clustering_markers, tasks):
+        print('{}: {} clusters in {:.1f} seconds'.format(clustering, len(markers), seconds))
+        sys.stdout.flush()
+        for cluster, cluster_markers in markers.items():
+            for rank, (gene, auroc, mean_diff) in enumerate(cluster_markers, 1):
+                yield {'clustering': clustering, 'cluster': cluster, 'rank': rank, 'gene_id': genes[gene][0],
+                       'auroc': auroc, 'mean_difference': mean_diff}
+        json_rows.append({'clustering': clustering, 'data': marker_table_json(
+            OrderedDict((cluster, [genes[gene] for gene, _, _ in cluster_markers])
+                        for cluster, cluster_markers in markers.items()))})
+
+
+def run(args):
+    timings = OrderedDict()
+
+    uri = database_uri(args)
+    if not uri:
+        print('No database configured, use --database-uri, --config or SCMDB_DATABASE_URI.')
+        return EXIT_CONFIG
+    manifest = read_matrix_manifest(args.matrix_path)
+    if not isinstance(manifest, dict):
+        return manifest
+
+    matrix = np.load(args.matrix_path, mmap_mode='r')
+    cell_index = {cell: i for i, cell in enumerate(manifest['cells'])}
+    engine = create_engine(uri)
+
+    try:
+        with stage('genes', timings):
+            names = gene_names(engine)
+        genes = [names.get(gene.split('.')[0], (gene, gene)) for gene in manifest['genes']]
+
+        for ensemble in args.ensembles:
+            print('-' * 10 + '\n' + ensemble)
+            with stage(ensemble + ' cells', timings):
+                df_cells = ensemble_clusters(engine, ensemble)
+                df_cells = df_cells[df_cells['cell_name'].isin(cell_index)]
+            clusterings = [column for column in df_cells.columns if column.startswith('cluster_')]
+            if df_cells.empty or not clusterings:
+                print('No clustered cells of {} found in {}'.format(ensemble, args.matrix_path))
+                return EXIT_NO_DATA
+
+            values_path = os.path.join(args.work_dir, '{}_values.npy'.format(ensemble))
+            ranks_path = os.path.join(args.work_dir, '{}_marker_ranks.npy'.format(ensemble))
+            with stage(ensemble + ' rank', timings):
+                prepare(matrix, [cell_index[cell] for cell in df_cells['cell_name']], values_path, ranks_path,
+                        args.block_size)
+
+            tasks = [(column.split('cluster_', 1)[1], df_cells[column].values.astype(np.float64), args.top_n,
+                      args.direction, args.min_cells, args.block_size) for column in clusterings]
+            # Rows are loaded as the clusterings are computed, instead of holding those of all clusterings.
+            json_rows = []
+            with stage(ensemble + ' markers', timings):
+                pool = Pool(args.processes, initializer=_init_worker, initargs=(values_path, ranks_path))
+                try:
+                    num_rows = replace_table(engine, '{}_cluster_marker_genes'.format(ensemble), marker_columns,
+                                             marker_rows(pool, tasks, genes, json_rows), args.batch_size,
+                                             indexes=['clustering'])
+                finally:
+                    pool.close()
+                    pool.join()
+            os.remove(values_path)
+            os.remove(ranks_path)
+
+            with stage(ensemble + ' load', timings):
+                replace_table(engine, '{}_cluster_marker_genes_json'.format(ensemble), marker_json_columns,
+                              json_rows, indexes=['clustering'])
+            print('Loaded {} rows into {}_cluster_marker_genes'.format(num_rows, ensemble))
+    except SQLAlchemyError as e:
+        print('Database error: {}'.format(e))
+        return EXIT_DATABASE
+
+    print_timings(timings)
+    return EXIT_OK
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('matrix_path', help='.npy matrix written by generate_correlation.py ingest.')
+    parser.add_argument('ensembles', nargs='+', help='Ensemble tables to compute marker genes for. ie. Ens1 Ens2')
+    parser.add_argument('--config', help='Flask config file to read SQLALCHEMY_BINDS from.')
+    parser.add_argument('--database-uri', help='SQLAlchemy URI of the methylation database.')
+    parser.add_argument('--top-n', type=int, default=100, help='Marker genes to keep per cluster.')
+    parser.add_argument('--direction', choices=['low', 'high'], default='low', help='Whether markers have low or high mCH in their cluster.')
+    parser.add_argument('--min-cells', type=int, default=10, help='Minimum cells with data inside and outside the cluster.')
+    parser.add_argument('--block-size', type=int, default=1024, help='Genes processed at a time.')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: number of CPUs).')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Rows per insert batch.')
+    parser.add_argument('--work-dir', default='.', help='Directory for temporary matrices.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    return run(parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
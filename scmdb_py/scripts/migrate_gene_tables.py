@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Migrate the per-gene tables of the methylation database into a long-format gene table.
+
+    migrate_gene_tables.py --config scmdb_py/default_config.py --processes 8
+    migrate_gene_tables.py --database-uri sqlite:////path/to/CEMBA.sqlite
+    migrate_gene_tables.py --config scmdb_py/default_config.py --recopy
+
+Gene body methylation is stored in one table per gene (gene_ENSMUSG00000026787_3...), tens of thousands of tables
+per database. This copies them into two tables:
+
+    gene_index: gene_idx, gene_id, table_name, whether the gene was migrated and the version of its table when it
+        was copied.
+    gene_data: gene_idx, cell_id and the count columns of the gene tables (mCH, CH, mCG, CG...), with the primary key
+        (gene_idx, cell_id). InnoDB clusters rows by primary key, so the rows of a gene are stored together in cell_id
+        order and one or several genes are read with a single indexed range scan.
+
+Genes are copied server-side (INSERT ... SELECT) in chunks, by parallel worker processes. Each chunk is one
+transaction that also marks its genes as migrated in gene_index, so an interrupted migration is resumed by running the
+command again. Gene tables created since the last run are added to gene_index and copied as well. SQLite allows a
+single writer, so SQLite databases are migrated with one process.
+
+content.py reads migrated genes from gene_data, not from their tables, so run the command again after reloading gene
+tables. Genes whose table changed since it was copied are copied again: the version of a table is its creation time
+on MySQL and its row count on other databases. --recopy copies every gene again, for changes these versions don't
+show (ie. rows updated in place).
+
+Per-gene tables are left in place. content.py reads migrated genes from gene_data. The end of each run is recorded
+in gene_migration, whose row count is part of the data version of the catalog: running apps pick up the migrated
+genes at their next catalog refresh after the run, instead of changing version with every chunk copied.
+
+Exit codes: 0 success, 2 usage error, 3 configuration error, 4 no data, 5 database error.
+"""
+import argparse
+import datetime
+import os
+import re
+import sys
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from sqlalchemy import (Boolean, Column, DateTime, Float, Integer, MetaData, PrimaryKeyConstraint, String, Table,
+                        create_engine, inspect, text)
+from sqlalchemy.exc import SQLAlchemyError
+
+# The shared helpers are in generate_correlation.py, next to this script.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generate_correlation import (EXIT_OK, EXIT_CONFIG, EXIT_NO_DATA, EXIT_DATABASE, database_uri, print_timings,
+                                  stage)
+
+gene_table_pattern = re.compile(r'^gene_(ENS[A-Z]*G\d+)(_\d+)?$')
+
+
+def find_gene_tables(engine):
+    """Return (gene id, table name) of every per-gene table, ordered by table name."""
+    tables = []
+    for table in sorted(inspect(engine).get_table_names()):
+        match = gene_table_pattern.match(table)
+        if match:
+            tables.append((match.group(1), table))
+    return tables
+
+
+def count_columns(engine, table_name):
+    """Return the data columns of a gene table, ie. ['mCH', 'CH', 'mCG', 'CG', 'mCA', 'CA']."""
+    return [column['name'] for column in inspect(engine).get_columns(table_name) if column['name'] != 'cell_id']
+
+
+def table_versions(engine, table_names):
+    """Return {table name: version} of gene tables, changing when a table is reloaded.
+
+    On MySQL, the creation times of the tables, read in one query: reloading a table replaces or truncates it, which
+    recreates it. (Update times are not used, InnoDB forgets them when the server restarts.) Elsewhere, their row
+    counts.
+    """
+    if engine.dialect.name == 'mysql':
+        result = engine.execute(text("SELECT TABLE_NAME, CREATE_TIME FROM information_schema.TABLES \
+            WHERE TABLE_SCHEMA = DATABASE()"))
+        versions = {row[0]: str(row[1]) for row in result}
+        return {table_name: versions.get(table_name) for table_name in table_names}
+    return {table_name: str(engine.execute(text("SELECT COUNT(*) FROM {}".format(table_name))).scalar())
+            for table_name in table_names}
+
+
+def create_tables(engine, columns):
+    """Create gene_index, gene_data and gene_migration if they don't exist.
+
+    Returns:
+        list: Count columns of gene_data. They are taken from the existing table when resuming.
+    """
+    metadata = MetaData()
+    Table('gene_index', metadata,
+          Column('gene_idx', Integer, primary_key=True, autoincrement=False),
+          Column('gene_id', String(40), nullable=False),
+          Column('table_name', String(64), nullable=False, unique=True),
+          Column('migrated', Boolean, nullable=False, default=False),
+          Column('table_version', String(64)),
+          mysql_engine='InnoDB')
+    Table('gene_data', metadata,
+          Column('gene_idx', Integer, nullable=False, autoincrement=False),
+          Column('cell_id', Integer, nullable=False, autoincrement=False),
+          *[Column(column, Float) for column in columns],
+          PrimaryKeyConstraint('gene_idx', 'cell_id'),
+          mysql_engine='InnoDB')
+    Table('gene_migration', metadata,
+          Column('run', Integer, primary_key=True),
+          Column('finished', DateTime, nullable=False),
+          Column('genes', Integer, nullable=False),
+          mysql_engine='InnoDB')
+    metadata.create_all(engine, checkfirst=True)
+    # gene_index of a migration started before table versions were recorded.
+    if 'table_version' not in count_columns(engine, 'gene_index'):
+        engine.execute(text("ALTER TABLE gene_index ADD COLUMN table_version VARCHAR(64)"))
+    return [column for column in count_columns(engine, 'gene_data') if column != 'gene_idx']
+
+
+def register_genes(engine, gene_tables):
+    """Add gene tables missing from gene_index, numbered after the existing ones.
+
+    Returns:
+        int: Number of genes added.
+    """
+    with engine.begin() as conn:
+        registered = set(row[0] for row in conn.execute(text("SELECT table_name FROM gene_index")))
+        next_idx = (conn.execute(text("SELECT MAX(gene_idx) FROM gene_index")).scalar() or 0) + 1
+        rows = []
+        for gene_id, table_name in gene_tables:
+            if table_name not in registered:
+                rows.append({'gene_idx': next_idx, 'gene_id': gene_id, 'table_name': table_name})
+                next_idx += 1
+        if rows:
+            conn.execute(text("INSERT INTO gene_index (gene_idx, gene_id, table_name, migrated) \
+                VALUES (:gene_idx, :gene_id, :table_name, 0)"), rows)
+    return len(rows)
+
+
+def mark_changed(engine, versions, recopy=False):
+    """Mark migrated genes whose table changed since it was copied (or all of them with recopy) as not migrated.
+
+    Genes migrated before table versions were recorded get the current version of their table, without being copied.
+
+    Returns:
+        int: Number of genes to copy again.
+    """
+    with engine.begin() as conn:
+        if recopy:
+            return conn.execute(text("UPDATE gene_index SET migrated = 0 WHERE migrated = 1")).rowcount
+        changed = []
+        unversioned = []
+        for gene_idx, table_name, version in conn.execute(text("SELECT gene_idx, table_name, table_version \
+                FROM gene_index WHERE migrated = 1")):
+            current = versions.get(table_name)
+            if version is None:
+                unversioned.append({'gene_idx': gene_idx, 'table_version': current})
+            elif current is not None and current != version:
+                changed.append(gene_idx)
+        if unversioned:
+            conn.execute(text("UPDATE gene_index SET table_version = :table_version WHERE gene_idx = :gene_idx"),
+                         unversioned)
+        if changed:
+            conn.execute(text("UPDATE gene_index SET migrated = 0 WHERE gene_idx IN ({})".format(
+                ', '.join(str(int(gene_idx)) for gene_idx in changed))))
+    return len(changed)
+
+
+def pending_genes(engine):
+    """Return (gene_idx, table name) of the genes not migrated yet, in gene_idx order."""
+    result = engine.execute(text("SELECT gene_idx, table_name FROM gene_index WHERE migrated = 0 ORDER BY gene_idx"))
+    return [(row[0], row[1]) for row in result]
+
+
+def record_run(engine):
+    """Record the end of a run and the number of genes migrated so far in gene_migration."""
+    with engine.begin() as conn:
+        migrated = conn.execute(text("SELECT COUNT(*) FROM gene_index WHERE migrated = 1")).scalar()
+        conn.execute(text("INSERT INTO gene_migration (finished, genes) VALUES (:finished, :genes)"),
+                     finished=datetime.datetime.now(), genes=migrated)
+
+
+_worker = {}
+
+
+def _init_worker(uri, columns):
+    _worker['engine'] = create_engine(uri)
+    _worker['columns'] = columns
+
+
+def copy_chunk(chunk):
+    """Copy a chunk of gene tables into gene_data and mark them migrated, in one transaction.
+
+    Rows a previous, interrupted run may have left for these genes are deleted first.
+
+    Arguments:
+        chunk (list): (gene_idx, table name, table version) of the genes to copy.
+
+    Returns:
+        tuple: Number of genes copied, number of rows copied and an error message (None on success).
+    """
+    columns = ', '.join(_worker['columns'])
+    num_rows = 0
+    try:
+        with _worker['engine'].begin() as conn:
+            for gene_idx, table_name, _ in chunk:
+                conn.execute(text("DELETE FROM gene_data WHERE gene_idx = :gene_idx"), gene_idx=gene_idx)
+                result = conn.execute(text("INSERT INTO gene_data (gene_idx, cell_id, {0}) \
+                    SELECT :gene_idx, cell_id, {0} FROM {1}".format(columns, table_name)), gene_idx=gene_idx)
+                num_rows += max(result.rowcount, 0)
+            conn.execute(text("UPDATE gene_index SET migrated = 1, table_version = :table_version \
+                WHERE gene_idx = :gene_idx"),
+                         [{'gene_idx': gene_idx, 'table_version': version} for gene_idx, _, version in chunk])
+    except SQLAlchemyError as e:
+        return 0, 0, '{} to {}: {}'.format(chunk[0][1], chunk[-1][1], e)
+    return len(chunk), num_rows, None
+
+
+def migrate(uri, processes=None, chunk_size=200, recopy=False):
+    """Copy all per-gene tables not migrated yet, or changed since they were copied, into gene_data.
+
+    Returns:
+        int: Exit code.
+    """
+    timings = OrderedDict()
+    engine = create_engine(uri)
+    if uri.startswith('sqlite') and processes != 1:
+        print('SQLite allows a single writer, migrating with one process.')
+        processes = 1
+
+    with stage('register', timings):
+        gene_tables = find_gene_tables(engine)
+        if not gene_tables:
+            print('No gene tables found.')
+            return EXIT_NO_DATA
+        columns = create_tables(engine, count_columns(engine, gene_tables[0][1]))
+        print('Added {} genes to gene_index'.format(register_genes(engine, gene_tables)))
+        # Versions are read before copying, so a table reloaded while it is copied is copied again by the next run.
+        versions = table_versions(engine, [table_name for _, table_name in gene_tables])
+        print('{} genes to copy again'.format(mark_changed(engine, versions, recopy)))
+        pending = [(gene_idx, table_name, versions.get(table_name)) for gene_idx, table_name in pending_genes(engine)]
+    print('{} of {} genes to migrate, columns: {}'.format(len(pending), len(gene_tables), ', '.join(columns)))
+
+    errors = []
+    with stage('copy', timings):
+        chunks = [pending[start:start+chunk_size] for start in range(0, len(pending), chunk_size)]
+        done_genes = done_rows = 0
+        with Pool(processes, initializer=_init_worker, initargs=(uri, columns)) as pool:
+            for num_genes, num_rows, error in pool.imap_unordered(copy_chunk, chunks):
+                if error is not None:
+                    errors.append(error)
+                    print('Failed: ' + error)
+                done_genes += num_genes
+                done_rows += num_rows
+                print('{}/{} genes, {} rows'.format(done_genes, len(pending), done_rows))
+                sys.stdout.flush()
+    # Genes of the chunks that succeeded are served even if others failed.
+    if done_genes:
+        record_run(engine)
+
+    print_timings(timings)
+    if errors:
+        print('{} chunks failed, rerun the command to retry them.'.format(len(errors)))
+        return EXIT_DATABASE
+    return EXIT_OK
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', help='Flask config file to read SQLALCHEMY_BINDS from.')
+    parser.add_argument('--database-uri', help='SQLAlchemy URI of the methylation database.')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: number of CPUs).')
+    parser.add_argument('--chunk-size', type=int, default=200, help='Genes copied per transaction.')
+    parser.add_argument('--recopy', action='store_true', help='Copy every gene again, ie. after reloading gene tables.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    uri = database_uri(args)
+    if not uri:
+        print('No database configured, use --database-uri, --config or SCMDB_DATABASE_URI.')
+        return EXIT_CONFIG
+    try:
+        return migrate(uri, args.processes, args.chunk_size, args.recopy)
+    except SQLAlchemyError as e:
+        print('Database error: {}'.format(e))
+        return EXIT_DATABASE
+
+
+if __name__ == '__main__':
+    sys.exit(main())
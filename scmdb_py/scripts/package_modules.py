@@ -0,0 +1,22 @@
+"""Load modules of the scmdb_py package in scripts, without importing the package.
+
+Importing scmdb_py runs its __init__, which needs the whole web stack (Flask and its extensions), and adding the
+scmdb_py directory to sys.path instead would let scmdb_py/json.py shadow the standard library json module. Scripts
+load the standalone modules they need (groupstats.py, bundles.py) by path with load_module.
+"""
+import importlib.util
+import os
+import sys
+
+package_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def load_module(name):
+    """Load scmdb_py/<name>.py as the top-level module <name>. It must not use relative imports."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(package_dir, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Profile the cold start of a worker: import times and time to first response.
+
+    profile_startup.py
+    profile_startup.py --path /login --runs 5 --top 20
+
+Each measurement runs in a fresh interpreter, like a newly spawned mod_wsgi worker, from the directory holding the
+scmdb_py package:
+
+    imports: python -X importtime over create_app(), the top-level packages that took longest (cumulative).
+    time to first response: time from the start of the interpreter until create_app() returned and until the
+        response to --path was built by the test client, with PRELOAD_MODULES False (scientific modules imported on
+        first use) and True (imported in create_app, as every worker did before lazy.py).
+
+PRELOAD_MODULES is set with the SCMDB_PY_PRELOAD_MODULES environment variable, read by flask-appconfig. -X importtime
+needs Python 3.7 or newer.
+
+Exit codes: 0 success, 5 the app failed to start.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+EXIT_OK = 0
+EXIT_APP = 5
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+first_response = '''
+import json, time
+start = time.time()
+from scmdb_py import create_app
+app = create_app()
+created = time.time()
+response = app.test_client().get({path!r})
+done = time.time()
+print('RESULT ' + json.dumps({{'create_app': created - start, 'first_response': done - start,
+                               'status': response.status_code}}))
+'''
+
+
+def run_python(args, env=None):
+    return subprocess.run([sys.executable] + args, cwd=root_dir, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def import_profile(top):
+    """Return (cumulative seconds, package) of the top-level packages imported by create_app, slowest first."""
+    result = run_python(['-X', 'importtime', '-c', 'from scmdb_py import create_app; create_app()'])
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented.
+        if not name[1:].startswith(' '):
+            times.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def time_first_response(path, preload):
+    env = dict(os.environ, SCMDB_PY_PRELOAD_MODULES='true' if preload else 'false')
+    result = run_python(['-c', first_response.format(path=path)], env)
+    for line in result.stdout.splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'no result')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default='/login', help='Path of the first request.')
+    parser.add_argument('--runs', type=int, default=3, help='Fresh interpreters per mode, the best run is shown.')
+    parser.add_argument('--top', type=int, default=15, help='Number of packages in the import profile.')
+    args = parser.parse_args(argv)
+
+    print('Slowest top-level imports of create_app (cumulative):')
+    for seconds, name in import_profile(args.top):
+        print('    {:<40}{:>8.3f} s'.format(name, seconds))
+
+    print('Time to first response for {}, best of {}:'.format(args.path, args.runs))
+    for preload in (True, False):
+        try:
+            runs = [time_first_response(args.path, preload) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print('The app failed to start: {}'.format(e))
+            return EXIT_APP
+        best = min(runs, key=lambda run: run['first_response'])
+        print('    PRELOAD_MODULES={:<6} create_app {:>7.3f} s, first response {:>7.3f} s (status {})'.format(
+            str(preload), best['create_app'], best['first_response'], best['status']))
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
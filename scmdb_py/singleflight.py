@@ -0,0 +1,138 @@
+"""Single-flight memoization: one computation per cache key at a time.
+
+When many browsers request the same plot at once (ie. a page shared in a meeting), every request used to miss the
+cache and run the same queries and plotly rendering in parallel. SingleFlight.memoize is a drop-in replacement for
+cache.memoize that lets only the first caller compute a missing value:
+
+    In the process, callers arriving while the value is computed wait for it and get the same result (or exception).
+    Across processes, the computing process holds a lock entry in the cache (cache.add) and the other processes poll
+    the cache for the value. This needs a cache shared by the processes (ie. CACHE_TYPE redis or memcached); with
+    the per-process simple cache, only callers in the same process are coalesced.
+
+Waiting is bounded by SINGLEFLIGHT_MAX_WAIT seconds, after which a waiting caller computes the value itself. The lock
+entry expires after SINGLEFLIGHT_LOCK_TIMEOUT seconds, in case the computing process dies.
+
+Callers coalesced in the process share the result object, so functions returning mutable objects should be frozen
+(see frames.frozen).
+
+metrics() counts, per function and per process: calls, cache hits, computations, callers coalesced in the process
+and across processes, and waits that timed out.
+"""
+import functools
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import current_app
+
+metric_names = ('calls', 'hits', 'computed', 'coalesced_local', 'coalesced_remote', 'wait_timeouts')
+
+
+class Flight(object):
+    """A computation in progress in this process."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Single-flight layer over the memoize decorator of a Flask-Cache instance."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._metrics = defaultdict(Counter)
+
+    def _count(self, name, metric):
+        with self._lock:
+            self._metrics[name][metric] += 1
+
+    def metrics(self):
+        """Return the counters of each memoized function, {function name: {metric: count}}."""
+        with self._lock:
+            return {name: dict((metric, counts[metric]) for metric in metric_names)
+                    for name, counts in self._metrics.items()}
+
+    def memoize(self, timeout=None):
+        """Same as cache.memoize(timeout), with concurrent calls for the same arguments coalesced.
+
+        The decorated function keeps the attributes of cache.memoize (uncached, make_cache_key, cache_timeout), so
+        cache.delete_memoized works with it.
+        """
+
+        def decorator(f):
+            memoized = self.cache.memoize(timeout=timeout)(f)
+            name = '{}.{}'.format(f.__module__, f.__name__)
+
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                self._count(name, 'calls')
+                key = memoized.make_cache_key(f, *args, **kwargs)
+                rv = self.cache.get(key)
+                if rv is not None:
+                    self._count(name, 'hits')
+                    return rv
+                return self._fly(name, key, lambda: memoized(*args, **kwargs))
+
+            decorated_function.uncached = f
+            decorated_function.make_cache_key = memoized.make_cache_key
+            decorated_function.cache_timeout = timeout
+            return decorated_function
+
+        return decorator
+
+    def _fly(self, name, key, compute):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            if flight.done.wait(current_app.config.get('SINGLEFLIGHT_MAX_WAIT', 120)):
+                self._count(name, 'coalesced_local')
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            self._count(name, 'wait_timeouts')
+            return compute()
+
+        try:
+            flight.result = self._compute_shared(name, key, compute)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _compute_shared(self, name, key, compute):
+        """Compute a value unless another process holds the lock for its key, in which case wait for its result."""
+        config = current_app.config
+        lock_key = 'singleflight/' + key
+        if self.cache.add(lock_key, 1, timeout=config.get('SINGLEFLIGHT_LOCK_TIMEOUT', 300)):
+            try:
+                self._count(name, 'computed')
+                return compute()
+            finally:
+                self.cache.delete(lock_key)
+
+        deadline = time.time() + config.get('SINGLEFLIGHT_MAX_WAIT', 120)
+        while time.time() < deadline:
+            time.sleep(config.get('SINGLEFLIGHT_POLL_INTERVAL', 0.1))
+            rv = self.cache.get(key)
+            if rv is not None:
+                self._count(name, 'coalesced_remote')
+                return rv
+            if self.cache.get(lock_key) is None:
+                # The other process finished without caching a value (ie. it failed): compute it here.
+                break
+        else:
+            self._count(name, 'wait_timeouts')
+        self._count(name, 'computed')
+        return compute()